@@ -1,13 +1,11 @@
 # app/__init__.py
 import os
 from flask import Flask
-from sqlalchemy import text
 
-# Importamos las extensiones, modelos y utils
-from .extensions import engine, login_manager
-from .models import User
+# Importamos las extensiones y utils
+from .extensions import login_manager
 # Solo importamos lo que no causa dependencias circulares o es seguro
-from .utils import is_inf
+from .utils import is_inf, cargar_usuario
 
 def create_app():
     """Crea y configura la instancia de la aplicación Flask."""
@@ -52,16 +50,8 @@ def create_app():
     # --- 4. Registrar User Loader ---
     @login_manager.user_loader
     def load_user(user_id):
-        try:
-            with engine.connect() as conn:
-                query = text("SELECT Id_Usuario, Nombre, Correo, Id_Rol FROM Usuarios WHERE Id_Usuario = :id AND Estado = 1")
-                result = conn.execute(query, {"id": int(user_id)}).fetchone()
-                if result:
-                    return User(id=result[0], nombre=result[1], correo=result[2], id_rol=result[3])
-        except Exception as e:
-            print(f"Error en user_loader: {e}")
-            return None
-        return None
+        # Usuario y rol en una sola consulta, con caché corta (ver utils.cargar_usuario)
+        return cargar_usuario(user_id)
 
     # --- 5. Registrar Filtros de Jinja2 ---
     @app.template_filter('is_inf')
@@ -93,13 +83,17 @@ def create_app():
             is_user_role, 
             get_rol_name_by_id, 
             is_admin, 
-            is_super_admin
+            is_super_admin,
+            FORMATOS_EXPORTACION,
+            NOMBRES_FORMATOS_EXPORTACION
         )
         return dict(
             check_user_role=is_user_role,
             get_rol_name=get_rol_name_by_id,
             is_user_admin=is_admin,
-            is_user_super_admin=is_super_admin
+            is_user_super_admin=is_super_admin,
+            # Formatos de exportación disponibles (parquet solo con pyarrow instalado)
+            formatos_exportacion={formato: NOMBRES_FORMATOS_EXPORTACION[formato] for formato in FORMATOS_EXPORTACION}
         )
 
     return app
\ No newline at end of file
@@ -4,11 +4,14 @@ from flask_login import login_required, current_user
 from sqlalchemy import text
 from decimal import Decimal, InvalidOperation
 from collections import defaultdict
-from datetime import date
 
 # Importamos engine y nuestras funciones de utils
-from ..extensions import engine
-from ..utils import admin_required, get_financial_reports
+from ..extensions import engine, estado_pool
+from ..utils import (
+    admin_required, get_financial_reports, invalidar_cache_reportes, invalidar_rol_usuario, obtener_periodos,
+    precalentar_analisis_ia, convertir_monto, asegurar_periodos, guardar_saldos, leer_filas_importacion,
+    cargar_saldos_importados, leer_filas_catalogo, sincronizar_catalogo
+)
 
 # Creamos el Blueprint
 admin_bp = Blueprint('admin', __name__)
@@ -23,18 +26,16 @@ def gestion():
     report_data = None
     
     try:
-        with engine.connect() as conn:
-            periodos_query = text("SELECT Anio FROM Periodo ORDER BY Anio DESC")
-            periodos_result = conn.execute(periodos_query).fetchall()
-            periodos = [row[0] for row in periodos_result]
-            
-            if not anio_seleccionado and periodos:
-                anio_seleccionado = periodos[0]
-            
-            if anio_seleccionado:
-                report_data = get_financial_reports(anio_seleccionado)
-                if not report_data:
-                    flash(f'No se encontraron datos de saldos para el año {anio_seleccionado}.', 'error')
+        # Períodos disponibles (registro en caché, sin abrir conexión)
+        periodos = obtener_periodos().anios
+        
+        if not anio_seleccionado and periodos:
+            anio_seleccionado = periodos[0]
+        
+        if anio_seleccionado:
+            report_data = get_financial_reports(anio_seleccionado)
+            if not report_data:
+                flash(f'No se encontraron datos de saldos para el año {anio_seleccionado}.', 'error')
 
     except Exception as e:
         print(f"Error en la ruta /gestion: {e}")
@@ -65,7 +66,8 @@ def catalogo_cuentas():
                     text("INSERT INTO CatalogoCuentas (CuentaID, NombreCuenta, TipoCuenta, SubTipoCuenta) VALUES (:cuenta_id, :nombre, :tipo, :subtipo)"),
                     {"cuenta_id": cuenta_id, "nombre": nombre, "tipo": tipo, "subtipo": subtipo}
                 )
-                flash('Cuenta agregada exitosamente.', 'success')
+            invalidar_cache_reportes()
+            flash('Cuenta agregada exitosamente.', 'success')
         except Exception as e:
             print(f"Error en catalogo_cuentas (POST): {e}")
             flash(f'Error al guardar la cuenta: {e}', 'error')
@@ -93,36 +95,33 @@ def ingresar_saldos():
         anio = request.form.get('anio')
         
         try:
+            # Validar todos los montos antes de abrir la transacción
+            saldos = []
+            cuentas_invalidas = []
+            for key, value in request.form.items():
+                if key.startswith('saldo_'):
+                    cuenta_id = key.split('_')[1]
+                    try:
+                        monto = convertir_monto(value)
+                    except ValueError:
+                        cuentas_invalidas.append(cuenta_id)
+                        continue
+                    if monto is not None:
+                        saldos.append((cuenta_id, monto))
+            
+            if cuentas_invalidas:
+                flash(f'Montos inválidos en las cuentas: {", ".join(cuentas_invalidas)}. No se guardó ningún saldo.', 'error')
+                return redirect(url_for('admin.ingresar_saldos'))
+            
             with engine.begin() as conn:
                 # Verificar si el periodo existe, si no crearlo
-                periodo_query = text("SELECT PeriodoID FROM Periodo WHERE Anio = :anio")
-                periodo_result = conn.execute(periodo_query, {"anio": anio}).fetchone();
-                
-                if not periodo_result:
-                    # PostgreSQL: Agregar FechaCierre requerido
-                    fecha_cierre = date(int(anio), 12, 31)
-                    conn.execute(
-                        text("INSERT INTO Periodo (Anio, FechaCierre) VALUES (:anio, :fecha_cierre)"), 
-                        {"anio": anio, "fecha_cierre": fecha_cierre}
-                    )
-                    periodo_result = conn.execute(periodo_query, {"anio": anio}).fetchone()
-                
-                periodo_id = periodo_result[0]
-                
-                # Procesar saldos
-                for key, value in request.form.items():
-                    if key.startswith('saldo_'):
-                        cuenta_id = key.split('_')[1]
-                        monto = value
-                        if monto:
-                            # PostgreSQL: INSERT ... ON CONFLICT (reemplaza MERGE)
-                            conn.execute(text("""
-                                INSERT INTO SaldoCuenta (CuentaID, PeriodoID, Monto)
-                                VALUES (:cuenta_id, :periodo_id, :monto)
-                                ON CONFLICT (PeriodoID, CuentaID)
-                                DO UPDATE SET Monto = EXCLUDED.Monto
-                            """), {"cuenta_id": cuenta_id, "periodo_id": periodo_id, "monto": monto})
+                periodo_id = asegurar_periodos(conn, [int(anio)])[int(anio)]
+                # Todos los saldos del año en una sentencia por lote
+                guardar_saldos(conn, [(cuenta_id, periodo_id, monto) for cuenta_id, monto in saldos])
 
+            invalidar_cache_reportes()
+            # Genera en segundo plano los análisis de IA del año (si IA_PRECALENTAR está activo)
+            precalentar_analisis_ia(int(anio))
             flash(f'Saldos guardados exitosamente para el año {anio}.', 'success')
             return redirect(url_for('admin.gestion', anio=anio))
         except Exception as e:
@@ -159,6 +158,47 @@ def ingresar_saldos():
     return render_template('ingresar_saldos.html', 
                            cuentas_agrupadas=cuentas_agrupadas)
 
+@admin_bp.route('/importar-saldos/', methods=['POST'])
+@login_required
+@admin_required
+def importar_saldos():
+    """Importa saldos de varios años desde un CSV o XLSX con columnas CuentaID, Anio y Monto."""
+    archivo = request.files.get('archivo')
+    if not archivo or not archivo.filename:
+        flash('Selecciona un archivo CSV o XLSX para importar.', 'error')
+        return redirect(url_for('admin.ingresar_saldos'))
+    
+    try:
+        resultado = cargar_saldos_importados(leer_filas_importacion(archivo.stream, archivo.filename))
+    except ValueError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('admin.ingresar_saldos'))
+    except Exception as e:
+        print(f"Error al importar saldos: {e}")
+        flash('Error al importar los saldos. Revisa el archivo e inténtalo de nuevo.', 'error')
+        return redirect(url_for('admin.ingresar_saldos'))
+    
+    if resultado['total_errores']:
+        # Nada se guardó: se informa cada fila con error para corregir el archivo
+        flash(f"El archivo tiene {resultado['total_errores']} fila(s) con errores. No se guardó ningún saldo.", 'error')
+        for numero_fila, mensaje in resultado['errores']:
+            flash(f'Fila {numero_fila}: {mensaje}.', 'error')
+        restantes = resultado['total_errores'] - len(resultado['errores'])
+        if restantes:
+            flash(f'... y {restantes} error(es) más.', 'error')
+        return redirect(url_for('admin.ingresar_saldos'))
+    
+    if not resultado['guardados']:
+        flash('El archivo no contiene saldos para importar.', 'error')
+        return redirect(url_for('admin.ingresar_saldos'))
+    
+    invalidar_cache_reportes()
+    ultimo_anio = resultado['anios'][-1]
+    precalentar_analisis_ia(ultimo_anio)
+    anios = ', '.join(str(anio) for anio in resultado['anios'])
+    flash(f"Se importaron {resultado['guardados']} saldos de los años {anios}.", 'success')
+    return redirect(url_for('admin.gestion', anio=ultimo_anio))
+
 @admin_bp.route('/gestion-usuarios')
 @login_required
 @admin_required
@@ -202,6 +242,7 @@ def update_user_role():
                     text("UPDATE Usuarios SET Id_Rol = :role_id WHERE Id_Usuario = :user_id"),
                     {"role_id": new_role_id, "user_id": user_id}
                 )
+            invalidar_rol_usuario(user_id)
             return jsonify({'success': True, 'message': 'Rol de usuario actualizado correctamente.'})
         except Exception as e:
             print(f"Error updating user role (JSON): {e}")
@@ -217,6 +258,7 @@ def update_user_role():
                 text("UPDATE Usuarios SET Id_Rol = :role_id WHERE Id_Usuario = :user_id"),
                 {"role_id": new_role_id, "user_id": user_id}
             )
+        invalidar_rol_usuario(user_id)
         flash('Rol de usuario actualizado correctamente.', 'success')
     except Exception as e:
         print(f"Error updating user role: {e}")
@@ -245,6 +287,7 @@ def toggle_user_status():
                 {"status": new_status, "id": user_id}
             )
             
+        invalidar_rol_usuario(user_id)
         flash('Estado de usuario actualizado correctamente.', 'success')
     except Exception as e:
         print(f"Error updating user status: {e}")
@@ -267,9 +310,62 @@ def editar_cuenta():
                 text("UPDATE CatalogoCuentas SET NombreCuenta = :nombre, TipoCuenta = :tipo, SubTipoCuenta = :subtipo WHERE CuentaID = :id"),
                 {"nombre": nombre, "tipo": tipo, "subtipo": subtipo, "id": cuenta_id}
             )
-            flash('Cuenta actualizada exitosamente.', 'success')
+        invalidar_cache_reportes()
+        flash('Cuenta actualizada exitosamente.', 'success')
     except Exception as e:
         print(f"Error en editar_cuenta: {e}")
         flash(f'Error al actualizar la cuenta: {e}', 'error')
     
-    return redirect(url_for('admin.catalogo_cuentas'))
\ No newline at end of file
+    return redirect(url_for('admin.catalogo_cuentas'))
+
+@admin_bp.route('/catalogo-cuentas/sincronizar', methods=['POST'])
+@login_required
+@admin_required
+def sincronizar_catalogo_cuentas():
+    """Sincroniza el catálogo con un plan de cuentas completo en CSV o XLSX."""
+    archivo = request.files.get('archivo')
+    if not archivo or not archivo.filename:
+        flash('Selecciona un archivo CSV o XLSX con el catálogo.', 'error')
+        return redirect(url_for('admin.catalogo_cuentas'))
+    
+    try:
+        resultado = sincronizar_catalogo(leer_filas_catalogo(archivo.stream, archivo.filename))
+    except ValueError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('admin.catalogo_cuentas'))
+    except Exception as e:
+        print(f"Error al sincronizar el catálogo: {e}")
+        flash('Error al sincronizar el catálogo. Revisa el archivo e inténtalo de nuevo.', 'error')
+        return redirect(url_for('admin.catalogo_cuentas'))
+    
+    if resultado['total_errores']:
+        flash(f"El archivo tiene {resultado['total_errores']} fila(s) con errores. No se modificó el catálogo.", 'error')
+        for numero_fila, mensaje in resultado['errores']:
+            flash(f'Fila {numero_fila}: {mensaje}.', 'error')
+        restantes = resultado['total_errores'] - len(resultado['errores'])
+        if restantes:
+            flash(f'... y {restantes} error(es) más.', 'error')
+        return redirect(url_for('admin.catalogo_cuentas'))
+    
+    if not resultado['filas']:
+        flash('El archivo no contiene cuentas.', 'error')
+        return redirect(url_for('admin.catalogo_cuentas'))
+    
+    # Una sola invalidación para todo el lote (reportes, clasificación, exportaciones)
+    if resultado['insertadas'] or resultado['actualizadas']:
+        invalidar_cache_reportes()
+    mensaje = (f"Catálogo sincronizado: {resultado['insertadas']} cuenta(s) nueva(s), "
+               f"{resultado['actualizadas']} actualizada(s), {resultado['sin_cambios']} sin cambios.")
+    if resultado['ausentes']:
+        mensaje += f" {resultado['ausentes']} cuenta(s) del catálogo no están en el archivo y se conservaron."
+    flash(mensaje, 'success')
+    return redirect(url_for('admin.catalogo_cuentas'))
+
+@admin_bp.route('/api/pool-stats')
+@login_required
+@admin_required
+def pool_stats():
+    """Estado del pool de conexiones del worker que atiende la petición."""
+    estado = estado_pool()
+    print(f"Pool de conexiones (pid {estado['pid']}): {estado['estado']}")
+    return jsonify(estado)
@@ -1,28 +1,42 @@
 # app/analysis/routes.py
 from flask import Blueprint, render_template, request, flash, send_file, redirect, url_for, jsonify
 from flask_login import login_required
-from sqlalchemy import text
+import re
 from io import BytesIO
 from datetime import datetime
 
-# Importamos engine y nuestras funciones de utils
-from ..extensions import engine
+# Importamos nuestras funciones de utils
 from ..utils import (
     get_financial_reports, 
-    analizar_con_gemini,
-    analizar_horizontal_ia,
-    analizar_ratios_ia,
-    analizar_origen_aplicacion_ia,
-    analizar_flujo_efectivo_ia,
+    get_financial_reports_many,
+    construir_prompt_vertical,
+    construir_prompt_horizontal,
+    construir_prompt_ratios,
+    construir_prompt_origen_aplicacion,
+    construir_prompt_flujo_efectivo,
+    construir_prompt_dupont,
+    encolar_analisis_ia,
+    encolar_analisis_combinado,
+    estado_analisis_ia,
+    transmitir_analisis_ia,
+    respuesta_sse,
     calcular_analisis_horizontal,
     calcular_origen_aplicacion,
     calcular_ratios_financieros,
+    calcular_porcentajes_verticales,
     exportar_analisis_excel,
     calcular_ctno,
     calcular_feo_indirecto,
     calcular_estado_flujo_efectivo,
     generar_analisis_dupont,
-    generar_estado_proforma
+    generar_estado_proforma,
+    obtener_periodos,
+    obtener_version_catalogo,
+    leer_cache_exportacion,
+    guardar_cache_exportacion,
+    generar_exportacion,
+    exportar_rango_analisis,
+    FORMATOS_EXPORTACION
 )
 
 # Creamos el Blueprint
@@ -41,48 +55,27 @@ def analisis_vertical():
     ctno_data = None
     
     try:
-        with engine.connect() as conn:
-            # Obtener todos los períodos disponibles
-            periodos_query = text("SELECT Anio FROM Periodo ORDER BY Anio DESC")
-            periodos_result = conn.execute(periodos_query).fetchall()
-            periodos = [row[0] for row in periodos_result]
-            
-            if anio_seleccionado:
-                report_data = get_financial_reports(anio_seleccionado)
-                if report_data:
-                    base_bg = report_data['Totales'].get('Total Activo', 0)
-                    base_er = report_data['Totales'].get('Ingreso', 0)
-                    
-                    # Calcular porcentajes verticales para cada cuenta
-                    tipos_balance = ['Activo', 'Pasivo', 'Patrimonio']
-                    tipos_resultados = ['Ingreso', 'Costo', 'Gasto']
-                    
-                    # Para Balance General (base = Total Activo)
-                    for tipo in tipos_balance:
-                        for subtipo, cuentas in report_data[tipo].items():
-                            for cuenta in cuentas:
-                                if base_bg > 0:
-                                    cuenta['percentage'] = (cuenta['monto'] / base_bg) * 100
-                                else:
-                                    cuenta['percentage'] = 0.0
-                    
-                    # Para Estado de Resultados (base = Ingresos)
-                    for tipo in tipos_resultados:
-                        for subtipo, cuentas in report_data[tipo].items():
-                            for cuenta in cuentas:
-                                if base_er > 0:
-                                    cuenta['percentage'] = (cuenta['monto'] / base_er) * 100
-                                else:
-                                    cuenta['percentage'] = 0.0
-                    
-                    # analisis_ia = analizar_con_gemini(report_data, anio_seleccionado)
-                    # Ahora se carga vía AJAX
-                    analisis_ia = None
-                    
-                    # Calcular CTNO (Capital de Trabajo Neto Operativo)
-                    ctno_data = calcular_ctno(anio_seleccionado)
-                else:
-                    flash(f'No se encontraron datos para el año {anio_seleccionado}.', 'error')
+        # Períodos disponibles (registro en caché, sin abrir conexión)
+        periodos = obtener_periodos().anios
+        
+        if anio_seleccionado:
+            report_data = get_financial_reports(anio_seleccionado)
+            if report_data:
+                base_bg = report_data['Totales'].get('Total Activo', 0)
+                base_er = report_data['Totales'].get('Ingreso', 0)
+                
+                # Calcular porcentajes verticales para cada cuenta
+                # (sobre una copia: el reporte en caché es de solo lectura)
+                report_data = calcular_porcentajes_verticales(report_data)
+                
+                # analisis_ia = analizar_con_gemini(report_data, anio_seleccionado)
+                # Ahora se carga vía AJAX
+                analisis_ia = None
+                
+                # Calcular CTNO (Capital de Trabajo Neto Operativo) sobre el reporte ya cargado
+                ctno_data = calcular_ctno(anio_seleccionado, report_data)
+            else:
+                flash(f'No se encontraron datos para el año {anio_seleccionado}.', 'error')
     except Exception as e:
         print(f"Error en la ruta /analisis-vertical: {e}")
         flash('Error al conectar con la base de datos.', 'error')
@@ -108,25 +101,23 @@ def analisis_horizontal():
     analisis_ia = None
     
     try:
-        with engine.connect() as conn:
-            # Obtener todos los períodos disponibles
-            periodos_query = text("SELECT Anio FROM Periodo ORDER BY Anio DESC")
-            periodos_result = conn.execute(periodos_query).fetchall()
-            periodos = [row[0] for row in periodos_result]
-            
-            if periodo_base and periodo_analisis:
-                if periodo_base < periodo_analisis:
-                    report_data_base = get_financial_reports(periodo_base)
-                    report_data_analisis = get_financial_reports(periodo_analisis)
-                    if report_data_base and report_data_analisis:
-                        analisis_comparativo = calcular_analisis_horizontal(report_data_base, report_data_analisis)
-                        # Agregar análisis con IA (ahora vía AJAX)
-                        analisis_ia = None
-                    else:
-                        flash('No se encontraron datos para uno o ambos períodos.', 'error')
+        # Períodos disponibles (registro en caché, sin abrir conexión)
+        periodos = obtener_periodos().anios
+        
+        if periodo_base and periodo_analisis:
+            if periodo_base < periodo_analisis:
+                reportes = get_financial_reports_many([periodo_base, periodo_analisis])
+                report_data_base = reportes.get(periodo_base)
+                report_data_analisis = reportes.get(periodo_analisis)
+                if report_data_base and report_data_analisis:
+                    analisis_comparativo = calcular_analisis_horizontal(report_data_base, report_data_analisis)
+                    # Agregar análisis con IA (ahora vía AJAX)
+                    analisis_ia = None
                 else:
-                    flash('El período base debe ser menor que el período de análisis.', 'error')
-                
+                    flash('No se encontraron datos para uno o ambos períodos.', 'error')
+            else:
+                flash('El período base debe ser menor que el período de análisis.', 'error')
+            
     except Exception as e:
         print(f"Error en la ruta /analisis-horizontal: {e}")
         flash('Error al conectar con la base de datos.', 'error')
@@ -153,34 +144,34 @@ def ratios_financieros():
     dupont_data = None
     
     try:
-        with engine.connect() as conn:
-            # Obtener todos los períodos disponibles
-            periodos_query = text("SELECT Anio FROM Periodo ORDER BY Anio DESC")
-            periodos_result = conn.execute(periodos_query).fetchall()
-            periodos = [row[0] for row in periodos_result]
-            
-            if anio_seleccionado:
-                report_data_anio = get_financial_reports(anio_seleccionado)
-                if report_data_anio:
-                    # Si se proporciona año anterior, obtener esos datos también
-                    if anio_anterior:
-                        report_data_anio_anterior = get_financial_reports(anio_anterior)
-                    
-                    # Calcular ratios financieros
-                    ratios_data = calcular_ratios_financieros(report_data_anio, report_data_anio_anterior)
-                    ratios_data['anio'] = anio_seleccionado
-                    ratios_data['anio_anterior'] = anio_anterior
-                    
-                    # Calcular Análisis DuPont
-                    dupont_result = generar_analisis_dupont(anio_seleccionado)
-                    if dupont_result.get('exito'):
-                        dupont_data = dupont_result.get('analisis_dupont')
-                    
-                    # Agregar análisis con IA (ahora vía AJAX)
-                    analisis_ia = None
-                else:
-                    flash(f'No se encontraron datos para el año {anio_seleccionado}.', 'error')
+        # Períodos disponibles (registro en caché, sin abrir conexión)
+        periodos = obtener_periodos().anios
+        
+        if anio_seleccionado:
+            # Se cargan juntos el año, el anterior que usa DuPont (anio - 1) y el indicado
+            anios = [anio_seleccionado, anio_seleccionado - 1] + ([anio_anterior] if anio_anterior else [])
+            reportes = get_financial_reports_many(anios)
+            report_data_anio = reportes.get(anio_seleccionado)
+            if report_data_anio:
+                # Si se proporciona año anterior, obtener esos datos también
+                if anio_anterior:
+                    report_data_anio_anterior = reportes.get(anio_anterior)
+                
+                # Calcular ratios financieros
+                ratios_data = calcular_ratios_financieros(report_data_anio, report_data_anio_anterior)
+                ratios_data['anio'] = anio_seleccionado
+                ratios_data['anio_anterior'] = anio_anterior
+                
+                # Calcular Análisis DuPont
+                dupont_result = generar_analisis_dupont(anio_seleccionado)
+                if dupont_result.get('exito'):
+                    dupont_data = dupont_result.get('analisis_dupont')
                 
+                # Agregar análisis con IA (ahora vía AJAX)
+                analisis_ia = None
+            else:
+                flash(f'No se encontraron datos para el año {anio_seleccionado}.', 'error')
+            
     except Exception as e:
         print(f"Error en la ruta /ratios-financieros: {e}")
         flash('Error al conectar con la base de datos.', 'error')
@@ -207,25 +198,23 @@ def origen_aplicacion():
     analisis_ia = None
     
     try:
-        with engine.connect() as conn:
-            # Obtener todos los períodos disponibles
-            periodos_query = text("SELECT Anio FROM Periodo ORDER BY Anio DESC")
-            periodos_result = conn.execute(periodos_query).fetchall()
-            periodos = [row[0] for row in periodos_result]
-            
-            if periodo_base and periodo_analisis:
-                if periodo_base < periodo_analisis:
-                    report_data_base = get_financial_reports(periodo_base)
-                    report_data_analisis = get_financial_reports(periodo_analisis)
-                    if report_data_base and report_data_analisis:
-                        origen_aplicacion_data = calcular_origen_aplicacion(report_data_base, report_data_analisis)
-                        # Agregar análisis con IA (ahora vía AJAX)
-                        analisis_ia = None
-                    else:
-                        flash('No se encontraron datos para uno o ambos períodos.', 'error')
+        # Períodos disponibles (registro en caché, sin abrir conexión)
+        periodos = obtener_periodos().anios
+        
+        if periodo_base and periodo_analisis:
+            if periodo_base < periodo_analisis:
+                reportes = get_financial_reports_many([periodo_base, periodo_analisis])
+                report_data_base = reportes.get(periodo_base)
+                report_data_analisis = reportes.get(periodo_analisis)
+                if report_data_base and report_data_analisis:
+                    origen_aplicacion_data = calcular_origen_aplicacion(report_data_base, report_data_analisis)
+                    # Agregar análisis con IA (ahora vía AJAX)
+                    analisis_ia = None
                 else:
-                    flash('El período base debe ser menor que el período de análisis.', 'error')
-                
+                    flash('No se encontraron datos para uno o ambos períodos.', 'error')
+            else:
+                flash('El período base debe ser menor que el período de análisis.', 'error')
+            
     except Exception as e:
         print(f"Error en la ruta /origen-aplicacion: {e}")
         flash('Error al conectar con la base de datos.', 'error')
@@ -249,28 +238,25 @@ def flujo_efectivo():
     periodos = []
     
     try:
-        with engine.connect() as conn:
-            # Obtener todos los períodos disponibles para mostrar en el selector
-            periodos_query = text("SELECT Anio FROM Periodo ORDER BY Anio DESC")
-            periodos_result = conn.execute(periodos_query).fetchall()
-            periodos = [row[0] for row in periodos_result]
-            
-            if periodo_inicio and periodo_fin:
-                if periodo_inicio < periodo_fin:
-                    # Calcular Estado de Flujo de Efectivo (clasificado cuenta por cuenta)
-                    flujo_data = calcular_estado_flujo_efectivo(periodo_inicio, periodo_fin)
-                    if not flujo_data['exito']:
-                        flash(flujo_data['mensaje'], 'error')
-                    
-                    # También calcular FEO para mostrar el resumen
-                    fecha_inicio = f"{periodo_inicio}-01-01"
-                    fecha_fin = f"{periodo_fin}-12-31"
-                    feo_data = calcular_feo_indirecto(fecha_inicio, fecha_fin)
-                else:
-                    flash('El período de inicio debe ser menor que el período de fin.', 'error')
-            elif periodo_inicio or periodo_fin:
-                flash('Por favor, selecciona ambos períodos (inicio y fin) para calcular el Flujo de Efectivo.', 'warning')
+        # Períodos disponibles (registro en caché, sin abrir conexión)
+        periodos = obtener_periodos().anios
+        
+        if periodo_inicio and periodo_fin:
+            if periodo_inicio < periodo_fin:
+                # Calcular Estado de Flujo de Efectivo (clasificado cuenta por cuenta)
+                flujo_data = calcular_estado_flujo_efectivo(periodo_inicio, periodo_fin)
+                if not flujo_data['exito']:
+                    flash(flujo_data['mensaje'], 'error')
                 
+                # También calcular FEO para mostrar el resumen
+                fecha_inicio = f"{periodo_inicio}-01-01"
+                fecha_fin = f"{periodo_fin}-12-31"
+                feo_data = calcular_feo_indirecto(fecha_inicio, fecha_fin)
+            else:
+                flash('El período de inicio debe ser menor que el período de fin.', 'error')
+        elif periodo_inicio or periodo_fin:
+            flash('Por favor, selecciona ambos períodos (inicio y fin) para calcular el Flujo de Efectivo.', 'warning')
+            
     except Exception as e:
         print(f"Error en la ruta /flujo-efectivo: {e}")
         flash('Error al conectar con la base de datos.', 'error')
@@ -291,28 +277,25 @@ def proforma():
     proforma_data = None
     
     try:
-        with engine.connect() as conn:
-            # Obtener todos los períodos disponibles
-            periodos_query = text("SELECT Anio FROM Periodo ORDER BY Anio DESC")
-            periodos_result = conn.execute(periodos_query).fetchall()
-            periodos = [row[0] for row in periodos_result]
-            
-            if anio_base and tasa_crecimiento is not None:
-                report_data = get_financial_reports(anio_base)
-                if report_data:
-                    # Convertir porcentaje a decimal (ej. 15 -> 0.15)
-                    tasa_decimal = tasa_crecimiento / 100.0
-                    
-                    resultado = generar_estado_proforma(report_data, tasa_decimal)
-                    if resultado['exito']:
-                        proforma_data = resultado['proforma']
-                    else:
-                        flash(resultado['mensaje'], 'error')
-                else:
-                    flash(f'No se encontraron datos para el año {anio_base}.', 'error')
-            elif anio_base:
-                flash('Por favor, ingresa una tasa de crecimiento.', 'warning')
+        # Períodos disponibles (registro en caché, sin abrir conexión)
+        periodos = obtener_periodos().anios
+        
+        if anio_base and tasa_crecimiento is not None:
+            report_data = get_financial_reports(anio_base)
+            if report_data:
+                # Convertir porcentaje a decimal (ej. 15 -> 0.15)
+                tasa_decimal = tasa_crecimiento / 100.0
                 
+                resultado = generar_estado_proforma(report_data, tasa_decimal)
+                if resultado['exito']:
+                    proforma_data = resultado['proforma']
+                else:
+                    flash(resultado['mensaje'], 'error')
+            else:
+                flash(f'No se encontraron datos para el año {anio_base}.', 'error')
+        elif anio_base:
+            flash('Por favor, ingresa una tasa de crecimiento.', 'warning')
+            
     except Exception as e:
         print(f"Error en la ruta /proforma: {e}")
         flash('Error al conectar con la base de datos.', 'error')
@@ -326,96 +309,107 @@ def proforma():
 @analysis_bp.route('/exportar-excel')
 @login_required
 def exportar_excel():
-    """Exporta el análisis financiero calculado a Excel"""
+    """
+    Exporta el análisis financiero calculado. formato=xlsx (por defecto) genera el
+    libro de Excel; csv, jsonl y parquet entregan filas planas para consumo automático.
+    """
     try:
         tipo_analisis = request.args.get('tipo', 'vertical')  # vertical, horizontal, ratios, origen_aplicacion
+        formato = request.args.get('formato', 'xlsx').lower()
         anio_seleccionado = request.args.get('anio', type=int)
         periodo_base = request.args.get('periodo_base', type=int)
         periodo_analisis = request.args.get('periodo_analisis', type=int)
         
-        wb = None
+        if formato not in FORMATOS_EXPORTACION:
+            flash(f'Formato de exportación no disponible: {formato}.', 'error')
+            return redirect(url_for('main.index'))
         
-        if tipo_analisis == 'vertical':
-            if not anio_seleccionado:
-                flash('Debe seleccionar un año para exportar.', 'error')
-                return redirect(url_for('analysis.analisis_vertical'))
-            report_data = get_financial_reports(anio_seleccionado)
-            if not report_data:
-                flash('No se encontraron datos para exportar.', 'error')
-                return redirect(url_for('analysis.analisis_vertical'))
-            from ..utils import exportar_analisis_vertical_excel
-            wb = exportar_analisis_vertical_excel(anio_seleccionado, report_data)
-            nombre_base = f'Analisis_Vertical_{anio_seleccionado}'
-        
-        elif tipo_analisis == 'horizontal':
-            if not periodo_base or not periodo_analisis:
-                flash('Debe seleccionar ambos períodos para exportar.', 'error')
-                return redirect(url_for('analysis.analisis_horizontal'))
-            report_data_base = get_financial_reports(periodo_base)
-            report_data_analisis = get_financial_reports(periodo_analisis)
-            if not report_data_base or not report_data_analisis:
-                flash('No se encontraron datos para exportar.', 'error')
-                return redirect(url_for('analysis.analisis_horizontal'))
-            analisis_comparativo = calcular_analisis_horizontal(report_data_base, report_data_analisis)
-            from ..utils import exportar_analisis_horizontal_excel
-            wb = exportar_analisis_horizontal_excel(periodo_base, periodo_analisis, analisis_comparativo)
-            nombre_base = f'Analisis_Horizontal_{periodo_base}_{periodo_analisis}'
-        
-        elif tipo_analisis == 'ratios':
-            if not anio_seleccionado:
-                flash('Debe seleccionar un año para exportar.', 'error')
-                return redirect(url_for('analysis.ratios_financieros'))
-            report_data = get_financial_reports(anio_seleccionado)
-            if not report_data:
-                flash('No se encontraron datos para exportar.', 'error')
-                return redirect(url_for('analysis.ratios_financieros'))
-            # Obtener año anterior para ratios si es necesario
-            periodos_query = text("SELECT Anio FROM Periodo ORDER BY Anio DESC")
-            with engine.connect() as conn:
-                periodos_result = conn.execute(periodos_query).fetchall()
-            periodos = [row[0] for row in periodos_result]
-            report_data_anterior = None
-            if anio_seleccionado in periodos:
-                idx = periodos.index(anio_seleccionado)
-                if idx + 1 < len(periodos):
-                    report_data_anterior = get_financial_reports(periodos[idx + 1])
-            ratios_data = calcular_ratios_financieros(report_data, report_data_anterior)
-            from ..utils import exportar_ratios_excel
-            wb = exportar_ratios_excel(anio_seleccionado, ratios_data)
-            nombre_base = f'Ratios_Financieros_{anio_seleccionado}'
-        
-        elif tipo_analisis == 'origen_aplicacion':
-            if not periodo_base or not periodo_analisis:
-                flash('Debe seleccionar ambos períodos para exportar.', 'error')
-                return redirect(url_for('analysis.origen_aplicacion'))
-            report_data_base = get_financial_reports(periodo_base)
-            report_data_analisis = get_financial_reports(periodo_analisis)
-            if not report_data_base or not report_data_analisis:
+        # El archivo de un período no cambia mientras no se escriban saldos o cuentas
+        clave = (tipo_analisis, formato, anio_seleccionado, periodo_base, periodo_analisis, obtener_version_catalogo())
+        exportacion = leer_cache_exportacion(clave)
+        
+        if exportacion is None:
+            argumentos = None
+        
+            if tipo_analisis == 'vertical':
+                if not anio_seleccionado:
+                    flash('Debe seleccionar un año para exportar.', 'error')
+                    return redirect(url_for('analysis.analisis_vertical'))
+                report_data = get_financial_reports(anio_seleccionado)
+                if not report_data:
+                    flash('No se encontraron datos para exportar.', 'error')
+                    return redirect(url_for('analysis.analisis_vertical'))
+                argumentos = (anio_seleccionado, report_data)
+                nombre_base = f'Analisis_Vertical_{anio_seleccionado}'
+        
+            elif tipo_analisis == 'horizontal':
+                if not periodo_base or not periodo_analisis:
+                    flash('Debe seleccionar ambos períodos para exportar.', 'error')
+                    return redirect(url_for('analysis.analisis_horizontal'))
+                reportes = get_financial_reports_many([periodo_base, periodo_analisis])
+                report_data_base = reportes.get(periodo_base)
+                report_data_analisis = reportes.get(periodo_analisis)
+                if not report_data_base or not report_data_analisis:
+                    flash('No se encontraron datos para exportar.', 'error')
+                    return redirect(url_for('analysis.analisis_horizontal'))
+                analisis_comparativo = calcular_analisis_horizontal(report_data_base, report_data_analisis)
+                argumentos = (periodo_base, periodo_analisis, analisis_comparativo)
+                nombre_base = f'Analisis_Horizontal_{periodo_base}_{periodo_analisis}'
+        
+            elif tipo_analisis == 'ratios':
+                if not anio_seleccionado:
+                    flash('Debe seleccionar un año para exportar.', 'error')
+                    return redirect(url_for('analysis.ratios_financieros'))
+                # Obtener año anterior para ratios si es necesario
+                registro_periodos = obtener_periodos()
+                anio_anterior = None
+                if anio_seleccionado in registro_periodos:
+                    anio_anterior = registro_periodos.anterior(anio_seleccionado)
+                reportes = get_financial_reports_many([anio_seleccionado, anio_anterior] if anio_anterior else [anio_seleccionado])
+                report_data = reportes.get(anio_seleccionado)
+                if not report_data:
+                    flash('No se encontraron datos para exportar.', 'error')
+                    return redirect(url_for('analysis.ratios_financieros'))
+                report_data_anterior = reportes.get(anio_anterior) if anio_anterior else None
+                ratios_data = calcular_ratios_financieros(report_data, report_data_anterior)
+                argumentos = (anio_seleccionado, ratios_data)
+                nombre_base = f'Ratios_Financieros_{anio_seleccionado}'
+        
+            elif tipo_analisis == 'origen_aplicacion':
+                if not periodo_base or not periodo_analisis:
+                    flash('Debe seleccionar ambos períodos para exportar.', 'error')
+                    return redirect(url_for('analysis.origen_aplicacion'))
+                reportes = get_financial_reports_many([periodo_base, periodo_analisis])
+                report_data_base = reportes.get(periodo_base)
+                report_data_analisis = reportes.get(periodo_analisis)
+                if not report_data_base or not report_data_analisis:
+                    flash('No se encontraron datos para exportar.', 'error')
+                    return redirect(url_for('analysis.origen_aplicacion'))
+                origen_aplicacion_data = calcular_origen_aplicacion(report_data_base, report_data_analisis)
+                argumentos = (periodo_base, periodo_analisis, origen_aplicacion_data)
+                nombre_base = f'Origen_Aplicacion_{periodo_base}_vs_{periodo_analisis}'
+            
+            contenido = generar_exportacion(tipo_analisis, formato, *argumentos) if argumentos else None
+            if not contenido:
                 flash('No se encontraron datos para exportar.', 'error')
-                return redirect(url_for('analysis.origen_aplicacion'))
-            origen_aplicacion_data = calcular_origen_aplicacion(report_data_base, report_data_analisis)
-            from ..utils import exportar_origen_aplicacion_excel
-            wb = exportar_origen_aplicacion_excel(periodo_base, periodo_analisis, origen_aplicacion_data)
-            nombre_base = f'Origen_Aplicacion_{periodo_base}_vs_{periodo_analisis}'
-        
-        if not wb:
-            flash('No se encontraron datos para exportar.', 'error')
-            return redirect(url_for('main.index'))
+                return redirect(url_for('main.index'))
+            
+            exportacion = guardar_cache_exportacion(clave, contenido, nombre_base)
         
-        # Guardar el workbook en memoria
-        output = BytesIO()
-        wb.save(output)
-        output.seek(0)
+        contenido, etag, nombre_base = exportacion
         
         # Generar nombre de archivo
         fecha = datetime.now().strftime('%Y%m%d_%H%M%S')
-        nombre_archivo = f'{nombre_base}_{fecha}.xlsx'
+        nombre_archivo = f'{nombre_base}_{fecha}.{formato}'
         
+        # Con conditional, un If-None-Match que coincide con el ETag responde 304
         return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            BytesIO(contenido),
+            mimetype=FORMATOS_EXPORTACION[formato],
             as_attachment=True,
-            download_name=nombre_archivo
+            download_name=nombre_archivo,
+            etag=etag,
+            conditional=True
         )
         
     except Exception as e:
@@ -423,41 +417,162 @@ def exportar_excel():
         flash('Error al generar el archivo Excel. Por favor, intenta de nuevo.', 'error')
         return redirect(url_for('main.index'))
 
+@analysis_bp.route('/exportar-todo')
+@login_required
+def exportar_todo():
+    """Exporta en un zip todos los análisis de un rango de años (desde/hasta) en el formato pedido."""
+    try:
+        anio_desde = request.args.get('desde', type=int)
+        anio_hasta = request.args.get('hasta', type=int)
+        formato = request.args.get('formato', 'xlsx').lower()
+        
+        if formato not in FORMATOS_EXPORTACION:
+            flash(f'Formato de exportación no disponible: {formato}.', 'error')
+            return redirect(url_for('main.dashboard_cliente'))
+        if not anio_desde or not anio_hasta or anio_desde > anio_hasta:
+            flash('Debe seleccionar un rango de años válido para exportar.', 'error')
+            return redirect(url_for('main.dashboard_cliente'))
+        
+        clave = ('todo', formato, anio_desde, anio_hasta, obtener_version_catalogo())
+        exportacion = leer_cache_exportacion(clave)
+        
+        if exportacion is None:
+            contenido = exportar_rango_analisis(anio_desde, anio_hasta, formato)
+            if not contenido:
+                flash('No se encontraron datos para exportar.', 'error')
+                return redirect(url_for('main.dashboard_cliente'))
+            exportacion = guardar_cache_exportacion(clave, contenido, f'Analisis_Completo_{anio_desde}_{anio_hasta}')
+        
+        contenido, etag, nombre_base = exportacion
+        fecha = datetime.now().strftime('%Y%m%d_%H%M%S')
+        
+        return send_file(
+            BytesIO(contenido),
+            mimetype='application/zip',
+            as_attachment=True,
+            download_name=f'{nombre_base}_{fecha}.zip',
+            etag=etag,
+            conditional=True
+        )
+        
+    except Exception as e:
+        print(f"Error al exportar todos los análisis: {e}")
+        flash('Error al generar la exportación. Por favor, intenta de nuevo.', 'error')
+        return redirect(url_for('main.dashboard_cliente'))
+
 # --- API Endpoints para Análisis con IA (Carga Asíncrona) ---
+# Cada endpoint arma el prompt y lo encola en el pool de IA. Si el análisis ya está en
+# caché responde con el HTML; si no, responde 202 con la URL de estado que la
+# plantilla consulta hasta que el trabajo termine (ver obtenerAnalisisIA en base.html).
+# Con ?stream=1 la respuesta se transmite por Server-Sent Events a medida que se genera;
+# la llamada al modelo corre igual en el pool (mismo job_id) y un análisis en caché o
+# ya en curso, como el precalentamiento, no se vuelve a pedir.
+
+def _responder_analisis_ia(prompt):
+    if request.args.get('stream') == '1':
+        return respuesta_sse(transmitir_analisis_ia(prompt))
+    
+    try:
+        job_id, analisis_html = encolar_analisis_ia(prompt)
+    except RuntimeError as e:
+        return jsonify({'estado': 'error', 'error': str(e)}), 503
+    
+    if analisis_html is not None:
+        return jsonify({'estado': 'listo', 'job_id': job_id, 'html': analisis_html})
+    return jsonify({
+        'estado': 'pendiente',
+        'job_id': job_id,
+        'status_url': url_for('analysis.api_ia_estado', job_id=job_id)
+    }), 202
+
+@analysis_bp.route('/api/ia-estado/<job_id>')
+@login_required
+def api_ia_estado(job_id):
+    if not re.fullmatch(r'[0-9a-f]{64}', job_id):
+        return jsonify({'estado': 'error', 'error': 'Trabajo no válido'}), 404
+    
+    estado = estado_analisis_ia(job_id)
+    estado['job_id'] = job_id
+    if estado['estado'] == 'pendiente':
+        estado['status_url'] = url_for('analysis.api_ia_estado', job_id=job_id)
+        return jsonify(estado), 202
+    return jsonify(estado)
+
+
+# Constructores de prompt compartidos por los endpoints sueltos y el combinado.
+# Devuelven None si no hay datos para los períodos indicados.
+
+def _prompt_vertical_ia(anio):
+    report_data = get_financial_reports(anio)
+    if not report_data:
+        return None
+    # Calcular porcentajes verticales (necesario para el contexto de la IA)
+    report_data = calcular_porcentajes_verticales(report_data)
+    return construir_prompt_vertical(report_data, anio)
+
+def _prompt_horizontal_ia(periodo_base, periodo_analisis):
+    reportes = get_financial_reports_many([periodo_base, periodo_analisis])
+    report_data_base = reportes.get(periodo_base)
+    report_data_analisis = reportes.get(periodo_analisis)
+    if not report_data_base or not report_data_analisis:
+        return None
+    # No necesitamos calcular todo el comparativo detallado si la IA usa los reportes crudos,
+    # pero analizar_horizontal_ia usa los reportes base y analisis.
+    return construir_prompt_horizontal(report_data_base, report_data_analisis, periodo_base, periodo_analisis)
+
+def _prompt_ratios_ia(anio, anio_anterior=None):
+    reportes = get_financial_reports_many([anio, anio_anterior] if anio_anterior else [anio])
+    report_data = reportes.get(anio)
+    if not report_data:
+        return None
+    report_data_anterior = None
+    if anio_anterior:
+        report_data_anterior = reportes.get(anio_anterior)
+    ratios_data = calcular_ratios_financieros(report_data, report_data_anterior)
+    ratios_data['anio'] = anio
+    ratios_data['anio_anterior'] = anio_anterior
+    return construir_prompt_ratios(ratios_data)
+
+def _prompt_dupont_ia(anio):
+    dupont_result = generar_analisis_dupont(anio)
+    if not dupont_result.get('exito'):
+        return None
+    return construir_prompt_dupont(dupont_result['analisis_dupont'], anio)
+
+def _prompt_origen_aplicacion_ia(periodo_base, periodo_analisis):
+    reportes = get_financial_reports_many([periodo_base, periodo_analisis])
+    report_data_base = reportes.get(periodo_base)
+    report_data_analisis = reportes.get(periodo_analisis)
+    if not report_data_base or not report_data_analisis:
+        return None
+    origen_aplicacion_data = calcular_origen_aplicacion(report_data_base, report_data_analisis)
+    return construir_prompt_origen_aplicacion(origen_aplicacion_data)
+
+def _prompt_flujo_efectivo_ia(periodo_inicio, periodo_fin):
+    # Recalcular datos de flujo (necesario para la IA)
+    flujo_data = calcular_estado_flujo_efectivo(periodo_inicio, periodo_fin)
+    if not flujo_data or not flujo_data.get('exito'):
+        return None
+    return construir_prompt_flujo_efectivo(flujo_data, periodo_inicio, periodo_fin)
+
+# tipo -> (constructor, parámetros de la query string que recibe en orden, requeridos)
+_ANALISIS_IA = {
+    'vertical': (_prompt_vertical_ia, ('anio',), 1),
+    'horizontal': (_prompt_horizontal_ia, ('base', 'analisis'), 2),
+    'ratios': (_prompt_ratios_ia, ('anio', 'anio_anterior'), 1),
+    'dupont': (_prompt_dupont_ia, ('anio',), 1),
+    'origen_aplicacion': (_prompt_origen_aplicacion_ia, ('base', 'analisis'), 2),
+    'flujo_efectivo': (_prompt_flujo_efectivo_ia, ('inicio', 'fin'), 2),
+}
 
 @analysis_bp.route('/api/vertical-ia/<int:anio>')
 @login_required
 def api_vertical_ia(anio):
     try:
-        report_data = get_financial_reports(anio)
-        if not report_data:
+        prompt = _prompt_vertical_ia(anio)
+        if not prompt:
             return jsonify({'error': 'No se encontraron datos'}), 404
-            
-        # Calcular porcentajes verticales (necesario para el contexto de la IA)
-        base_bg = report_data['Totales'].get('Total Activo', 0)
-        base_er = report_data['Totales'].get('Ingreso', 0)
-        
-        tipos_balance = ['Activo', 'Pasivo', 'Patrimonio']
-        tipos_resultados = ['Ingreso', 'Costo', 'Gasto']
-        
-        for tipo in tipos_balance:
-            for subtipo, cuentas in report_data[tipo].items():
-                for cuenta in cuentas:
-                    if base_bg > 0:
-                        cuenta['percentage'] = (cuenta['monto'] / base_bg) * 100
-                    else:
-                        cuenta['percentage'] = 0.0
-        
-        for tipo in tipos_resultados:
-            for subtipo, cuentas in report_data[tipo].items():
-                for cuenta in cuentas:
-                    if base_er > 0:
-                        cuenta['percentage'] = (cuenta['monto'] / base_er) * 100
-                    else:
-                        cuenta['percentage'] = 0.0
-                        
-        analisis_html = analizar_con_gemini(report_data, anio)
-        return jsonify({'html': analisis_html})
+        return _responder_analisis_ia(prompt)
     except Exception as e:
         print(f"Error en API Vertical IA: {e}")
         return jsonify({'error': str(e)}), 500
@@ -472,16 +587,10 @@ def api_horizontal_ia():
         if not periodo_base or not periodo_analisis:
             return jsonify({'error': 'Faltan parámetros'}), 400
             
-        report_data_base = get_financial_reports(periodo_base)
-        report_data_analisis = get_financial_reports(periodo_analisis)
-        
-        if not report_data_base or not report_data_analisis:
+        prompt = _prompt_horizontal_ia(periodo_base, periodo_analisis)
+        if not prompt:
             return jsonify({'error': 'No se encontraron datos'}), 404
-            
-        # No necesitamos calcular todo el comparativo detallado si la IA usa los reportes crudos,
-        # pero analizar_horizontal_ia usa los reportes base y analisis.
-        analisis_html = analizar_horizontal_ia(report_data_base, report_data_analisis, periodo_base, periodo_analisis)
-        return jsonify({'html': analisis_html})
+        return _responder_analisis_ia(prompt)
     except Exception as e:
         print(f"Error en API Horizontal IA: {e}")
         return jsonify({'error': str(e)}), 500
@@ -496,24 +605,31 @@ def api_ratios_ia():
         if not anio:
             return jsonify({'error': 'Falta el año'}), 400
             
-        report_data = get_financial_reports(anio)
-        if not report_data:
+        prompt = _prompt_ratios_ia(anio, anio_anterior)
+        if not prompt:
             return jsonify({'error': 'No se encontraron datos'}), 404
-            
-        report_data_anterior = None
-        if anio_anterior:
-            report_data_anterior = get_financial_reports(anio_anterior)
-            
-        ratios_data = calcular_ratios_financieros(report_data, report_data_anterior)
-        ratios_data['anio'] = anio
-        ratios_data['anio_anterior'] = anio_anterior
-        
-        analisis_html = analizar_ratios_ia(ratios_data)
-        return jsonify({'html': analisis_html})
+        return _responder_analisis_ia(prompt)
     except Exception as e:
         print(f"Error en API Ratios IA: {e}")
         return jsonify({'error': str(e)}), 500
 
+@analysis_bp.route('/api/dupont-ia')
+@login_required
+def api_dupont_ia():
+    try:
+        anio = request.args.get('anio', type=int)
+        
+        if not anio:
+            return jsonify({'error': 'Falta el año'}), 400
+            
+        prompt = _prompt_dupont_ia(anio)
+        if not prompt:
+            return jsonify({'error': 'No se encontraron datos'}), 404
+        return _responder_analisis_ia(prompt)
+    except Exception as e:
+        print(f"Error en API DuPont IA: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @analysis_bp.route('/api/origen-aplicacion-ia')
 @login_required
 def api_origen_aplicacion_ia():
@@ -524,16 +640,10 @@ def api_origen_aplicacion_ia():
         if not periodo_base or not periodo_analisis:
             return jsonify({'error': 'Faltan parámetros'}), 400
             
-        report_data_base = get_financial_reports(periodo_base)
-        report_data_analisis = get_financial_reports(periodo_analisis)
-        
-        if not report_data_base or not report_data_analisis:
+        prompt = _prompt_origen_aplicacion_ia(periodo_base, periodo_analisis)
+        if not prompt:
             return jsonify({'error': 'No se encontraron datos'}), 404
-            
-        origen_aplicacion_data = calcular_origen_aplicacion(report_data_base, report_data_analisis)
-        
-        analisis_html = analizar_origen_aplicacion_ia(origen_aplicacion_data)
-        return jsonify({'html': analisis_html})
+        return _responder_analisis_ia(prompt)
     except Exception as e:
         print(f"Error en API Origen Aplicación IA: {e}")
         return jsonify({'error': str(e)}), 500
@@ -548,14 +658,53 @@ def api_flujo_efectivo_ia():
         if not periodo_inicio or not periodo_fin:
             return jsonify({'error': 'Faltan parámetros'}), 400
             
-        # Recalcular datos de flujo (necesario para la IA)
-        flujo_data = calcular_estado_flujo_efectivo(periodo_inicio, periodo_fin)
-        
-        if not flujo_data or not flujo_data.get('exito'):
+        prompt = _prompt_flujo_efectivo_ia(periodo_inicio, periodo_fin)
+        if not prompt:
              return jsonify({'error': 'No se pudieron calcular los datos'}), 404
-
-        analisis_html = analizar_flujo_efectivo_ia(flujo_data, periodo_inicio, periodo_fin)
-        return jsonify({'html': analisis_html})
+        return _responder_analisis_ia(prompt)
     except Exception as e:
         print(f"Error en API Flujo Efectivo IA: {e}")
         return jsonify({'error': str(e)}), 500
+
+@analysis_bp.route('/api/ia-combinado')
+@login_required
+def api_ia_combinado():
+    """
+    Varios análisis de los mismos períodos en una sola llamada al modelo, p. ej.
+    ?tipos=ratios,dupont&anio=2024 o ?tipos=horizontal,origen_aplicacion&base=2023&analisis=2024.
+    Responde {'estado': 'listo', 'secciones': {tipo: html}} o 202 con status_url.
+    """
+    try:
+        tipos = [t.strip() for t in request.args.get('tipos', '').split(',') if t.strip()]
+        if not tipos:
+            return jsonify({'error': 'Faltan los tipos de análisis'}), 400
+        desconocidos = [t for t in tipos if t not in _ANALISIS_IA]
+        if desconocidos:
+            return jsonify({'error': f"Tipos de análisis no válidos: {', '.join(desconocidos)}"}), 400
+        
+        prompts = {}
+        for tipo in dict.fromkeys(tipos):
+            constructor, parametros, requeridos = _ANALISIS_IA[tipo]
+            valores = [request.args.get(nombre, type=int) for nombre in parametros]
+            if not all(valores[:requeridos]):
+                return jsonify({'error': 'Faltan parámetros'}), 400
+            prompt = constructor(*valores)
+            if not prompt:
+                return jsonify({'error': f'No se encontraron datos para el análisis {tipo}'}), 404
+            prompts[tipo] = prompt
+        
+        try:
+            job_id, secciones = encolar_analisis_combinado(prompts)
+        except RuntimeError as e:
+            return jsonify({'estado': 'error', 'error': str(e)}), 503
+        
+        if secciones is not None:
+            return jsonify({'estado': 'listo', 'job_id': job_id, 'secciones': secciones})
+        return jsonify({
+            'estado': 'pendiente',
+            'job_id': job_id,
+            'status_url': url_for('analysis.api_ia_estado', job_id=job_id)
+        }), 202
+    except Exception as e:
+        print(f"Error en API IA combinado: {e}")
+        return jsonify({'estado': 'error', 'error': str(e)}), 500
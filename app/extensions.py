@@ -1,5 +1,5 @@
 import os
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from flask_login import LoginManager
 from dotenv import load_dotenv
 
@@ -34,8 +34,54 @@ else:
     connection_string = f"mssql+pyodbc://@{SERVER_NAME}/{DATABASE_NAME}?driver={DRIVER_NAME}&trusted_connection=yes"
     print("--- MODO LOCAL: Conectando a SQL Server ---")
 
+# --- POOL DE CONEXIONES ---
+# Configurable por entorno para ajustarlo según la cantidad de workers de gunicorn:
+# cada worker tiene su propio pool, así que el máximo de conexiones contra la BD es
+# workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW).
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', '30'))            # segundos esperando una conexión libre
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))          # segundos antes de reabrir una conexión
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', '1').lower() in ('1', 'true', 'si', 'yes')
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', '0'))  # 0 = sin límite
+
+connect_args = {}
+if DATABASE_URL and DB_STATEMENT_TIMEOUT_MS:
+    # PostgreSQL: límite por sentencia a nivel de sesión
+    connect_args['options'] = f'-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}'
+
 # Crear engine
-engine = create_engine(connection_string)
+engine = create_engine(
+    connection_string,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING,
+    connect_args=connect_args
+)
+
+if not DATABASE_URL and DB_STATEMENT_TIMEOUT_MS:
+    # SQL Server (pyodbc): el timeout se asigna a cada conexión nueva, en segundos
+    @event.listens_for(engine, 'connect')
+    def _asignar_timeout_sql_server(dbapi_connection, connection_record):
+        dbapi_connection.timeout = max(1, DB_STATEMENT_TIMEOUT_MS // 1000)
+
+print(f"--- Pool de conexiones: size={DB_POOL_SIZE}, max_overflow={DB_MAX_OVERFLOW}, "
+      f"recycle={DB_POOL_RECYCLE}s, pre_ping={DB_POOL_PRE_PING}, statement_timeout={DB_STATEMENT_TIMEOUT_MS}ms ---")
+
+def estado_pool():
+    """Estadísticas del pool de conexiones de este proceso (worker)."""
+    pool = engine.pool
+    return {
+        'pid': os.getpid(),
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'en_pool': pool.checkedin(),
+        'en_uso': pool.checkedout(),
+        'overflow': pool.overflow(),
+        'estado': pool.status()
+    }
 
 # Configuración Flask-Login
 login_manager = LoginManager()
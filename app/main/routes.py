@@ -5,7 +5,23 @@ from sqlalchemy import text
 
 # Importamos engine y nuestras funciones de utils
 from ..extensions import engine
-from ..utils import get_financial_reports, calcular_ratios_financieros
+from ..utils import (
+    get_financial_reports,
+    get_financial_reports_many,
+    calcular_ratios_financieros,
+    obtener_periodos,
+    generar_texto_ia,
+    ia_disponible,
+    IANoDisponibleError,
+    leer_cache_ia,
+    respuesta_sse,
+    clave_pregunta_chatbot,
+    construir_prompt_chatbot,
+    historial_chatbot,
+    registrar_respuesta_chatbot,
+    transmitir_respuesta_chatbot,
+    consumir_token_chatbot
+)
 
 # Creamos el Blueprint
 main_bp = Blueprint('main', __name__)
@@ -27,84 +43,83 @@ def dashboard_cliente():
     crecimiento = {}
     
     try:
-        with engine.connect() as conn:
-            # Obtener todos los períodos disponibles
-            periodos_query = text("SELECT Anio FROM Periodo ORDER BY Anio DESC")
-            periodos_result = conn.execute(periodos_query).fetchall()
-            periodos = [row[0] for row in periodos_result]
+        # Períodos disponibles (registro en caché, sin abrir conexión)
+        registro_periodos = obtener_periodos()
+        periodos = registro_periodos.anios
+        
+        if not anio_seleccionado and periodos:
+            anio_seleccionado = periodos[0]
+        
+        if anio_seleccionado:
+            # Determinar el año anterior para comparación
+            anio_anterior = None
+            if anio_seleccionado in registro_periodos:
+                anio_anterior = registro_periodos.anterior(anio_seleccionado)
             
-            if not anio_seleccionado and periodos:
-                anio_seleccionado = periodos[0]
+            # Obtener datos del año actual y del anterior en una sola consulta
+            reportes = get_financial_reports_many([anio_seleccionado, anio_anterior] if anio_anterior else [anio_seleccionado])
+            report_data = reportes.get(anio_seleccionado)
+            if anio_anterior:
+                report_data_anterior = reportes.get(anio_anterior)
             
-            if anio_seleccionado:
-                # Obtener datos del año actual
-                report_data = get_financial_reports(anio_seleccionado)
+            if report_data:
+                # Calcular ratios financieros
+                ratios = calcular_ratios_financieros(report_data, report_data_anterior)
                 
-                # Obtener datos del año anterior para comparación
-                if len(periodos) > 1 and anio_seleccionado in periodos:
-                    indice_actual = periodos.index(anio_seleccionado)
-                    if indice_actual < len(periodos) - 1:
-                        anio_anterior = periodos[indice_actual + 1]
-                        report_data_anterior = get_financial_reports(anio_anterior)
+                # Calcular KPIs importantes para inversores
+                ventas = report_data['Totales'].get('Ingreso', 0.0)
+                utilidad_neta = report_data['Totales'].get('Utilidad Neta', 0.0)
+                utilidad_operativa = report_data['Totales'].get('Utilidad Operativa', 0.0)
+                activos_totales = report_data['Totales'].get('Total Activo', 0.0)
+                patrimonio = report_data['Totales'].get('Total Patrimonio', 0.0)
+                pasivos_totales = report_data['Totales'].get('Total Pasivo', 0.0)
                 
-                if report_data:
-                    # Calcular ratios financieros
-                    ratios = calcular_ratios_financieros(report_data, report_data_anterior)
-                    
-                    # Calcular KPIs importantes para inversores
-                    ventas = report_data['Totales'].get('Ingreso', 0.0)
-                    utilidad_neta = report_data['Totales'].get('Utilidad Neta', 0.0)
-                    utilidad_operativa = report_data['Totales'].get('Utilidad Operativa', 0.0)
-                    activos_totales = report_data['Totales'].get('Total Activo', 0.0)
-                    patrimonio = report_data['Totales'].get('Total Patrimonio', 0.0)
-                    pasivos_totales = report_data['Totales'].get('Total Pasivo', 0.0)
-                    
-                    # Calcular ROE (Return on Equity)
-                    roe = (utilidad_neta / patrimonio * 100) if patrimonio > 0 else 0.0
-                    
-                    # Calcular ROA (Return on Assets)
-                    roa = (utilidad_neta / activos_totales * 100) if activos_totales > 0 else 0.0
-                    
-                    # Margen de utilidad neta
-                    margen_utilidad_neta = (utilidad_neta / ventas * 100) if ventas > 0 else 0.0
-                    
-                    # Razón circulante
-                    activos_circulantes = sum([c['monto'] for c in report_data['Activo'].get('Activo Corriente', [])])
-                    pasivos_circulantes = sum([c['monto'] for c in report_data['Pasivo'].get('Pasivo Corriente', [])])
-                    razon_circulante = (activos_circulantes / pasivos_circulantes) if pasivos_circulantes > 0 else 0.0
-                    
-                    # Razón de endeudamiento
-                    razon_endeudamiento = ((pasivos_totales / activos_totales) * 100) if activos_totales > 0 else 0.0
+                # Calcular ROE (Return on Equity)
+                roe = (utilidad_neta / patrimonio * 100) if patrimonio > 0 else 0.0
+                
+                # Calcular ROA (Return on Assets)
+                roa = (utilidad_neta / activos_totales * 100) if activos_totales > 0 else 0.0
+                
+                # Margen de utilidad neta
+                margen_utilidad_neta = (utilidad_neta / ventas * 100) if ventas > 0 else 0.0
+                
+                # Razón circulante
+                activos_circulantes = sum([c['monto'] for c in report_data['Activo'].get('Activo Corriente', [])])
+                pasivos_circulantes = sum([c['monto'] for c in report_data['Pasivo'].get('Pasivo Corriente', [])])
+                razon_circulante = (activos_circulantes / pasivos_circulantes) if pasivos_circulantes > 0 else 0.0
+                
+                # Razón de endeudamiento
+                razon_endeudamiento = ((pasivos_totales / activos_totales) * 100) if activos_totales > 0 else 0.0
+                
+                # Calcular crecimiento si hay datos del año anterior
+                if report_data_anterior:
+                    ventas_anterior = report_data_anterior['Totales'].get('Ingreso', 0.0)
+                    utilidad_anterior = report_data_anterior['Totales'].get('Utilidad Neta', 0.0)
+                    activos_anterior = report_data_anterior['Totales'].get('Total Activo', 0.0)
                     
-                    # Calcular crecimiento si hay datos del año anterior
-                    if report_data_anterior:
-                        ventas_anterior = report_data_anterior['Totales'].get('Ingreso', 0.0)
-                        utilidad_anterior = report_data_anterior['Totales'].get('Utilidad Neta', 0.0)
-                        activos_anterior = report_data_anterior['Totales'].get('Total Activo', 0.0)
-                        
-                        crecimiento_ventas = ((ventas - ventas_anterior) / ventas_anterior * 100) if ventas_anterior > 0 else 0.0
-                        crecimiento_utilidad = ((utilidad_neta - utilidad_anterior) / abs(utilidad_anterior) * 100) if utilidad_anterior != 0 else 0.0
-                        crecimiento_activos = ((activos_totales - activos_anterior) / activos_anterior * 100) if activos_anterior > 0 else 0.0
-                        
-                        crecimiento = {
-                            'ventas': crecimiento_ventas,
-                            'utilidad': crecimiento_utilidad,
-                            'activos': crecimiento_activos
-                        }
+                    crecimiento_ventas = ((ventas - ventas_anterior) / ventas_anterior * 100) if ventas_anterior > 0 else 0.0
+                    crecimiento_utilidad = ((utilidad_neta - utilidad_anterior) / abs(utilidad_anterior) * 100) if utilidad_anterior != 0 else 0.0
+                    crecimiento_activos = ((activos_totales - activos_anterior) / activos_anterior * 100) if activos_anterior > 0 else 0.0
                     
-                    kpis = {
-                        'ventas': ventas,
-                        'utilidad_neta': utilidad_neta,
-                        'utilidad_operativa': utilidad_operativa,
-                        'activos_totales': activos_totales,
-                        'patrimonio': patrimonio,
-                        'roa': roa,
-                        'roe': roe,
-                        'margen_utilidad_neta': margen_utilidad_neta,
-                        'razon_circulante': razon_circulante,
-                        'razon_endeudamiento': razon_endeudamiento
+                    crecimiento = {
+                        'ventas': crecimiento_ventas,
+                        'utilidad': crecimiento_utilidad,
+                        'activos': crecimiento_activos
                     }
-    
+                
+                kpis = {
+                    'ventas': ventas,
+                    'utilidad_neta': utilidad_neta,
+                    'utilidad_operativa': utilidad_operativa,
+                    'activos_totales': activos_totales,
+                    'patrimonio': patrimonio,
+                    'roa': roa,
+                    'roe': roe,
+                    'margen_utilidad_neta': margen_utilidad_neta,
+                    'razon_circulante': razon_circulante,
+                    'razon_endeudamiento': razon_endeudamiento
+                }
+
     except Exception as e:
         print(f"Error en dashboard_cliente: {e}")
         report_data = None
@@ -120,11 +135,8 @@ def dashboard_cliente():
 @main_bp.route('/chatbot', methods=['POST'])
 @login_required
 def chatbot():
-    """Endpoint para el chatbot con Gemini"""
-    from ..extensions import GEMINI_API_KEY
-    import google.generativeai as genai
-    
-    if not GEMINI_API_KEY:
+    """Endpoint para el chatbot con Gemini. Con "stream": true responde por Server-Sent Events."""
+    if not ia_disponible():
         return jsonify({'error': 'La API de Gemini no está configurada'}), 500
     
     try:
@@ -134,40 +146,42 @@ def chatbot():
         if not mensaje:
             return jsonify({'error': 'Mensaje vacío'}), 400
         
-        # Configurar el modelo - Balance entre potencia, velocidad y costo
-        # gemini-2.5-flash: Rápido, potente y económico
-        # gemini-1.5-flash: Fallback rápido y económico
-        try:
-            model = genai.GenerativeModel('gemini-2.5-flash')
-        except Exception:
-            try:
-                model = genai.GenerativeModel('gemini-1.5-flash')
-            except Exception:
-                # Último fallback
-                model = genai.GenerativeModel('gemini-2.0-flash-lite')
+        # Preguntas de definición: respuesta compartida en caché, sin consumir cuota
+        clave = clave_pregunta_chatbot(mensaje)
+        respuesta = leer_cache_ia(clave) if clave else None
+        if respuesta is not None:
+            registrar_respuesta_chatbot(current_user.id, mensaje, respuesta)
+            if data.get('stream'):
+                return respuesta_sse(iter([respuesta]))
+            return jsonify({'respuesta': respuesta, 'exito': True})
         
-        # Crear prompt contextual
-        prompt = f"""Eres un asistente financiero. Responde de forma PRECISA y CONCISA.
-
-Pregunta del usuario: {mensaje}
-
-REGLAS ESTRICTAS:
-1. Responde DIRECTAMENTE la pregunta, sin introducciones largas
-2. Máximo 80 palabras - sé breve y al grano
-3. Si es sobre un término financiero, da la definición corta (1-2 oraciones)
-4. Si es sobre números/análisis, explica QUÉ SIGNIFICA ese número específico
-5. NO te extiendas, NO repitas información, NO agregues contexto innecesario
-6. Si no sabes algo, di simplemente "No tengo esa información"
-
-Responde SOLO lo que pregunta, de forma directa:"""
+        permitido, espera = consumir_token_chatbot(current_user.id)
+        if not permitido:
+            response = jsonify({
+                'error': f'Has hecho muchas consultas seguidas. Intenta de nuevo en {espera} segundos.',
+                'exito': False
+            })
+            response.headers['Retry-After'] = str(espera)
+            return response, 429
+        
+        # Crear prompt contextual (las definiciones no dependen de la conversación)
+        prompt = construir_prompt_chatbot(mensaje, [] if clave else historial_chatbot(current_user.id))
         
-        response = model.generate_content(prompt)
+        if data.get('stream'):
+            return respuesta_sse(transmitir_respuesta_chatbot(current_user.id, mensaje, prompt, clave))
+        
+        # Los modelos y su orden de respaldo están en utils.MODELOS_IA['chatbot']
+        respuesta, modelo = generar_texto_ia(prompt, 'chatbot')
+        registrar_respuesta_chatbot(current_user.id, mensaje, respuesta, clave, modelo)
         
         return jsonify({
-            'respuesta': response.text,
+            'respuesta': respuesta,
             'exito': True
         })
         
+    except IANoDisponibleError as e:
+        # Circuito abierto o sin cupo: respuesta inmediata en lugar de esperar a Gemini
+        return jsonify({'error': str(e), 'exito': False}), 503
     except Exception as e:
         print(f"Error en chatbot: {e}")
         return jsonify({
@@ -203,13 +217,11 @@ def account_history():
             
         data = {}
         
+        # Get years (registro de períodos en caché)
+        periodos_map = {periodo_id: anio for anio, periodo_id in obtener_periodos().ids.items()}
+        years = sorted(list(periodos_map.values()))
+        
         with engine.connect() as conn:
-            # Get years
-            periodos_query = text("SELECT Anio, PeriodoID FROM Periodo ORDER BY Anio ASC")
-            periodos_result = conn.execute(periodos_query).fetchall()
-            periodos_map = {row[1]: row[0] for row in periodos_result}
-            years = sorted(list(periodos_map.values()))
-            
             # Get account names
             placeholders = ','.join([':id' + str(i) for i in range(len(account_ids))])
             params = {f'id{i}': aid for i, aid in enumerate(account_ids)}
@@ -268,18 +280,16 @@ def gestion_reportes():
     report_data = None
     
     try:
-        with engine.connect() as conn:
-            periodos_query = text("SELECT Anio FROM Periodo ORDER BY Anio DESC")
-            periodos_result = conn.execute(periodos_query).fetchall()
-            periodos = [row[0] for row in periodos_result]
-            
-            if not anio_seleccionado and periodos:
-                anio_seleccionado = periodos[0]
-            
-            if anio_seleccionado:
-                report_data = get_financial_reports(anio_seleccionado)
-                if not report_data:
-                    flash(f'No se encontraron datos de saldos para el año {anio_seleccionado}.', 'error')
+        # Períodos disponibles (registro en caché, sin abrir conexión)
+        periodos = obtener_periodos().anios
+        
+        if not anio_seleccionado and periodos:
+            anio_seleccionado = periodos[0]
+        
+        if anio_seleccionado:
+            report_data = get_financial_reports(anio_seleccionado)
+            if not report_data:
+                flash(f'No se encontraron datos de saldos para el año {anio_seleccionado}.', 'error')
 
     except Exception as e:
         print(f"Error en la ruta /gestion-reportes: {e}")
@@ -3,8 +3,12 @@ from flask_login import UserMixin
 
 class User(UserMixin):
     """Modelo de Usuario para Flask-Login"""
-    def __init__(self, id, nombre, correo, id_rol):
+    def __init__(self, id, nombre, correo, id_rol, rol_nombre=None, es_admin=False, es_super_admin=False):
         self.id = id
         self.nombre = nombre
         self.correo = correo
-        self.id_rol = id_rol
\ No newline at end of file
+        self.id_rol = id_rol
+        # Datos del rol, cargados junto con el usuario para no consultarlos en cada plantilla
+        self.rol_nombre = rol_nombre
+        self.es_admin = es_admin
+        self.es_super_admin = es_super_admin
@@ -1,6 +1,18 @@
 # app/utils.py
+import csv
+import gzip
+import hashlib
+import io
+import itertools
+import json
 import math
 import os
+import re
+import tempfile
+import threading
+import time
+import unicodedata
+import zipfile
 import bcrypt
 try:
     import google.generativeai as genai
@@ -12,20 +24,30 @@ except ImportError:
     class MockResponse:
         text = "Análisis IA no disponible (librería faltante)."
     genai = MockGenAI()
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # Parquet es opcional: sin pyarrow se exporta solo a xlsx, csv y jsonl
+    pa = pq = None
 from markdown import markdown
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal, InvalidOperation
 from sqlalchemy import text
 from functools import wraps
-from flask import flash, redirect, url_for
+from flask import flash, redirect, url_for, g, has_app_context, current_app, Response, stream_with_context
 from flask_login import current_user
-from openpyxl import Workbook
-from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, PatternFill, Alignment, Border, Side, NamedStyle
+from openpyxl.styles.fonts import DEFAULT_FONT
 from openpyxl.utils import get_column_letter
-from datetime import datetime
+from datetime import date, datetime
 
 # Importamos el engine compartido y la clave de API desde extensions
 from .extensions import engine, GEMINI_API_KEY
+from .models import User
 
 # --- Filtro personalizado ---
 # Nota: El decorador @app.template_filter se aplica en __init__.py
@@ -36,93 +58,288 @@ def is_inf(value):
     except (ValueError, TypeError):
         return False
 
+# --- Versiones compartidas entre workers ---
+# Cada worker de gunicorn tiene sus propias cachés en memoria. Para que una escritura
+# hecha en un worker se note en los demás, la versión de cada grupo de datos vive en
+# la tabla VersionDatos ('catalogo': saldos, cuentas y períodos; 'usuarios': roles y
+# estado de los usuarios). Se lee una vez por
+# petición (flask.g); fuera de una petición se reutiliza la última lectura durante
+# VERSIONES_TTL segundos. Si la tabla no está disponible las cachés quedan locales al
+# proceso y las protege su TTL.
+
+VERSIONES_TTL = float(os.getenv('VERSIONES_TTL', '1'))
+VERSIONES_REINTENTO = 60  # segundos sin consultar la tabla después de un error
+
+GRUPOS_VERSION = ('catalogo', 'usuarios')
+
+_versiones = {'leidas_en': None, 'valores': {}, 'reintentar_en': 0.0, 'tabla_lista': False}
+_versiones_lock = threading.Lock()
+
+def _asegurar_tabla_versiones(conn):
+    """Crea VersionDatos y sus filas si no existen (despliegues anteriores a la tabla)."""
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS VersionDatos (
+            Nombre VARCHAR(20) PRIMARY KEY,
+            Version BIGINT NOT NULL DEFAULT 0
+        )
+    """))
+    for nombre in GRUPOS_VERSION:
+        conn.execute(
+            text("INSERT INTO VersionDatos (Nombre, Version) VALUES (:nombre, 0) ON CONFLICT (Nombre) DO NOTHING"),
+            {"nombre": nombre}
+        )
+
+def leer_versiones_compartidas():
+    """
+    Devuelve {grupo: version} leído de VersionDatos, una vez por petición. Si la
+    tabla no se puede leer devuelve {} y las cachés se comportan como locales.
+    """
+    if has_app_context() and 'versiones_datos' in g:
+        return g.versiones_datos
+
+    ahora = time.monotonic()
+    with _versiones_lock:
+        leidas_en = _versiones['leidas_en']
+        if ahora < _versiones['reintentar_en']:
+            return {}
+        if not has_app_context() and leidas_en is not None and ahora - leidas_en <= VERSIONES_TTL:
+            return _versiones['valores']
+        tabla_lista = _versiones['tabla_lista']
+
+    try:
+        with engine.begin() as conn:
+            if not tabla_lista:
+                _asegurar_tabla_versiones(conn)
+            valores = {row[0]: row[1] for row in conn.execute(text("SELECT Nombre, Version FROM VersionDatos")).fetchall()}
+    except Exception as e:
+        print(f"Error al leer las versiones compartidas (cachés solo locales por {VERSIONES_REINTENTO}s): {e}")
+        with _versiones_lock:
+            _versiones['reintentar_en'] = ahora + VERSIONES_REINTENTO
+        return {}
+
+    with _versiones_lock:
+        _versiones.update(leidas_en=ahora, valores=valores, tabla_lista=True)
+    if has_app_context():
+        g.versiones_datos = valores
+    return valores
+
+def incrementar_version_compartida(grupo):
+    """Sube la versión compartida del grupo y devuelve la nueva (None si no se pudo)."""
+    nueva = None
+    with _versiones_lock:
+        tabla_lista = _versiones['tabla_lista']
+    try:
+        with engine.begin() as conn:
+            if not tabla_lista:
+                _asegurar_tabla_versiones(conn)
+            conn.execute(text("UPDATE VersionDatos SET Version = Version + 1 WHERE Nombre = :nombre"), {"nombre": grupo})
+            nueva = conn.execute(text("SELECT Version FROM VersionDatos WHERE Nombre = :nombre"), {"nombre": grupo}).scalar()
+    except Exception as e:
+        print(f"Error al incrementar la versión compartida '{grupo}': {e}")
+
+    # La próxima lectura vuelve a la BD
+    with _versiones_lock:
+        _versiones['leidas_en'] = None
+        if nueva is not None:
+            _versiones['tabla_lista'] = True
+    if has_app_context():
+        g.pop('versiones_datos', None)
+    return nueva
+
 # --- Funciones auxiliares para trabajar con Roles ---
+# Los nombres de rol se comparan normalizados (minúsculas y sin espacios), así
+# 'Super Admin', 'superadmin' y 'SuperAdmin' son el mismo rol. El rol de cada
+# usuario se resuelve con una sola consulta y se guarda en la petición (flask.g)
+# y en memoria del proceso por ROLES_CACHE_TTL segundos.
+
+ROLES_CACHE_TTL = int(os.getenv('ROLES_CACHE_TTL', '60'))
+USUARIOS_CACHE_TTL = int(os.getenv('USUARIOS_CACHE_TTL', '30'))
+
+ROLES_ADMIN = {'administrador', 'admin', 'superadministrador', 'sa', 'superadmin'}
+ROLES_SUPER_ADMIN = {'superadministrador', 'sa', 'superadmin'}
+ROLES_INF = {'inf'}
+
+_cache_roles = {}
+_cache_roles_usuario = {}
+_cache_usuarios = {}
+_cache_roles_lock = threading.Lock()
+
+# Las entradas se guardan como (guardado_en, version, valor): solo valen mientras la
+# versión compartida 'usuarios' no cambie, así un cambio de rol o de estado hecho en
+# otro worker se aplica en la siguiente petición y no al vencer el TTL.
+
+def _version_usuarios():
+    return leer_versiones_compartidas().get('usuarios')
+
+def _entrada_vigente(entrada, version, ttl):
+    return bool(entrada) and entrada[1] == version and time.monotonic() - entrada[0] <= ttl
+
+def normalizar_nombre_rol(nombre_rol):
+    """Normaliza un nombre de rol para compararlo: minúsculas y sin espacios."""
+    return ''.join((nombre_rol or '').lower().split())
+
+def _obtener_roles():
+    """Roles activos {Id_Rol: Nombre}, en caché por ROLES_CACHE_TTL segundos."""
+    version = _version_usuarios()
+    with _cache_roles_lock:
+        entrada = _cache_roles.get('roles')
+    if _entrada_vigente(entrada, version, ROLES_CACHE_TTL):
+        return entrada[2]
 
-def get_rol_id_by_name(nombre_rol):
-    """Obtiene el Id_Rol desde la tabla Roles."""
     try:
         with engine.connect() as conn:
-            query = text("SELECT Id_Rol FROM Roles WHERE Nombre = :nombre AND Estado = 1")
-            result = conn.execute(query, {"nombre": nombre_rol}).fetchone()
-            if result:
-                return result[0]
+            query = text("SELECT Id_Rol, Nombre FROM Roles WHERE Estado = 1")
+            roles = {row[0]: row[1] for row in conn.execute(query).fetchall()}
     except Exception as e:
-        print(f"Error al obtener Id_Rol para {nombre_rol}: {e}")
+        print(f"Error al obtener roles: {e}")
+        return {}
+
+    with _cache_roles_lock:
+        _cache_roles['roles'] = (time.monotonic(), version, roles)
+    return roles
+
+def get_rol_id_by_name(nombre_rol):
+    """Obtiene el Id_Rol desde la tabla Roles."""
+    normalizado = normalizar_nombre_rol(nombre_rol)
+    for id_rol, nombre in _obtener_roles().items():
+        if normalizar_nombre_rol(nombre) == normalizado:
+            return id_rol
     return None
 
 def get_rol_name_by_id(id_rol):
     """Obtiene el nombre del rol desde la tabla Roles."""
-    try:
-        with engine.connect() as conn:
-            query = text("SELECT Nombre FROM Roles WHERE Id_Rol = :id_rol AND Estado = 1")
-            result = conn.execute(query, {"id_rol": id_rol}).fetchone()
-            if result:
-                return result[0]
-    except Exception as e:
-        print(f"Error al obtener nombre de rol para Id_Rol {id_rol}: {e}")
-    return None
+    return _obtener_roles().get(id_rol)
+
+def obtener_rol_usuario(user_id):
+    """
+    Devuelve el rol activo de un usuario activo como dict
+    {'id_rol', 'nombre', 'normalizado'}, o None si no tiene.
+    """
+    clave = str(user_id)
+    memo = None
+    if has_app_context():
+        memo = g.setdefault('roles_usuario', {})
+        if clave in memo:
+            return memo[clave]
+
+    version = _version_usuarios()
+    with _cache_roles_lock:
+        entrada = _cache_roles_usuario.get(clave)
+    if _entrada_vigente(entrada, version, ROLES_CACHE_TTL):
+        rol = entrada[2]
+    else:
+        try:
+            with engine.connect() as conn:
+                query = text("""
+                    SELECT r.Id_Rol, r.Nombre FROM Usuarios u
+                    INNER JOIN Roles r ON u.Id_Rol = r.Id_Rol
+                    WHERE u.Id_Usuario = :user_id AND u.Estado = 1 AND r.Estado = 1
+                """)
+                result = conn.execute(query, {"user_id": user_id}).fetchone()
+        except Exception as e:
+            print(f"Error al obtener el rol del usuario {user_id}: {e}")
+            return None
+
+        rol = None
+        if result:
+            rol = {'id_rol': result[0], 'nombre': result[1], 'normalizado': normalizar_nombre_rol(result[1])}
+        with _cache_roles_lock:
+            _cache_roles_usuario[clave] = (time.monotonic(), version, rol)
+
+    if memo is not None:
+        memo[clave] = rol
+    return rol
+
+def invalidar_rol_usuario(user_id):
+    """
+    Descarta el rol en caché de un usuario en este proceso y sube la versión compartida
+    'usuarios' para que los demás workers lo vuelvan a leer. Se llama al cambiar su rol
+    o su estado.
+    """
+    incrementar_version_compartida('usuarios')
+    clave = str(user_id)
+    with _cache_roles_lock:
+        _cache_roles_usuario.pop(clave, None)
+        _cache_usuarios.pop(clave, None)
+    if has_app_context() and 'roles_usuario' in g:
+        g.roles_usuario.pop(clave, None)
+
+def _es_rol_admin(rol):
+    if not rol:
+        return False
+    if rol['normalizado'] in ROLES_ADMIN:
+        return True
+    # Cualquier otro rol que contenga 'admin' o 'sa' también se considera administrador
+    rol_nombre = rol['nombre'].lower()
+    return 'admin' in rol_nombre or 'sa' in rol_nombre
+
+def _es_rol_super_admin(rol):
+    return bool(rol) and rol['normalizado'] in ROLES_SUPER_ADMIN
+
+def cargar_usuario(user_id):
+    """
+    Carga un usuario activo junto con su rol (nombre y banderas de admin) en una sola
+    consulta. Se usa desde el user_loader y se guarda en memoria por USUARIOS_CACHE_TTL
+    segundos, así las plantillas no consultan la BD para decidir la navegación. La
+    entrada se descarta antes si cambia la versión compartida 'usuarios' (un usuario
+    desactivado en otro worker deja de cargarse en la siguiente petición).
+    """
+    clave = str(user_id)
+    version = _version_usuarios()
+    with _cache_roles_lock:
+        entrada = _cache_usuarios.get(clave)
+    if _entrada_vigente(entrada, version, USUARIOS_CACHE_TTL):
+        return entrada[2]
 
-def is_user_role(user_id, nombre_rol):
-    """Verifica si un usuario tiene un rol específico."""
     try:
         with engine.connect() as conn:
             query = text("""
-                SELECT COUNT(*) FROM Usuarios u
-                INNER JOIN Roles r ON u.Id_Rol = r.Id_Rol
-                WHERE u.Id_Usuario = :user_id AND r.Nombre = :nombre_rol AND u.Estado = 1 AND r.Estado = 1
+                SELECT u.Id_Usuario, u.Nombre, u.Correo, u.Id_Rol, r.Nombre
+                FROM Usuarios u
+                LEFT JOIN Roles r ON u.Id_Rol = r.Id_Rol AND r.Estado = 1
+                WHERE u.Id_Usuario = :id AND u.Estado = 1
             """)
-            result = conn.execute(query, {"user_id": user_id, "nombre_rol": nombre_rol}).fetchone()
-            return result[0] > 0 if result else False
+            result = conn.execute(query, {"id": int(user_id)}).fetchone()
     except Exception as e:
-        print(f"Error al verificar rol {nombre_rol} para usuario {user_id}: {e}")
-    return False
+        print(f"Error en user_loader: {e}")
+        return None
+
+    if not result:
+        return None
+
+    rol = None
+    if result[4]:
+        rol = {'id_rol': result[3], 'nombre': result[4], 'normalizado': normalizar_nombre_rol(result[4])}
+    usuario = User(
+        id=result[0], nombre=result[1], correo=result[2], id_rol=result[3],
+        rol_nombre=rol['nombre'] if rol else None,
+        es_admin=_es_rol_admin(rol),
+        es_super_admin=_es_rol_super_admin(rol)
+    )
+    ahora = time.monotonic()
+    with _cache_roles_lock:
+        _cache_usuarios[clave] = (ahora, version, usuario)
+        # El rol ya se conoce: is_admin(current_user.id) no necesita otra consulta
+        _cache_roles_usuario[clave] = (ahora, version, rol)
+    return usuario
+
+def is_user_role(user_id, nombre_rol):
+    """Verifica si un usuario tiene un rol específico."""
+    rol = obtener_rol_usuario(user_id)
+    return bool(rol) and rol['normalizado'] == normalizar_nombre_rol(nombre_rol)
 
 def is_admin(user_id):
     """Verifica si un usuario es administrador."""
-    admin_roles = [
-        'Administrador', 'administrador', 'Admin', 'admin',
-        'Super Administrador', 'super administrador', 'SuperAdministrador', 'superadministrador',
-        'SA', 'sa', 'Super Admin', 'super admin', 'SuperAdmin', 'superadmin'
-    ]
-    for admin_name in admin_roles:
-        if is_user_role(user_id, admin_name):
-            return True
-    
-    try:
-        with engine.connect() as conn:
-            query = text("""
-                SELECT r.Nombre FROM Usuarios u
-                INNER JOIN Roles r ON u.Id_Rol = r.Id_Rol
-                WHERE u.Id_Usuario = :user_id AND u.Estado = 1 AND r.Estado = 1
-            """)
-            result = conn.execute(query, {"user_id": user_id}).fetchone()
-            if result:
-                rol_nombre = result[0].lower()
-                if 'admin' in rol_nombre or 'sa' in rol_nombre:
-                    return True
-    except Exception as e:
-        print(f"Error al verificar si es admin para usuario {user_id}: {e}")
-    
-    return False
+    return _es_rol_admin(obtener_rol_usuario(user_id))
 
 def is_super_admin(user_id):
     """Verifica si un usuario es Super Administrador (SA)."""
-    super_admin_names = [
-        'Super Administrador', 'super administrador', 'SuperAdministrador', 'superadministrador',
-        'SA', 'sa', 'Super Admin', 'super admin', 'SuperAdmin', 'superadmin'
-    ]
-    for sa_name in super_admin_names:
-        if is_user_role(user_id, sa_name):
-            return True
-    return False
+    return _es_rol_super_admin(obtener_rol_usuario(user_id))
 
 def is_user_inf(user_id):
     """Verifica si un usuario es INF."""
-    inf_roles = ['INF', 'inf', 'Inf']
-    for inf_name in inf_roles:
-        if is_user_role(user_id, inf_name):
-            return True
-    return False
+    rol = obtener_rol_usuario(user_id)
+    return bool(rol) and rol['normalizado'] in ROLES_INF
 
 # --- Decoradores personalizados ---
 
@@ -141,138 +358,564 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# --- Caché de reportes financieros ---
+# Los reportes se guardan por año como instantáneas de solo lectura. La versión del
+# catálogo sube cada vez que el admin escribe saldos o cuentas, y con ello se descarta
+# todo lo calculado antes. La escritura también sube la versión compartida 'catalogo',
+# así los demás workers descartan sus cachés en la siguiente petición; el TTL es el
+# respaldo si la versión compartida no está disponible.
+
+REPORTES_CACHE_TTL = int(os.getenv('REPORTES_CACHE_TTL', '300'))  # 0 = sin expiración
+
+_cache_reportes = {}
+_cache_reportes_lock = threading.Lock()
+_version_catalogo = 0
+_version_catalogo_compartida = None  # última versión compartida vista por este proceso
+
+class ReporteInmutable(dict):
+    """Diccionario de solo lectura usado en las instantáneas de reportes en caché.
+
+    Conserva el comportamiento de los defaultdict originales: una llave inexistente
+    devuelve el valor por defecto (0.0 en 'Totales', tupla vacía en las secciones)
+    sin modificar el diccionario.
+    """
+    def __init__(self, datos=(), default=None):
+        super().__init__(datos)
+        self._default = default
+
+    def __missing__(self, key):
+        return self._default
+
+    def _solo_lectura(self, *args, **kwargs):
+        raise TypeError('El reporte en caché es de solo lectura. Usa descongelar_reporte() para obtener una copia editable.')
+
+    __setitem__ = __delitem__ = __ior__ = _solo_lectura
+    clear = pop = popitem = setdefault = update = _solo_lectura
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self), self._default))
+
+def _congelar(valor, default=None):
+    """Convierte recursivamente dicts y listas en ReporteInmutable y tuplas."""
+    if isinstance(valor, dict):
+        if isinstance(valor, defaultdict) and valor.default_factory is not None:
+            default = valor.default_factory()
+            # Las listas por defecto se exponen como tuplas vacías
+            if isinstance(default, list):
+                default = ()
+        return ReporteInmutable({k: _congelar(v) for k, v in valor.items()}, default)
+    if isinstance(valor, (list, tuple)):
+        return tuple(_congelar(v) for v in valor)
+    return valor
+
+def descongelar_reporte(valor):
+    """Devuelve una copia editable (dicts, defaultdicts y listas) de un reporte en caché."""
+    if isinstance(valor, dict):
+        default = getattr(valor, '_default', None)
+        copia = {k: descongelar_reporte(v) for k, v in valor.items()}
+        if default == ():
+            return defaultdict(list, copia)
+        if isinstance(default, float):
+            return defaultdict(float, copia)
+        return copia
+    if isinstance(valor, (list, tuple)):
+        return [descongelar_reporte(v) for v in valor]
+    return valor
+
+def obtener_version_catalogo():
+    """
+    Versión actual de los datos financieros (catálogo y saldos) en este proceso. Si
+    otro worker escribió (la versión compartida cambió) se descartan las cachés locales.
+    """
+    global _version_catalogo_compartida
+    compartida = leer_versiones_compartidas().get('catalogo')
+    with _cache_reportes_lock:
+        if compartida is not None and compartida != _version_catalogo_compartida:
+            if _version_catalogo_compartida is not None:
+                _descartar_caches_catalogo()
+            _version_catalogo_compartida = compartida
+        return _version_catalogo
+
+def _descartar_caches_catalogo():
+    # Se llama con _cache_reportes_lock tomado
+    global _version_catalogo, _cache_exportaciones_bytes
+    _version_catalogo += 1
+    _cache_reportes.clear()
+    _cache_catalogo.clear()
+    _cache_periodos.clear()
+    _cache_exportaciones.clear()
+    _cache_exportaciones_bytes = 0
+
+def invalidar_cache_reportes():
+    """
+    Descarta los reportes en caché de este proceso y sube la versión compartida para
+    que los demás workers hagan lo mismo. Se llama después de escribir saldos o cuentas.
+    """
+    global _version_catalogo_compartida
+    nueva = incrementar_version_compartida('catalogo')
+    with _cache_reportes_lock:
+        _descartar_caches_catalogo()
+        if nueva is not None:
+            _version_catalogo_compartida = nueva
+
+def _cache_vencida(entrada):
+    """True si la entrada ({'guardado_en', ...}) superó REPORTES_CACHE_TTL."""
+    return bool(REPORTES_CACHE_TTL) and time.monotonic() - entrada.get('guardado_en', 0) > REPORTES_CACHE_TTL
+
+def _leer_cache_reportes(anio, version):
+    with _cache_reportes_lock:
+        entrada = _cache_reportes.get(anio)
+    if not entrada:
+        return None
+    version_entrada, guardado_en, reporte = entrada
+    if version_entrada != version:
+        return None
+    if REPORTES_CACHE_TTL and time.monotonic() - guardado_en > REPORTES_CACHE_TTL:
+        return None
+    return reporte
+
+def _guardar_cache_reportes(anio, version, reporte):
+    with _cache_reportes_lock:
+        # Si hubo una invalidación mientras se consultaba la BD, el reporte ya es viejo
+        if version == _version_catalogo:
+            _cache_reportes[anio] = (version, time.monotonic(), reporte)
+
+# --- Clasificación de cuentas ---
+# Cada cuenta del catálogo se clasifica una sola vez (por versión del catálogo) en un
+# conjunto de etiquetas semánticas. Los análisis consultan las etiquetas en lugar de
+# buscar palabras clave en el nombre cada vez.
+
+ETIQUETA_EFECTIVO = 'efectivo'
+ETIQUETA_POR_COBRAR = 'por_cobrar'
+ETIQUETA_CLIENTES = 'clientes'
+ETIQUETA_INVENTARIO = 'inventario'
+ETIQUETA_ACTIVO_FIJO = 'activo_fijo'
+ETIQUETA_ACTIVO_OPERATIVO = 'activo_operativo'
+ETIQUETA_DEPRECIACION = 'depreciacion'
+ETIQUETA_AMORTIZACION = 'amortizacion'
+ETIQUETA_POR_PAGAR = 'por_pagar'
+ETIQUETA_DEUDA_FINANCIERA = 'deuda_financiera'
+ETIQUETA_PASIVO_OPERATIVO = 'pasivo_operativo'
+ETIQUETA_UTILIDADES_RETENIDAS = 'utilidades_retenidas'
+ETIQUETA_GASTO_FINANCIERO = 'gasto_financiero'
+# Cuentas por cobrar en sentido estricto ('por cobrar'); ETIQUETA_POR_COBRAR es cualquier cobro
+ETIQUETA_CUENTAS_POR_COBRAR = 'cuentas_por_cobrar'
+# Grupo Propiedad, Planta y Equipo en bruto (incluye sus contra-cuentas); ETIQUETA_ACTIVO_FIJO es el neto tangible
+ETIQUETA_PROPIEDAD_PLANTA_EQUIPO = 'propiedad_planta_equipo'
+
+_PALABRAS_EFECTIVO = ['caja', 'banco', 'efectivo', 'cash', 'disponible']
+_PALABRAS_ACTIVO_FIJO = ['maquinaria', 'equipo', 'edificio', 'terreno', 'vehiculo',
+                         'rodante', 'mobiliario', 'construccion', 'propiedad']
+_PALABRAS_ACTIVO_OPERATIVO = ['cliente', 'cobrar', 'inventario', 'almacen', 'anticipo',
+                              'deposito', 'garantia', 'otro activo', 'impuesto', 'renta', 'iva', 'acreditable',
+                              'obra', 'trabajo', 'proceso', 'pago anticipado', 'pagos anticipados']
+_PALABRAS_DEUDA_FINANCIERA = ['prestamo', 'préstamo', 'credito', 'crédito', 'bancari', 'financier', 'hipoteca']
+_PALABRAS_PASIVO_OPERATIVO = ['proveedor', 'acreedor', 'por pagar', 'impuesto', 'retencion',
+                              'iva', 'acumulado', 'laboral', 'sueldo', 'salario']
+_PALABRAS_PROPIEDAD_PLANTA_EQUIPO = ['propiedad', 'planta', 'equipo']
+_PALABRAS_UTILIDADES_RETENIDAS = ['utilidad', 'resultado', 'ganancia', 'perdida', 'ejercicio', 'acumulada']
+
+# Reglas directas: la etiqueta se asigna si el nombre contiene alguna de las palabras.
+# Las etiquetas derivadas (activo fijo, capital de trabajo) se calculan después en
+# clasificar_cuenta a partir de estas.
+_REGLAS_ETIQUETAS = (
+    (ETIQUETA_EFECTIVO, _PALABRAS_EFECTIVO),
+    (ETIQUETA_POR_COBRAR, ['cobrar']),
+    (ETIQUETA_CUENTAS_POR_COBRAR, ['por cobrar']),
+    (ETIQUETA_CLIENTES, ['cliente']),
+    (ETIQUETA_INVENTARIO, ['inventario']),
+    (ETIQUETA_PROPIEDAD_PLANTA_EQUIPO, _PALABRAS_PROPIEDAD_PLANTA_EQUIPO),
+    (ETIQUETA_DEPRECIACION, ['depreciaci', 'deprecioaci']),
+    (ETIQUETA_AMORTIZACION, ['amortizaci']),
+    (ETIQUETA_POR_PAGAR, ['pagar']),
+    (ETIQUETA_GASTO_FINANCIERO, ['financiero', 'interes']),
+    (ETIQUETA_UTILIDADES_RETENIDAS, _PALABRAS_UTILIDADES_RETENIDAS),
+)
+
+_cache_catalogo = {}
+
+def clasificar_cuenta(nombre):
+    """Devuelve el conjunto (frozenset) de etiquetas de una cuenta según su nombre.
+
+    Las etiquetas no dependen del tipo de cuenta: cada análisis sigue recorriendo
+    la sección que le corresponde (Activo, Pasivo, Gasto...) y filtra por etiqueta.
+    """
+    n = (nombre or '').lower()
+    if not n:
+        return frozenset()
+    etiquetas = {etiqueta for etiqueta, palabras in _REGLAS_ETIQUETAS if any(x in n for x in palabras)}
+
+    # Activo fijo tangible: sin depreciación/amortización ni obras en proceso
+    es_contra_activo = ETIQUETA_DEPRECIACION in etiquetas or ETIQUETA_AMORTIZACION in etiquetas
+    es_obra_en_proceso = 'proceso' in n or 'obra' in n or 'trabajo' in n
+    if not es_contra_activo and not es_obra_en_proceso and any(x in n for x in _PALABRAS_ACTIVO_FIJO):
+        etiquetas.add(ETIQUETA_ACTIVO_FIJO)
+
+    # Capital de trabajo: se excluye lo que ya es efectivo, activo fijo o deuda financiera
+    if (ETIQUETA_EFECTIVO not in etiquetas and ETIQUETA_ACTIVO_FIJO not in etiquetas
+            and any(x in n for x in _PALABRAS_ACTIVO_OPERATIVO)):
+        etiquetas.add(ETIQUETA_ACTIVO_OPERATIVO)
+    if any(x in n for x in _PALABRAS_DEUDA_FINANCIERA):
+        etiquetas.add(ETIQUETA_DEUDA_FINANCIERA)
+    elif any(x in n for x in _PALABRAS_PASIVO_OPERATIVO):
+        etiquetas.add(ETIQUETA_PASIVO_OPERATIVO)
+
+    return frozenset(etiquetas)
+
+def obtener_catalogo_cuentas():
+    """
+    Devuelve el catálogo clasificado {CuentaID: {'nombre', 'tipo', 'subtipo', 'etiquetas'}}.
+
+    Se carga con una sola consulta y se guarda en memoria hasta la próxima
+    invalidación (local o de otro worker, ver obtener_version_catalogo) o hasta que
+    vence REPORTES_CACHE_TTL. Si la consulta falla devuelve {} y no guarda nada,
+    para reintentar en la siguiente llamada.
+    """
+    version = obtener_version_catalogo()
+    with _cache_reportes_lock:
+        if _cache_catalogo.get('version') == version and not _cache_vencida(_cache_catalogo):
+            return _cache_catalogo['datos']
+
+    try:
+        with engine.connect() as conn:
+            query = text("SELECT CuentaID, NombreCuenta, TipoCuenta, SubTipoCuenta FROM CatalogoCuentas")
+            resultados = conn.execute(query).fetchall()
+    except Exception as e:
+        print(f"Error al obtener el catálogo de cuentas: {e}")
+        return {}
+
+    catalogo = {
+        row[0]: {
+            'nombre': row[1],
+            'tipo': row[2],
+            'subtipo': row[3],
+            'etiquetas': clasificar_cuenta(row[1])
+        }
+        for row in resultados
+    }
+    with _cache_reportes_lock:
+        if version == _version_catalogo:
+            _cache_catalogo['version'] = version
+            _cache_catalogo['guardado_en'] = time.monotonic()
+            _cache_catalogo['datos'] = catalogo
+    return catalogo
+
+def etiquetas_cuenta(cuenta, catalogo=None):
+    """
+    Etiquetas de una cuenta de un reporte ({'id', 'nombre', ...}), tomadas del catálogo
+    clasificado. En ciclos conviene pasar el catálogo ya obtenido.
+    """
+    if catalogo is None:
+        catalogo = obtener_catalogo_cuentas()
+    entrada = catalogo.get(cuenta.get('id'))
+    if entrada is not None:
+        return entrada['etiquetas']
+    return clasificar_cuenta(cuenta.get('nombre'))
+
+def sumar_por_etiqueta(secciones, etiqueta):
+    """Suma los montos de las cuentas (de una sección {subtipo: [cuentas]}) que tienen la etiqueta."""
+    catalogo = obtener_catalogo_cuentas()
+    total = 0.0
+    for cuentas in secciones.values():
+        for cuenta in cuentas:
+            if etiqueta in etiquetas_cuenta(cuenta, catalogo):
+                total += cuenta['monto']
+    return total
+
+# --- Registro de períodos ---
+# Lista de años con su PeriodoID, compartida por todas las rutas. Se invalida junto
+# con los reportes (invalidar_cache_reportes), p. ej. cuando ingresar_saldos crea un período.
+
+_cache_periodos = {}
+
+class RegistroPeriodos:
+    """Períodos disponibles: años (de mayor a menor), mapa año -> PeriodoID y navegación."""
+    def __init__(self, filas=()):
+        self.ids = {anio: periodo_id for anio, periodo_id in filas}
+        self.anios = sorted(self.ids, reverse=True)
+
+    def __contains__(self, anio):
+        return anio in self.ids
+
+    def periodo_id(self, anio):
+        return self.ids.get(anio)
+
+    def anterior(self, anio):
+        """Año registrado inmediatamente anterior a `anio` (None si no hay)."""
+        anteriores = [a for a in self.anios if a < anio]
+        return anteriores[0] if anteriores else None
+
+    def siguiente(self, anio):
+        """Año registrado inmediatamente posterior a `anio` (None si no hay)."""
+        siguientes = [a for a in self.anios if a > anio]
+        return siguientes[-1] if siguientes else None
+
+def obtener_periodos():
+    """
+    Devuelve el RegistroPeriodos en caché. Solo consulta la BD la primera vez después de
+    cada invalidación (local o de otro worker, ver obtener_version_catalogo) o cuando
+    vence REPORTES_CACHE_TTL; si la consulta falla devuelve un registro vacío sin guardarlo.
+    """
+    version = obtener_version_catalogo()
+    with _cache_reportes_lock:
+        if _cache_periodos.get('version') == version and not _cache_vencida(_cache_periodos):
+            return _cache_periodos['registro']
+
+    try:
+        with engine.connect() as conn:
+            query = text("SELECT Anio, PeriodoID FROM Periodo")
+            registro = RegistroPeriodos(conn.execute(query).fetchall())
+    except Exception as e:
+        print(f"Error al obtener los períodos: {e}")
+        return RegistroPeriodos()
+
+    with _cache_reportes_lock:
+        if version == _version_catalogo:
+            _cache_periodos['version'] = version
+            _cache_periodos['guardado_en'] = time.monotonic()
+            _cache_periodos['registro'] = registro
+    return registro
+
 # --- Funciones para obtener reportes financieros ---
 
 def get_financial_reports(anio_seleccionado):
     """
     Obtiene los datos de Balance General y Estado de Resultados para un año específico,
     con totales por subtipo.
+
+    El resultado sale de la caché de reportes cuando existe y es una instantánea de
+    solo lectura; para modificarlo usar descongelar_reporte().
+    """
+    return get_financial_reports_many([anio_seleccionado]).get(anio_seleccionado)
+
+def get_financial_reports_many(anios):
+    """
+    Obtiene los reportes de varios años a la vez. Los años que no están en caché se
+    cargan con una sola consulta (Periodo.Anio IN (...)).
+
+    Dentro de una petición, cada (año, versión del catálogo) se materializa una sola
+    vez: las siguientes llamadas lo toman del memo guardado en flask.g.
+
+    Returns:
+        dict: {anio: reporte} con la misma estructura que get_financial_reports;
+              None para los años sin período o si hubo un error.
+    """
+    version = obtener_version_catalogo()
+    memo = _memo_reportes()
+    reportes = {}
+    faltantes = []
+    for anio in anios:
+        if anio in reportes or anio in faltantes:
+            continue
+        if memo is not None and (anio, version) in memo:
+            reportes[anio] = memo[(anio, version)]
+            continue
+        report_data = _leer_cache_reportes(anio, version)
+        if report_data is not None:
+            reportes[anio] = report_data
+            _registrar_en_memo(memo, anio, version, report_data)
+        else:
+            faltantes.append(anio)
+
+    if faltantes:
+        cargados = _cargar_reportes_financieros(faltantes)
+        for anio in faltantes:
+            report_data = cargados.get(anio)
+            if report_data is not None:
+                report_data = _congelar(report_data)
+                _guardar_cache_reportes(anio, version, report_data)
+            reportes[anio] = report_data
+            _registrar_en_memo(memo, anio, version, report_data)
+
+    return reportes
+
+def _memo_reportes():
+    """Memo de reportes de la petición actual (None fuera de un contexto de Flask)."""
+    if not has_app_context():
+        return None
+    if 'memo_reportes' not in g:
+        g.memo_reportes = {}
+        g.reportes_materializados = 0
+    return g.memo_reportes
+
+def _registrar_en_memo(memo, anio, version, report_data):
+    if memo is None:
+        return
+    memo[(anio, version)] = report_data
+    g.reportes_materializados += 1
+
+def reportes_materializados():
+    """Cantidad de reportes (año, versión) materializados en la petición actual."""
+    if not has_app_context():
+        return 0
+    return g.get('reportes_materializados', 0)
+
+def calcular_porcentajes_verticales(report_data):
     """
+    Devuelve una copia editable del reporte con el porcentaje vertical de cada cuenta
+    ('percentage'): Balance General sobre Total Activo y Estado de Resultados sobre Ingresos.
+    """
+    report_data = descongelar_reporte(report_data)
+    base_bg = report_data['Totales'].get('Total Activo', 0)
+    base_er = report_data['Totales'].get('Ingreso', 0)
+
+    # Para Balance General (base = Total Activo)
+    for tipo in ['Activo', 'Pasivo', 'Patrimonio']:
+        for subtipo, cuentas in report_data[tipo].items():
+            for cuenta in cuentas:
+                if base_bg > 0:
+                    cuenta['percentage'] = (cuenta['monto'] / base_bg) * 100
+                else:
+                    cuenta['percentage'] = 0.0
+
+    # Para Estado de Resultados (base = Ingresos)
+    for tipo in ['Ingreso', 'Costo', 'Gasto']:
+        for subtipo, cuentas in report_data[tipo].items():
+            for cuenta in cuentas:
+                if base_er > 0:
+                    cuenta['percentage'] = (cuenta['monto'] / base_er) * 100
+                else:
+                    cuenta['percentage'] = 0.0
+
+    return report_data
+
+def _cargar_reportes_financieros(anios):
+    """Consulta la BD y arma los reportes (editables) de varios años en una sola consulta."""
     try:
         with engine.connect() as conn:
-            query = text("""
+            placeholders = ','.join([':anio' + str(i) for i in range(len(anios))])
+            params = {f'anio{i}': anio for i, anio in enumerate(anios)}
+            
+            query = text(f"""
                 SELECT
                     c.CuentaID AS cuenta_id,
                     c.NombreCuenta AS cuenta_nombre,
                     c.TipoCuenta AS tipo,
                     c.SubTipoCuenta AS subtipo,
-                    COALESCE(s.Monto, 0) AS monto_actual
+                    COALESCE(s.Monto, 0) AS monto_actual,
+                    p.Anio AS anio
                 FROM
                     CatalogoCuentas c
                 INNER JOIN
-                    Periodo p ON p.Anio = :anio
+                    Periodo p ON p.Anio IN ({placeholders})
                 LEFT JOIN
                     SaldoCuenta s ON s.CuentaID = c.CuentaID AND s.PeriodoID = p.PeriodoID
                 ORDER BY
-                    c.TipoCuenta, c.SubTipoCuenta, c.NombreCuenta
+                    p.Anio, c.TipoCuenta, c.SubTipoCuenta, c.NombreCuenta
             """)
             
-            resultados = conn.execute(query, {"anio": anio_seleccionado}).fetchall()
-            
-            if not resultados:
-                return None 
-
-            # Estructura de datos
-            report_data = {
-                'Activo': defaultdict(list),
-                'Pasivo': defaultdict(list),
-                'Patrimonio': defaultdict(list),
-                'Ingreso': defaultdict(list),
-                'Costo': defaultdict(list),
-                'Gasto': defaultdict(list),
-                'Totales': defaultdict(float)
-            }
-
-            for i, row in enumerate(resultados):
-                try:
-                    cuenta = {'id': row[0], 'nombre': row[1], 'monto': 0.0} 
-                    tipo = str(row[2]).strip() if row[2] else None
-                    subtipo = str(row[3]).strip() if row[3] else None
-                    monto_actual = float(row[4]) if row[4] is not None else 0.0
-                    
-                    # Debug print to see what we are getting
-                    # print(f"DEBUG: Cuenta: {row[1]}, Tipo: '{tipo}', Subtipo: '{subtipo}', Monto: {monto_actual}")
-
-                    # Validar que el tipo existe en report_data
-                    if not tipo:
-                        print(f"Tipo nulo para cuenta: {row[1]}")
-                        continue
-                        
-                    # Normalize type to match keys if needed (simple capitalization)
-                    # This handles cases like 'pasivo' vs 'Pasivo'
-                    tipo_normalized = tipo.title()
-                    
-                    if tipo_normalized not in report_data:
-                        # Try to map common variations just in case
-                        if 'Pasivo' in tipo_normalized:
-                            tipo_normalized = 'Pasivo'
-                        elif 'Patrimonio' in tipo_normalized or 'Capital' in tipo_normalized:
-                            tipo_normalized = 'Patrimonio'
-                        elif 'Activo' in tipo_normalized:
-                            tipo_normalized = 'Activo'
-                        elif 'Ingreso' in tipo_normalized:
-                            tipo_normalized = 'Ingreso'
-                        elif 'Costo' in tipo_normalized:
-                            tipo_normalized = 'Costo'
-                        elif 'Gasto' in tipo_normalized:
-                            tipo_normalized = 'Gasto'
-                    
-                    if tipo_normalized not in report_data:
-                        print(f"Tipo '{tipo}' (normalizado: '{tipo_normalized}') no válido o no encontrado en report_data. Saltando cuenta: {row[1]}")
-                        continue
-                    
-                    # Use the normalized type
-                    tipo = tipo_normalized
-                    
-                    # Si la cuenta contiene "depreciación" o "deprecioacion" en el nombre, hacer el monto negativo
-                    nombre_cuenta_lower = str(row[1]).lower() if row[1] else ''
-                    if 'depreciaci' in nombre_cuenta_lower or 'deprecioaci' in nombre_cuenta_lower:
-                        # Si el monto ya es negativo, mantenerlo negativo; si es positivo, hacerlo negativo
-                        if monto_actual > 0:
-                            monto_actual = -abs(monto_actual)
-                        elif monto_actual == 0:
-                            monto_actual = 0.0
-                        # Si ya es negativo, mantenerlo así
-                    
-                    cuenta['monto'] = monto_actual
-                    if subtipo:
-                        report_data[tipo][subtipo].append(cuenta)
-                    report_data['Totales'][tipo] += monto_actual
-                    if subtipo:
-                        report_data['Totales'][subtipo] += monto_actual
-                except Exception as e:
-                    print(f"Error procesando fila {i} en get_financial_reports: {e}")
-                    print(f"Datos de la fila: {row}")
-                    import traceback
-                    traceback.print_exc()
-                    continue
-
-            # Calcular Totales Principales
-            report_data['Totales']['Total Activo'] = report_data['Totales']['Activo']
-            report_data['Totales']['Total Pasivo'] = report_data['Totales']['Pasivo']
-            report_data['Totales']['Total Patrimonio'] = report_data['Totales']['Patrimonio']
-            report_data['Totales']['Total Pasivo y Patrimonio'] = report_data['Totales']['Pasivo'] + report_data['Totales']['Patrimonio']
-            
-            # Calcular Utilidades
-            total_ingresos = report_data['Totales']['Ingreso']
-            total_costos = report_data['Totales']['Costo']
-            utilidad_bruta = total_ingresos - total_costos
-            
-            report_data['Totales']['Utilidad Bruta'] = utilidad_bruta
+            resultados = conn.execute(query, params).fetchall()
             
-            # Calcular Utilidad Operativa (Utilidad Bruta - Gastos Operativos)
-            gastos_operativos = report_data['Totales'].get('Gasto Operativo', 0.0)
-            utilidad_operativa = utilidad_bruta - gastos_operativos
-            report_data['Totales']['Utilidad Operativa'] = utilidad_operativa
-            
-            utilidad_neta = utilidad_bruta - report_data['Totales']['Gasto']
-            report_data['Totales']['Utilidad Neta'] = utilidad_neta
-            
-            return report_data
+        # Agrupar las filas por año y armar un reporte por cada uno
+        filas_por_anio = defaultdict(list)
+        for row in resultados:
+            filas_por_anio[row[5]].append(row)
+        
+        return {anio: _armar_reporte(filas) for anio, filas in filas_por_anio.items()}
             
     except Exception as e:
         print(f"Error EXCEPCIÓN en get_financial_reports: {e}")
-        return None 
+        return {}
+
+def _armar_reporte(resultados):
+    """Arma la estructura del reporte a partir de las filas (cuenta, nombre, tipo, subtipo, monto) de un año."""
+    # Estructura de datos
+    report_data = {
+        'Activo': defaultdict(list),
+        'Pasivo': defaultdict(list),
+        'Patrimonio': defaultdict(list),
+        'Ingreso': defaultdict(list),
+        'Costo': defaultdict(list),
+        'Gasto': defaultdict(list),
+        'Totales': defaultdict(float)
+    }
+    catalogo = obtener_catalogo_cuentas()
+
+    for i, row in enumerate(resultados):
+        try:
+            cuenta = {'id': row[0], 'nombre': row[1], 'monto': 0.0} 
+            tipo = str(row[2]).strip() if row[2] else None
+            subtipo = str(row[3]).strip() if row[3] else None
+            monto_actual = float(row[4]) if row[4] is not None else 0.0
+
+            # Debug print to see what we are getting
+            # print(f"DEBUG: Cuenta: {row[1]}, Tipo: '{tipo}', Subtipo: '{subtipo}', Monto: {monto_actual}")
+
+            # Validar que el tipo existe en report_data
+            if not tipo:
+                print(f"Tipo nulo para cuenta: {row[1]}")
+                continue
+
+            # Normalize type to match keys if needed (simple capitalization)
+            # This handles cases like 'pasivo' vs 'Pasivo'
+            tipo_normalized = tipo.title()
+
+            if tipo_normalized not in report_data:
+                # Try to map common variations just in case
+                if 'Pasivo' in tipo_normalized:
+                    tipo_normalized = 'Pasivo'
+                elif 'Patrimonio' in tipo_normalized or 'Capital' in tipo_normalized:
+                    tipo_normalized = 'Patrimonio'
+                elif 'Activo' in tipo_normalized:
+                    tipo_normalized = 'Activo'
+                elif 'Ingreso' in tipo_normalized:
+                    tipo_normalized = 'Ingreso'
+                elif 'Costo' in tipo_normalized:
+                    tipo_normalized = 'Costo'
+                elif 'Gasto' in tipo_normalized:
+                    tipo_normalized = 'Gasto'
+
+            if tipo_normalized not in report_data:
+                print(f"Tipo '{tipo}' (normalizado: '{tipo_normalized}') no válido o no encontrado en report_data. Saltando cuenta: {row[1]}")
+                continue
+
+            # Use the normalized type
+            tipo = tipo_normalized
+
+            # Si la cuenta contiene "depreciación" o "deprecioacion" en el nombre, hacer el monto negativo
+            if ETIQUETA_DEPRECIACION in etiquetas_cuenta(cuenta, catalogo):
+                # Si el monto ya es negativo, mantenerlo negativo; si es positivo, hacerlo negativo
+                if monto_actual > 0:
+                    monto_actual = -abs(monto_actual)
+                elif monto_actual == 0:
+                    monto_actual = 0.0
+                # Si ya es negativo, mantenerlo así
+
+            cuenta['monto'] = monto_actual
+            if subtipo:
+                report_data[tipo][subtipo].append(cuenta)
+            report_data['Totales'][tipo] += monto_actual
+            if subtipo:
+                report_data['Totales'][subtipo] += monto_actual
+        except Exception as e:
+            print(f"Error procesando fila {i} en get_financial_reports: {e}")
+            print(f"Datos de la fila: {row}")
+            import traceback
+            traceback.print_exc()
+            continue
+
+    # Calcular Totales Principales
+    report_data['Totales']['Total Activo'] = report_data['Totales']['Activo']
+    report_data['Totales']['Total Pasivo'] = report_data['Totales']['Pasivo']
+    report_data['Totales']['Total Patrimonio'] = report_data['Totales']['Patrimonio']
+    report_data['Totales']['Total Pasivo y Patrimonio'] = report_data['Totales']['Pasivo'] + report_data['Totales']['Patrimonio']
+
+    # Calcular Utilidades
+    total_ingresos = report_data['Totales']['Ingreso']
+    total_costos = report_data['Totales']['Costo']
+    utilidad_bruta = total_ingresos - total_costos
+
+    report_data['Totales']['Utilidad Bruta'] = utilidad_bruta
+
+    # Calcular Utilidad Operativa (Utilidad Bruta - Gastos Operativos)
+    gastos_operativos = report_data['Totales'].get('Gasto Operativo', 0.0)
+    utilidad_operativa = utilidad_bruta - gastos_operativos
+    report_data['Totales']['Utilidad Operativa'] = utilidad_operativa
+
+    utilidad_neta = utilidad_bruta - report_data['Totales']['Gasto']
+    report_data['Totales']['Utilidad Neta'] = utilidad_neta
+
+    return report_data
 
 def calcular_analisis_horizontal(report_data_base, report_data_analisis):
     """Calcula el análisis horizontal comparando dos períodos."""
@@ -436,14 +1079,15 @@ def calcular_ratios_financieros(report_data, report_data_anterior=None):
     cuentas_por_cobrar = 0
     activos_fijos = 0
     
+    catalogo = obtener_catalogo_cuentas()
     for subtipo, cuentas in report_data['Activo'].items():
         for cuenta in cuentas:
-            nombre_lower = cuenta['nombre'].lower()
-            if 'inventario' in nombre_lower:
+            etiquetas = etiquetas_cuenta(cuenta, catalogo)
+            if ETIQUETA_INVENTARIO in etiquetas:
                 inventario += cuenta['monto']
-            if 'por cobrar' in nombre_lower or 'cuentas por cobrar' in nombre_lower:
+            if ETIQUETA_CUENTAS_POR_COBRAR in etiquetas:
                 cuentas_por_cobrar += cuenta['monto']
-            if 'propiedad' in nombre_lower or 'planta' in nombre_lower or 'equipo' in nombre_lower:
+            if ETIQUETA_PROPIEDAD_PLANTA_EQUIPO in etiquetas:
                 activos_fijos += cuenta['monto']
     
     # === RATIOS DE LIQUIDEZ ===
@@ -583,7 +1227,7 @@ def calcular_ratios_financieros(report_data, report_data_anterior=None):
     gastos_financieros = 0
     for subtipo, cuentas in report_data['Gasto'].items():
         for cuenta in cuentas:
-            if 'financiero' in cuenta['nombre'].lower() or 'interes' in cuenta['nombre'].lower():
+            if ETIQUETA_GASTO_FINANCIERO in etiquetas_cuenta(cuenta, catalogo):
                 gastos_financieros += abs(cuenta['monto'])  # Usar valor absoluto para gastos
     
     utilidad_operativa = totales.get('Utilidad Operativa', utilidad_bruta)
@@ -684,14 +1328,7 @@ def calcular_origen_aplicacion(report_data_base, report_data_analisis):
     }
     
     # Obtener nombres de cuentas desde el catálogo para casos donde no estén en los datos
-    nombres_cuentas = {}
-    try:
-        with engine.connect() as conn:
-            query_nombres = text("SELECT CuentaID, NombreCuenta FROM CatalogoCuentas")
-            resultados_nombres = conn.execute(query_nombres).fetchall()
-            nombres_cuentas = {row[0]: row[1] for row in resultados_nombres}
-    except Exception as e:
-        print(f"Error al obtener nombres de cuentas: {e}")
+    nombres_cuentas = {cuenta_id: datos['nombre'] for cuenta_id, datos in obtener_catalogo_cuentas().items()}
     
     # Procesar Activos (Aumento = Aplicación, Disminución = Origen)
     for subtipo in set(list(report_data_base['Activo'].keys()) + list(report_data_analisis['Activo'].keys())):
@@ -842,112 +1479,1104 @@ def calcular_origen_aplicacion(report_data_base, report_data_analisis):
     
     return origen_aplicacion
 
-# --- Funciones para análisis con IA (Gemini) ---
+# --- Escritura masiva de saldos ---
+# Los montos se validan como Decimal antes de abrir la transacción y se escriben con un
+# INSERT ... ON CONFLICT de varias filas por sentencia, en lotes de SALDOS_LOTE filas
+# (3 parámetros por fila, lejos del límite de PostgreSQL).
 
-def analizar_con_gemini(report_data, anio_seleccionado):
-    """Genera un análisis financiero pequeño y enfocado usando Gemini"""
-    try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        model = genai.GenerativeModel('gemini-2.0-flash-lite')
-        
-        # Extraer datos clave
-        totales = report_data.get('Totales', {})
-        total_activo = totales.get('Total Activo', 0)
-        total_pasivo = totales.get('Total Pasivo', 0)
-        total_patrimonio = totales.get('Total Patrimonio', 0)
-        ingresos = totales.get('Ingreso', 0)
-        costos = totales.get('Costo', 0)
-        gastos = totales.get('Gasto', 0)
-        utilidad_bruta = totales.get('Utilidad Bruta', 0)
-        utilidad_operativa = totales.get('Utilidad Operativa', 0)
-        utilidad_neta = totales.get('Utilidad Neta', 0)
-        
-        # Calcular ratios básicos para contexto
-        razon_pasivo_patrimonio = (total_pasivo / total_patrimonio) if total_patrimonio > 0 else 0
-        margen_neto = (utilidad_neta / ingresos * 100) if ingresos > 0 else 0
-        
-        # Prompt conciso y estructurado
-        prompt = f"""Como analista financiero, proporciona un resumen ejecutivo breve (máximo 4 puntos clave) del análisis vertical para el año {anio_seleccionado}.
+SALDOS_LOTE = int(os.getenv('SALDOS_LOTE', '500'))
 
-Datos principales del Balance General:
-- Total Activo: C${total_activo:,.2f}
-- Total Pasivo: C${total_pasivo:,.2f}
-- Total Patrimonio: C${total_patrimonio:,.2f}
-- Razón Pasivo/Patrimonio: {razon_pasivo_patrimonio:.2f}
+# SaldoCuenta.Monto es NUMERIC(18, 2): 16 dígitos enteros y 2 decimales
+MONTO_DECIMALES = 2
+MONTO_MAXIMO = Decimal(10) ** (18 - MONTO_DECIMALES)
 
-Datos principales del Estado de Resultados:
-- Ingresos: C${ingresos:,.2f}
-- Costos: C${costos:,.2f}
-- Gastos: C${gastos:,.2f}
-- Utilidad Bruta: C${utilidad_bruta:,.2f}
-- Utilidad Operativa: C${utilidad_operativa:,.2f}
-- Utilidad Neta: C${utilidad_neta:,.2f}
-- Margen Neto: {margen_neto:.1f}%
+def convertir_monto(valor):
+    """
+    Convierte un monto (texto del formulario o celda de un archivo) a Decimal.
+    Devuelve None si está vacío y lanza ValueError si no es un número finito o no
+    cabe en NUMERIC(18, 2) (más de 16 dígitos enteros o más de 2 decimales).
+    """
+    if valor is None:
+        return None
+    if isinstance(valor, bool):
+        raise ValueError(f'monto inválido "{valor}"')
+    if isinstance(valor, Decimal):
+        monto = valor
+    elif isinstance(valor, (int, float)):
+        monto = Decimal(str(valor))
+    else:
+        texto = str(valor).strip()
+        if not texto:
+            return None
+        try:
+            monto = Decimal(texto)
+        except InvalidOperation:
+            raise ValueError(f'monto inválido "{texto}"')
+    if not monto.is_finite():
+        raise ValueError(f'monto inválido "{valor}"')
+    if abs(monto) >= MONTO_MAXIMO:
+        raise ValueError(f'monto fuera de rango "{valor}" (máximo 16 dígitos enteros)')
+    if monto != monto.quantize(Decimal(1).scaleb(-MONTO_DECIMALES)):
+        raise ValueError(f'monto con más de {MONTO_DECIMALES} decimales "{valor}"')
+    return monto
 
-Enfoca tu análisis en:
-1. Estructura de capital (relación pasivo/patrimonio y su significado)
-2. Rentabilidad (margen neto y eficiencia operativa)
-3. Principales fortalezas identificadas en la estructura financiera
-4. Recomendación clave basada en los datos presentados
+def _normalizar_decimal_coma(valor):
+    """'1.234,56' -> '1234.56' para archivos con ';' como separador (coma decimal)."""
+    if isinstance(valor, str) and ',' in valor:
+        return valor.replace('.', '').replace(',', '.')
+    return valor
 
-Sé directo, específico y usa las cifras proporcionadas. Máximo 80 palabras."""
+def asegurar_periodos(conn, anios):
+    """
+    Devuelve {anio: PeriodoID} dentro de la transacción `conn`, creando los períodos
+    que todavía no existen (FechaCierre al 31 de diciembre).
+    """
+    anios = sorted(set(anios))
+    if not anios:
+        return {}
+    parametros = {f'anio{i}': anio for i, anio in enumerate(anios)}
+    consulta = text(f"SELECT Anio, PeriodoID FROM Periodo WHERE Anio IN ({', '.join(':' + p for p in parametros)})")
+    periodos = {row[0]: row[1] for row in conn.execute(consulta, parametros).fetchall()}
 
-        response = model.generate_content(prompt)
-        analisis_texto = response.text
-        
-        # Convertir markdown a HTML
-        analisis_html = markdown(analisis_texto)
-        
-        return analisis_html
-        
-    except Exception as e:
-        print(f"Error al llamar a la API de Gemini: {e}")
-        import traceback
-        traceback.print_exc()
-        return f"<p><strong>Error al generar el análisis:</strong> {str(e)}</p>"
+    faltantes = [anio for anio in anios if anio not in periodos]
+    if faltantes:
+        # PostgreSQL: FechaCierre es requerido
+        conn.execute(
+            text("INSERT INTO Periodo (Anio, FechaCierre) VALUES (:anio, :fecha_cierre)"),
+            [{"anio": anio, "fecha_cierre": date(anio, 12, 31)} for anio in faltantes]
+        )
+        periodos = {row[0]: row[1] for row in conn.execute(consulta, parametros).fetchall()}
+    return periodos
 
-def analizar_horizontal_ia(report_data_base, report_data_analisis, periodo_base, periodo_analisis):
-    """Análisis horizontal pequeño y enfocado"""
-    try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        model = genai.GenerativeModel('gemini-2.0-flash-lite')
-        
-        # Obtener totales de ambos períodos
-        totales_base = report_data_base.get('Totales', {})
-        totales_analisis = report_data_analisis.get('Totales', {})
-        
-        # Calcular variaciones principales
-        activo_base = totales_base.get('Total Activo', 0)
-        activo_analisis = totales_analisis.get('Total Activo', 0)
-        activo_var = activo_analisis - activo_base
-        activo_var_pct = (activo_var / activo_base * 100) if activo_base > 0 else 0
-        
-        pasivo_base = totales_base.get('Total Pasivo', 0)
-        pasivo_analisis = totales_analisis.get('Total Pasivo', 0)
-        pasivo_var = pasivo_analisis - pasivo_base
-        pasivo_var_pct = (pasivo_var / pasivo_base * 100) if pasivo_base > 0 else 0
-        
-        patrimonio_base = totales_base.get('Total Patrimonio', 0)
-        patrimonio_analisis = totales_analisis.get('Total Patrimonio', 0)
-        patrimonio_var = patrimonio_analisis - patrimonio_base
-        patrimonio_var_pct = (patrimonio_var / patrimonio_base * 100) if patrimonio_base > 0 else 0
-        
-        ingresos_base = totales_base.get('Ingreso', 0)
-        ingresos_analisis = totales_analisis.get('Ingreso', 0)
-        ingresos_var = ingresos_analisis - ingresos_base
-        ingresos_var_pct = (ingresos_var / ingresos_base * 100) if ingresos_base > 0 else 0
-        
-        utilidad_base = totales_base.get('Utilidad Neta', 0)
-        utilidad_analisis = totales_analisis.get('Utilidad Neta', 0)
-        utilidad_var = utilidad_analisis - utilidad_base
-        utilidad_var_pct = (utilidad_var / utilidad_base * 100) if utilidad_base != 0 else (100 if utilidad_var > 0 else -100 if utilidad_var < 0 else 0)
-        
-        prompt = f"""Como analista financiero, proporciona un análisis horizontal breve (máximo 4 puntos clave) comparando el período {periodo_base} vs {periodo_analisis}.
+def guardar_saldos(conn, saldos):
+    """
+    Inserta o actualiza saldos [(cuenta_id, periodo_id, monto)] dentro de la transacción
+    `conn` con una sentencia de varias filas por lote. Si un par (cuenta, período) se
+    repite gana el último, ya que ON CONFLICT no admite la misma llave dos veces en una
+    sentencia. Devuelve la cantidad de saldos escritos.
+    """
+    unicos = {}
+    for cuenta_id, periodo_id, monto in saldos:
+        unicos[(cuenta_id, periodo_id)] = monto
+    filas = [(cuenta_id, periodo_id, monto) for (cuenta_id, periodo_id), monto in unicos.items()]
 
-Variaciones en Balance General:
-- Activo Total: {activo_var_pct:+.1f}% (C${activo_var:+,.2f}) - De C${activo_base:,.2f} a C${activo_analisis:,.2f}
-- Pasivo Total: {pasivo_var_pct:+.1f}% (C${pasivo_var:+,.2f}) - De C${pasivo_base:,.2f} a C${pasivo_analisis:,.2f}
-- Patrimonio: {patrimonio_var_pct:+.1f}% (C${patrimonio_var:+,.2f}) - De C${patrimonio_base:,.2f} a C${patrimonio_analisis:,.2f}
+    # PostgreSQL: INSERT ... ON CONFLICT (reemplaza MERGE)
+    _insertar_en_lotes(
+        conn, 'SaldoCuenta', ('CuentaID', 'PeriodoID', 'Monto'), filas, SALDOS_LOTE,
+        'ON CONFLICT (PeriodoID, CuentaID) DO UPDATE SET Monto = EXCLUDED.Monto'
+    )
+    return len(filas)
+
+def _insertar_en_lotes(conn, tabla, columnas, filas, lote, sufijo=''):
+    """INSERT de varias filas por sentencia (lotes de `lote` filas) con un sufijo opcional (ON CONFLICT...)."""
+    for inicio in range(0, len(filas), lote):
+        parametros = {}
+        valores = []
+        for i, fila in enumerate(filas[inicio:inicio + lote]):
+            for j, valor in enumerate(fila):
+                parametros[f'v{i}_{j}'] = valor
+            valores.append('(' + ', '.join(f':v{i}_{j}' for j in range(len(columnas))) + ')')
+        conn.execute(text(f"""
+            INSERT INTO {tabla} ({', '.join(columnas)})
+            VALUES {', '.join(valores)}
+            {sufijo}
+        """), parametros)
+
+# --- Importación de saldos desde archivo ---
+# CSV o XLSX con las columnas CuentaID, Anio y Monto (en cualquier orden) y filas de
+# varios años. El archivo se recorre fila por fila (openpyxl en modo solo lectura) y se
+# valida contra las cuentas leídas en la misma transacción que escribe los saldos; si
+# alguna fila tiene errores no se escribe nada. En un CSV separado por ';' el monto
+# puede usar coma decimal.
+
+IMPORTACION_MAX_ERRORES = int(os.getenv('IMPORTACION_MAX_ERRORES', '20'))
+
+# Encabezados aceptados en los archivos de saldos y de catálogo (sin acentos, espacios
+# ni mayúsculas). Un mismo encabezado significa lo mismo en las dos cargas: 'Cuenta'
+# es siempre el CuentaID y el nombre va en 'NombreCuenta' o 'Nombre'.
+_COLUMNAS_ARCHIVO = {
+    'cuentaid': 'cuenta_id', 'cuenta': 'cuenta_id', 'codigo': 'cuenta_id', 'id': 'cuenta_id',
+    'nombrecuenta': 'nombre', 'nombre': 'nombre',
+    'tipocuenta': 'tipo', 'tipo': 'tipo',
+    'subtipocuenta': 'subtipo', 'subtipo': 'subtipo',
+    'anio': 'anio', 'ano': 'anio', 'periodo': 'anio',
+    'monto': 'monto', 'saldo': 'monto',
+}
+
+def _columna_importacion(encabezado):
+    """Nombre interno de una columna del archivo ('Año', 'Cuenta ID'...) o None si no se usa."""
+    texto = unicodedata.normalize('NFKD', str(encabezado or '')).encode('ascii', 'ignore').decode().lower()
+    return _COLUMNAS_ARCHIVO.get(re.sub(r'[^a-z]', '', texto))
+
+def _texto_celda(valor):
+    """Texto de una celda; los números enteros leídos de Excel (1101.0) pierden el decimal."""
+    if isinstance(valor, float) and valor.is_integer():
+        valor = int(valor)
+    return str(valor).strip() if valor is not None else ''
+
+def leer_filas_importacion(archivo, nombre_archivo):
+    """
+    Recorre un CSV (coma o punto y coma) o XLSX subido y devuelve tuplas
+    (numero_fila, {'cuenta_id', 'anio', 'monto'}) con los valores sin validar.
+    Lanza ValueError si el formato o los encabezados no son válidos.
+    """
+    return _leer_tabla_archivo(
+        archivo, nombre_archivo, ('cuenta_id', 'anio', 'monto'),
+        'El archivo debe tener las columnas CuentaID, Anio y Monto en la primera fila.',
+        decimales=('monto',)
+    )
+
+def _leer_tabla_archivo(archivo, nombre_archivo, requeridas, mensaje_encabezados, decimales=()):
+    """
+    Filas (numero_fila, {columna: valor}) de un CSV o XLSX cuya primera fila son los
+    encabezados. En un CSV separado por ';' las columnas de `decimales` se leen con
+    coma decimal.
+    """
+    extension = os.path.splitext(nombre_archivo or '')[1].lower()
+    wb = None
+    coma_decimal = False
+    if extension == '.csv':
+        texto = io.TextIOWrapper(archivo, encoding='utf-8-sig', newline='')
+        primera_linea = texto.readline()
+        delimitador = ';' if primera_linea.count(';') > primera_linea.count(',') else ','
+        coma_decimal = delimitador == ';'
+        filas = csv.reader(itertools.chain([primera_linea], texto), delimiter=delimitador)
+    elif extension in ('.xlsx', '.xlsm'):
+        wb = load_workbook(archivo, read_only=True, data_only=True)
+        filas = wb.worksheets[0].iter_rows(values_only=True)
+    else:
+        raise ValueError('Formato no soportado: usa un archivo .csv o .xlsx.')
+
+    try:
+        encabezados = [_columna_importacion(valor) for valor in next(filas, ())]
+        if set(requeridas) - set(encabezados):
+            raise ValueError(mensaje_encabezados)
+        posiciones = {columna: encabezados.index(columna) for columna in requeridas}
+
+        for numero_fila, valores in enumerate(filas, start=2):
+            valores = list(valores)
+            if not any(_texto_celda(valor) for valor in valores):
+                continue
+            fila = {
+                columna: valores[posicion] if posicion < len(valores) else None
+                for columna, posicion in posiciones.items()
+            }
+            if coma_decimal:
+                for columna in decimales:
+                    if columna in fila:
+                        fila[columna] = _normalizar_decimal_coma(fila[columna])
+            yield numero_fila, fila
+    finally:
+        if wb is not None:
+            wb.close()
+
+def cargar_saldos_importados(filas):
+    """
+    Valida las filas de leer_filas_importacion y, si ninguna tiene errores, guarda todos
+    los saldos en una sola transacción (períodos nuevos incluidos).
+
+    Returns:
+        dict: {'filas', 'guardados', 'anios', 'errores': [(fila, mensaje)], 'total_errores'};
+              'errores' guarda solo los primeros IMPORTACION_MAX_ERRORES.
+    """
+    resultado = {'filas': 0, 'guardados': 0, 'anios': [], 'errores': [], 'total_errores': 0}
+
+    def registrar_error(numero_fila, mensaje):
+        resultado['total_errores'] += 1
+        if len(resultado['errores']) < IMPORTACION_MAX_ERRORES:
+            resultado['errores'].append((numero_fila, mensaje))
+
+    # Las cuentas se leen en la misma transacción que escribe: la caché del catálogo
+    # puede venir de antes de una sincronización hecha en otro worker
+    with engine.begin() as conn:
+        cuentas = {row[0] for row in conn.execute(text("SELECT CuentaID FROM CatalogoCuentas")).fetchall()}
+        if not cuentas:
+            raise ValueError('El catálogo de cuentas está vacío: sincronízalo antes de importar saldos.')
+
+        saldos = []
+        for numero_fila, fila in filas:
+            resultado['filas'] += 1
+            cuenta_id = _texto_celda(fila['cuenta_id'])
+            if cuenta_id not in cuentas:
+                registrar_error(numero_fila, f'la cuenta "{cuenta_id}" no existe en el catálogo')
+                continue
+            try:
+                anio = int(_texto_celda(fila['anio']))
+            except ValueError:
+                registrar_error(numero_fila, f'año inválido "{_texto_celda(fila["anio"])}"')
+                continue
+            if not 1900 <= anio <= 2100:
+                registrar_error(numero_fila, f'año fuera de rango {anio}')
+                continue
+            try:
+                monto = convertir_monto(fila['monto'])
+            except ValueError as e:
+                registrar_error(numero_fila, str(e))
+                continue
+            if monto is None:
+                registrar_error(numero_fila, 'monto vacío')
+                continue
+            saldos.append((cuenta_id, anio, monto))
+
+        if resultado['total_errores'] or not saldos:
+            return resultado
+
+        anios = sorted({anio for _, anio, _ in saldos})
+        periodos = asegurar_periodos(conn, anios)
+        resultado['guardados'] = guardar_saldos(conn, [(cuenta_id, periodos[anio], monto) for cuenta_id, anio, monto in saldos])
+    resultado['anios'] = anios
+    return resultado
+
+# --- Sincronización del catálogo de cuentas ---
+# Un archivo con el plan de cuentas completo se compara en memoria contra la tabla:
+# las cuentas nuevas se insertan y las que cambiaron se actualizan, todo en una
+# transacción. Las cuentas que no vienen en el archivo se dejan como están (pueden
+# tener saldos). Las cachés derivadas se invalidan una sola vez al terminar.
+
+CATALOGO_LOTE = int(os.getenv('CATALOGO_LOTE', '500'))
+
+# Valores permitidos por los CHECK de CatalogoCuentas (render_schema.sql) y subtipos
+# que corresponden a cada tipo
+SUBTIPOS_POR_TIPO = {
+    'Activo': ('Activo Corriente', 'Activo No Corriente'),
+    'Pasivo': ('Pasivo Corriente', 'Pasivo No Corriente'),
+    'Patrimonio': ('Capital', 'Resultados'),
+    'Ingreso': ('Ingresos Operativos', 'Otros Ingresos'),
+    'Costo': ('Costo de Ventas',),
+    'Gasto': ('Gasto Operativo', 'Gasto No Operativo'),
+}
+TIPOS_CUENTA = tuple(SUBTIPOS_POR_TIPO)
+SUBTIPOS_CUENTA = tuple(subtipo for subtipos in SUBTIPOS_POR_TIPO.values() for subtipo in subtipos)
+
+# Largos de las columnas VARCHAR de CatalogoCuentas
+CUENTA_ID_MAX = 20
+NOMBRE_CUENTA_MAX = 100
+
+def leer_filas_catalogo(archivo, nombre_archivo):
+    """
+    Recorre un CSV o XLSX con las columnas CuentaID, NombreCuenta, TipoCuenta y
+    SubTipoCuenta y devuelve tuplas (numero_fila, {columna: valor}).
+    """
+    return _leer_tabla_archivo(
+        archivo, nombre_archivo, ('cuenta_id', 'nombre', 'tipo', 'subtipo'),
+        'El archivo debe tener las columnas CuentaID, NombreCuenta, TipoCuenta y SubTipoCuenta en la primera fila.'
+    )
+
+def sincronizar_catalogo(filas):
+    """
+    Valida el plan de cuentas del archivo y aplica la diferencia con CatalogoCuentas en
+    una sola transacción. Si alguna fila tiene errores no se escribe nada. No invalida
+    las cachés: la ruta llama a invalidar_cache_reportes() si hubo cambios.
+
+    Returns:
+        dict: {'filas', 'insertadas', 'actualizadas', 'sin_cambios', 'ausentes',
+               'errores': [(fila, mensaje)], 'total_errores'}
+    """
+    resultado = {'filas': 0, 'insertadas': 0, 'actualizadas': 0, 'sin_cambios': 0, 'ausentes': 0,
+                 'errores': [], 'total_errores': 0}
+
+    def registrar_error(numero_fila, mensaje):
+        resultado['total_errores'] += 1
+        if len(resultado['errores']) < IMPORTACION_MAX_ERRORES:
+            resultado['errores'].append((numero_fila, mensaje))
+
+    cuentas = {}
+    for numero_fila, fila in filas:
+        resultado['filas'] += 1
+        cuenta_id = _texto_celda(fila['cuenta_id'])
+        nombre = _texto_celda(fila['nombre'])
+        tipo = _texto_celda(fila['tipo'])
+        subtipo = _texto_celda(fila['subtipo'])
+        if not cuenta_id:
+            registrar_error(numero_fila, 'falta el CuentaID')
+        elif len(cuenta_id) > CUENTA_ID_MAX:
+            registrar_error(numero_fila, f'el CuentaID "{cuenta_id}" supera los {CUENTA_ID_MAX} caracteres')
+        elif cuenta_id in cuentas:
+            registrar_error(numero_fila, f'la cuenta "{cuenta_id}" está repetida en el archivo')
+        elif not nombre:
+            registrar_error(numero_fila, f'la cuenta "{cuenta_id}" no tiene nombre')
+        elif len(nombre) > NOMBRE_CUENTA_MAX:
+            registrar_error(numero_fila, f'el nombre de la cuenta "{cuenta_id}" supera los {NOMBRE_CUENTA_MAX} caracteres')
+        elif tipo not in TIPOS_CUENTA:
+            registrar_error(numero_fila, f'tipo de cuenta inválido "{tipo}"')
+        elif not subtipo:
+            registrar_error(numero_fila, f'la cuenta "{cuenta_id}" no tiene subtipo')
+        elif subtipo not in SUBTIPOS_CUENTA:
+            registrar_error(numero_fila, f'subtipo de cuenta inválido "{subtipo}"')
+        elif subtipo not in SUBTIPOS_POR_TIPO[tipo]:
+            registrar_error(numero_fila, f'el subtipo "{subtipo}" no corresponde al tipo "{tipo}"')
+        else:
+            cuentas[cuenta_id] = (nombre, tipo, subtipo)
+
+    if resultado['total_errores'] or not cuentas:
+        return resultado
+
+    with engine.begin() as conn:
+        # Estado actual leído dentro de la misma transacción que aplica los cambios; se
+        # normaliza igual que el archivo para no reportar como cambiadas cuentas iguales
+        actuales = {
+            _texto_celda(row[0]): (_texto_celda(row[1]), _texto_celda(row[2]), _texto_celda(row[3]))
+            for row in conn.execute(text("SELECT CuentaID, NombreCuenta, TipoCuenta, SubTipoCuenta FROM CatalogoCuentas")).fetchall()
+        }
+        nuevas = [(cuenta_id,) + datos for cuenta_id, datos in cuentas.items() if cuenta_id not in actuales]
+        cambiadas = [
+            {"id": cuenta_id, "nombre": nombre, "tipo": tipo, "subtipo": subtipo}
+            for cuenta_id, (nombre, tipo, subtipo) in cuentas.items()
+            if cuenta_id in actuales and actuales[cuenta_id] != (nombre, tipo, subtipo)
+        ]
+
+        _insertar_en_lotes(conn, 'CatalogoCuentas', ('CuentaID', 'NombreCuenta', 'TipoCuenta', 'SubTipoCuenta'), nuevas, CATALOGO_LOTE)
+        actualizar = text("UPDATE CatalogoCuentas SET NombreCuenta = :nombre, TipoCuenta = :tipo, SubTipoCuenta = :subtipo WHERE CuentaID = :id")
+        for inicio in range(0, len(cambiadas), CATALOGO_LOTE):
+            conn.execute(actualizar, cambiadas[inicio:inicio + CATALOGO_LOTE])
+
+    resultado['insertadas'] = len(nuevas)
+    resultado['actualizadas'] = len(cambiadas)
+    resultado['sin_cambios'] = len(cuentas) - len(nuevas) - len(cambiadas)
+    resultado['ausentes'] = len(set(actuales) - set(cuentas))
+    return resultado
+
+# --- Modelos de IA ---
+# Registro de modelos: el SDK se configura una sola vez (en extensions.py, al iniciar)
+# y cada modelo se construye una vez por proceso y se reutiliza. El orden de respaldo
+# de cada uso se define aquí: si un modelo falla al generar se intenta el siguiente.
+# Con IA_MODELO_FALSO=1 se usa un modelo local que responde sin red, para pruebas y
+# desarrollo sin API key. IA_MODELO_FALSO_DEMORA simula la latencia por fragmento.
+
+def _lista_modelos(variable, por_defecto):
+    return [m.strip() for m in os.getenv(variable, por_defecto).split(',') if m.strip()]
+
+MODELOS_IA = {
+    'analisis': _lista_modelos('IA_MODELOS_ANALISIS', 'gemini-2.0-flash-lite,gemini-2.5-flash'),
+    'chatbot': _lista_modelos('IA_MODELOS_CHATBOT', 'gemini-2.5-flash,gemini-1.5-flash,gemini-2.0-flash-lite'),
+}
+
+_modelos_ia = {}
+_modelos_ia_lock = threading.Lock()
+
+# Protección de las llamadas: límite por llamada, máximo de llamadas simultáneas por
+# proceso y un circuito por modelo que, tras varios fallos seguidos, rechaza las
+# llamadas de inmediato durante IA_CIRCUITO_ESPERA segundos. Pasada la espera el
+# circuito queda semiabierto: solo la primera llamada llega al modelo y las demás se
+# rechazan hasta que esa prueba termine.
+IA_TIMEOUT = float(os.getenv('IA_TIMEOUT', '20'))                    # segundos por llamada
+IA_MAX_SIMULTANEAS = int(os.getenv('IA_MAX_SIMULTANEAS', '4'))
+IA_ESPERA_TURNO = float(os.getenv('IA_ESPERA_TURNO', '5'))            # segundos esperando un cupo
+IA_CIRCUITO_FALLOS = int(os.getenv('IA_CIRCUITO_FALLOS', '3'))
+IA_CIRCUITO_ESPERA = float(os.getenv('IA_CIRCUITO_ESPERA', '60'))
+
+_semaforo_ia = threading.BoundedSemaphore(IA_MAX_SIMULTANEAS)
+_circuitos_ia = {}
+
+class IANoDisponibleError(RuntimeError):
+    """El servicio de IA está saturado o en pausa por fallos recientes."""
+
+IA_MODELO_FALSO = os.getenv('IA_MODELO_FALSO', '0').lower() in ('1', 'true', 'si', 'yes')
+IA_MODELO_FALSO_DEMORA = float(os.getenv('IA_MODELO_FALSO_DEMORA', '0'))
+
+class _RespuestaIAFalsa:
+    def __init__(self, texto):
+        self.text = texto
+
+class ModeloIAFalso:
+    """Sustituto local de genai.GenerativeModel con la misma interfaz de generate_content."""
+    def __init__(self, model_name):
+        self.model_name = model_name
+
+    def _texto(self, prompt):
+        huella = hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:12]
+        return (f"**Análisis de prueba** (modelo local `{self.model_name}`).\n\n"
+                f"- El prompt tiene {len(prompt)} caracteres.\n"
+                f"- Huella del prompt: `{huella}`.\n"
+                f"- Configura GEMINI_API_KEY y desactiva IA_MODELO_FALSO para respuestas reales.")
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        texto = self._texto(prompt)
+        if not stream:
+            time.sleep(IA_MODELO_FALSO_DEMORA)
+            return _RespuestaIAFalsa(texto)
+        return self._fragmentos(texto)
+
+    def _fragmentos(self, texto):
+        palabras = texto.split(' ')
+        for i in range(0, len(palabras), 4):
+            time.sleep(IA_MODELO_FALSO_DEMORA)
+            fin = '' if i + 4 >= len(palabras) else ' '
+            yield _RespuestaIAFalsa(' '.join(palabras[i:i + 4]) + fin)
+
+def obtener_modelo_ia(modelo):
+    """Devuelve el modelo generativo indicado, construido una sola vez por proceso."""
+    with _modelos_ia_lock:
+        instancia = _modelos_ia.get(modelo)
+        if instancia is None:
+            instancia = ModeloIAFalso(modelo) if IA_MODELO_FALSO else genai.GenerativeModel(modelo)
+            _modelos_ia[modelo] = instancia
+        return instancia
+
+def _nuevo_circuito_ia():
+    return {'fallos': 0, 'abierto_hasta': 0.0, 'en_prueba': False}
+
+def _circuito_abierto(modelo):
+    """True si el modelo no admite llamadas: en espera o con la llamada de prueba en curso."""
+    with _modelos_ia_lock:
+        circuito = _circuitos_ia.get(modelo)
+        return bool(circuito) and (time.monotonic() < circuito['abierto_hasta'] or circuito['en_prueba'])
+
+def _admitir_llamada_ia(modelo):
+    """
+    Decide si una llamada puede ir al modelo. Devuelve (admitida, es_prueba): con el
+    circuito cerrado se admiten todas; semiabierto solo la primera, que queda como prueba.
+    """
+    with _modelos_ia_lock:
+        circuito = _circuitos_ia.get(modelo)
+        if not circuito or not circuito['abierto_hasta']:
+            return True, False
+        if time.monotonic() < circuito['abierto_hasta'] or circuito['en_prueba']:
+            return False, False
+        circuito['en_prueba'] = True
+        return True, True
+
+def _cancelar_prueba_ia(modelo):
+    """Libera la prueba del circuito semiabierto sin contarla como éxito ni como fallo."""
+    with _modelos_ia_lock:
+        circuito = _circuitos_ia.get(modelo)
+        if circuito:
+            circuito['en_prueba'] = False
+
+def _registrar_resultado_ia(modelo, exito):
+    with _modelos_ia_lock:
+        circuito = _circuitos_ia.setdefault(modelo, _nuevo_circuito_ia())
+        circuito['en_prueba'] = False
+        if exito:
+            circuito['fallos'] = 0
+            circuito['abierto_hasta'] = 0.0
+            return
+        circuito['fallos'] += 1
+        # Si la llamada de prueba falla, los fallos siguen sobre el umbral y el circuito se reabre
+        if circuito['fallos'] >= IA_CIRCUITO_FALLOS:
+            circuito['abierto_hasta'] = time.monotonic() + IA_CIRCUITO_ESPERA
+            print(f"Circuito de IA abierto para {modelo} por {IA_CIRCUITO_ESPERA:.0f}s tras {circuito['fallos']} fallos")
+
+def ia_en_pausa(uso='analisis'):
+    """True si todos los modelos del uso tienen el circuito abierto."""
+    return all(_circuito_abierto(modelo) for modelo in modelos_para(uso))
+
+def _tomar_turno_ia(modelo):
+    """Admisión del circuito y cupo de llamadas simultáneas. Devuelve True si la llamada es la prueba."""
+    admitida, es_prueba = _admitir_llamada_ia(modelo)
+    if not admitida:
+        raise IANoDisponibleError('El servicio de IA no está disponible en este momento. Intenta de nuevo en unos minutos.')
+    if not _semaforo_ia.acquire(timeout=IA_ESPERA_TURNO):
+        if es_prueba:
+            _cancelar_prueba_ia(modelo)
+        raise IANoDisponibleError('El servicio de IA está atendiendo demasiadas consultas. Intenta de nuevo en unos momentos.')
+    return es_prueba
+
+def llamar_modelo_ia(modelo, prompt):
+    """generate_content con límite de tiempo, cupo de llamadas simultáneas y circuito."""
+    _tomar_turno_ia(modelo)
+    try:
+        response = obtener_modelo_ia(modelo).generate_content(prompt, request_options={'timeout': IA_TIMEOUT})
+        texto = response.text
+    except Exception:
+        _registrar_resultado_ia(modelo, False)
+        raise
+    finally:
+        _semaforo_ia.release()
+    _registrar_resultado_ia(modelo, True)
+    return texto
+
+def transmitir_modelo_ia(modelo, prompt):
+    """Versión con stream=True de llamar_modelo_ia: genera los fragmentos de texto."""
+    es_prueba = _tomar_turno_ia(modelo)
+    terminada = False
+    try:
+        respuesta = obtener_modelo_ia(modelo).generate_content(
+            prompt, stream=True, request_options={'timeout': IA_TIMEOUT}
+        )
+        for chunk in respuesta:
+            yield chunk.text
+        terminada = True
+    except Exception:
+        terminada = True
+        _registrar_resultado_ia(modelo, False)
+        raise
+    finally:
+        _semaforo_ia.release()
+        # Si el cliente cerró la transmisión a medias la prueba no decidió nada
+        if not terminada and es_prueba:
+            _cancelar_prueba_ia(modelo)
+    _registrar_resultado_ia(modelo, True)
+
+def modelos_para(uso):
+    """Modelos a intentar, en orden, para un uso ('analisis' o 'chatbot')."""
+    return MODELOS_IA.get(uso) or MODELOS_IA['analisis']
+
+def generar_texto_ia(prompt, uso='analisis'):
+    """
+    Genera la respuesta probando los modelos del uso en orden de respaldo.
+    Devuelve (texto, modelo_usado); si todos fallan se lanza el último error.
+    """
+    ultimo_error = None
+    for modelo in modelos_para(uso):
+        try:
+            return llamar_modelo_ia(modelo, prompt), modelo
+        except Exception as e:
+            print(f"Error al generar con {modelo}: {e}")
+            ultimo_error = e
+    raise ultimo_error
+
+def ia_disponible():
+    """Indica si hay un modelo con el cual generar respuestas (API key o modelo local)."""
+    return IA_MODELO_FALSO or bool(GEMINI_API_KEY)
+
+# --- Caché de respuestas de IA ---
+# Los prompts de análisis dependen solo de totales deterministas, así que la respuesta
+# se guarda en disco con llave modelo + sha256(prompt). Un período cerrado devuelve
+# siempre el mismo análisis sin volver a llamar a Gemini. La llave usa el modelo
+# principal del uso; si respondió un modelo de respaldo la entrada queda marcada y
+# dura solo IA_CACHE_TTL_RESPALDO, para volver al modelo principal cuando se recupere.
+
+MODELO_IA = MODELOS_IA['analisis'][0]
+IA_CACHE_DIR = os.getenv('IA_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'finanzas_ia_cache'))
+IA_CACHE_TTL = int(os.getenv('IA_CACHE_TTL', str(30 * 24 * 3600)))  # segundos, 0 = sin expiración
+IA_CACHE_TTL_RESPALDO = int(os.getenv('IA_CACHE_TTL_RESPALDO', '3600'))  # respuestas de un modelo de respaldo
+IA_CACHE_MAX_ENTRADAS = int(os.getenv('IA_CACHE_MAX_ENTRADAS', '500'))
+
+def clave_cache_ia(prompt, modelo=MODELO_IA):
+    """Llave de caché de una respuesta: sha256 del modelo y el prompt."""
+    return hashlib.sha256(f"{modelo}\n{prompt}".encode('utf-8')).hexdigest()
+
+def _ruta_cache_ia(clave):
+    return os.path.join(IA_CACHE_DIR, f"{clave}.json")
+
+def leer_cache_ia(clave):
+    """Devuelve el texto guardado para la llave, o None si no existe o ya expiró."""
+    ruta = _ruta_cache_ia(clave)
+    try:
+        with open(ruta, 'r', encoding='utf-8') as f:
+            entrada = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    ttl = IA_CACHE_TTL_RESPALDO if entrada.get('respaldo') else IA_CACHE_TTL
+    if ttl and time.time() - entrada.get('creado', 0) > ttl:
+        try:
+            os.remove(ruta)
+        except OSError:
+            pass
+        return None
+
+    try:
+        # Marca de uso para que la expulsión descarte primero lo menos usado
+        os.utime(ruta, None)
+    except OSError:
+        pass
+    return entrada.get('texto')
+
+def es_modelo_respaldo(modelo, uso='analisis'):
+    """True si `modelo` no es el principal del uso (la llave de caché usa el principal)."""
+    return modelo != modelos_para(uso)[0]
+
+def guardar_cache_ia(clave, texto, modelo=MODELO_IA, respaldo=False):
+    """
+    Guarda la respuesta en disco y expulsa las entradas más viejas si se pasa del máximo.
+    Con respaldo la entrada expira a los IA_CACHE_TTL_RESPALDO segundos.
+    """
+    try:
+        os.makedirs(IA_CACHE_DIR, exist_ok=True)
+        ruta = _ruta_cache_ia(clave)
+        temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporal, 'w', encoding='utf-8') as f:
+            json.dump({'modelo': modelo, 'creado': time.time(), 'texto': texto, 'respaldo': respaldo}, f, ensure_ascii=False)
+        os.replace(temporal, ruta)
+        _expulsar_cache_ia()
+    except OSError as e:
+        print(f"Error al guardar en caché de IA: {e}")
+
+def _expulsar_cache_ia():
+    if not IA_CACHE_MAX_ENTRADAS:
+        return
+    archivos = [os.path.join(IA_CACHE_DIR, n) for n in os.listdir(IA_CACHE_DIR) if n.endswith('.json')]
+    sobrantes = len(archivos) - IA_CACHE_MAX_ENTRADAS
+    if sobrantes <= 0:
+        return
+    def _mtime(ruta):
+        try:
+            return os.path.getmtime(ruta)
+        except OSError:
+            return 0
+    for ruta in sorted(archivos, key=_mtime)[:sobrantes]:
+        try:
+            os.remove(ruta)
+        except OSError:
+            pass
+
+def generar_analisis_ia(prompt, uso='analisis', transmitir=False):
+    """
+    Genera el análisis (HTML) para un prompt, usando la caché en disco cuando existe.
+    Los errores de la API se propagan para que cada análisis los reporte a su manera;
+    las respuestas fallidas no se guardan. Con transmitir se genera con stream=True y
+    cada fragmento se publica para transmitir_analisis_ia.
+    """
+    clave = clave_cache_ia(prompt, modelos_para(uso)[0])
+    while True:
+        analisis_texto = leer_cache_ia(clave)
+        if analisis_texto is not None:
+            break
+        generacion, propia = _reservar_generacion_ia(clave)
+        if not propia:
+            # Otro trabajo (transmisión, combinado o precalentamiento) ya la está
+            # generando: se espera y se vuelve a leer la caché
+            generacion.esperar()
+            continue
+        error = None
+        try:
+            if transmitir:
+                # transmitir_texto_ia guarda la respuesta completa en la caché
+                for fragmento in transmitir_texto_ia(prompt, uso):
+                    generacion.agregar(fragmento)
+                analisis_texto = ''.join(generacion.partes)
+            else:
+                analisis_texto, modelo = generar_texto_ia(prompt, uso)
+                guardar_cache_ia(clave, analisis_texto, modelo, es_modelo_respaldo(modelo, uso))
+                generacion.agregar(analisis_texto)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            _liberar_generacion_ia(clave, generacion, error)
+        break
+
+    # Convertir markdown a HTML
+    return markdown(analisis_texto)
+
+def transmitir_texto_ia(prompt, uso='analisis', usar_cache=True):
+    """
+    Generador con los fragmentos de texto de la respuesta a medida que el modelo los
+    produce (generate_content con stream=True). Con usar_cache, una respuesta ya
+    guardada se entrega en un solo fragmento y una respuesta completa se guarda al final.
+    Si un modelo falla antes de enviar el primer fragmento se intenta el siguiente.
+    """
+    modelos = modelos_para(uso)
+    clave = clave_cache_ia(prompt, modelos[0]) if usar_cache else None
+    if clave:
+        texto = leer_cache_ia(clave)
+        if texto is not None:
+            yield texto
+            return
+
+    partes = []
+    for i, modelo in enumerate(modelos):
+        try:
+            for fragmento in transmitir_modelo_ia(modelo, prompt):
+                if fragmento:
+                    partes.append(fragmento)
+                    yield fragmento
+            break
+        except Exception as e:
+            # Con texto ya enviado no se puede cambiar de modelo
+            if partes or i == len(modelos) - 1:
+                raise
+            print(f"Error al generar con {modelo}: {e}")
+
+    if clave:
+        guardar_cache_ia(clave, ''.join(partes), modelo, es_modelo_respaldo(modelo, uso))
+
+def formatear_evento_sse(evento, datos):
+    """Serializa un evento Server-Sent Events con datos JSON."""
+    return f"event: {evento}\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n"
+
+def respuesta_sse(fragmentos):
+    """
+    Respuesta text/event-stream a partir de un generador de fragmentos de texto.
+    Emite 'fragmento' por cada trozo, 'fin' con el texto completo y su HTML, o
+    'error' si el modelo falla a mitad de camino.
+    """
+    def eventos():
+        partes = []
+        try:
+            for fragmento in fragmentos:
+                partes.append(fragmento)
+                yield formatear_evento_sse('fragmento', {'texto': fragmento})
+            texto = ''.join(partes)
+            yield formatear_evento_sse('fin', {'texto': texto, 'html': markdown(texto)})
+        except Exception as e:
+            print(f"Error en transmisión de IA: {e}")
+            yield formatear_evento_sse('error', {'error': str(e)})
+
+    return Response(
+        stream_with_context(eventos()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+# --- Cola de análisis de IA ---
+# Las llamadas a Gemini se ejecutan en un pool de hilos acotado para no bloquear los
+# workers web. El id del trabajo es la llave de caché del prompt: si el resultado ya
+# está en disco se responde de inmediato y, aunque la consulta de estado llegue a otro
+# worker, el resultado se encuentra en la caché compartida. Los fallos se guardan
+# durante IA_FALLOS_TTL segundos (en memoria y junto a la caché en disco) para que
+# cualquier worker pueda reportarlos.
+
+IA_MAX_HILOS = int(os.getenv('IA_MAX_HILOS', '4'))
+IA_MAX_PENDIENTES = int(os.getenv('IA_MAX_PENDIENTES', '32'))
+IA_FALLOS_TTL = int(os.getenv('IA_FALLOS_TTL', '300'))
+
+_ejecutor_ia = None
+_trabajos_ia = {}
+_fallos_ia = {}
+_trabajos_ia_lock = threading.Lock()
+
+def obtener_ejecutor_ia():
+    """Pool de hilos compartido para trabajos de IA (se crea en el primer uso)."""
+    global _ejecutor_ia
+    with _trabajos_ia_lock:
+        if _ejecutor_ia is None:
+            _ejecutor_ia = ThreadPoolExecutor(max_workers=IA_MAX_HILOS, thread_name_prefix='ia')
+        return _ejecutor_ia
+
+def encolar_analisis_ia(prompt, uso='analisis'):
+    """
+    Encola la generación de un análisis y devuelve (job_id, html). Si el análisis ya
+    está en caché, html trae el resultado y no se encola nada; si no, html es None.
+    Un mismo prompt en curso no se encola dos veces. Lanza RuntimeError si la cola
+    está llena e IANoDisponibleError si la IA está en pausa.
+    """
+    job_id = clave_cache_ia(prompt, modelos_para(uso)[0])
+    texto = leer_cache_ia(job_id)
+    if texto is not None:
+        return job_id, markdown(texto)
+
+    if ia_en_pausa(uso):
+        # Respuesta inmediata: no tiene sentido encolar mientras todos los circuitos están abiertos
+        raise IANoDisponibleError('El servicio de IA no está disponible en este momento. Intenta de nuevo en unos minutos.')
+
+    _encolar_trabajo_ia(job_id, generar_analisis_ia, prompt, uso)
+    return job_id, None
+
+def _encolar_trabajo_ia(job_id, funcion, *args):
+    """
+    Envía funcion(*args) al pool bajo job_id, salvo que ya esté en curso. Devuelve
+    True si se encoló y False si ya había un trabajo con ese id.
+    """
+    ejecutor = obtener_ejecutor_ia()
+    with _trabajos_ia_lock:
+        futuro = _trabajos_ia.get(job_id)
+        if futuro is not None and not futuro.done():
+            return False
+        # Los trabajos terminados ya dejaron su resultado en la caché o su fallo en _fallos_ia
+        for clave in [c for c, futuro in _trabajos_ia.items() if futuro.done()]:
+            del _trabajos_ia[clave]
+        ahora = time.monotonic()
+        for clave in [c for c, (momento, _) in _fallos_ia.items() if ahora - momento > IA_FALLOS_TTL]:
+            del _fallos_ia[clave]
+        if len(_trabajos_ia) >= IA_MAX_PENDIENTES:
+            raise RuntimeError('Hay demasiados análisis en proceso. Intenta de nuevo en unos momentos.')
+    # Un nuevo intento descarta el fallo anterior
+    _descartar_fallo_ia(job_id)
+    with _trabajos_ia_lock:
+        if job_id in _trabajos_ia:
+            return False
+        _trabajos_ia[job_id] = ejecutor.submit(_ejecutar_trabajo_ia, job_id, funcion, *args)
+    return True
+
+def _ejecutar_trabajo_ia(job_id, funcion, *args):
+    """Ejecuta el trabajo y, si falla, registra el error antes de propagarlo."""
+    try:
+        return funcion(*args)
+    except Exception as e:
+        _registrar_fallo_ia(job_id, e)
+        raise
+
+def _ruta_fallo_ia(job_id):
+    # Extensión distinta de .json para que no cuente en la expulsión de la caché
+    return os.path.join(IA_CACHE_DIR, f"{job_id}.fallo")
+
+def _registrar_fallo_ia(job_id, error):
+    with _trabajos_ia_lock:
+        _fallos_ia[job_id] = (time.monotonic(), error)
+    try:
+        os.makedirs(IA_CACHE_DIR, exist_ok=True)
+        ruta = _ruta_fallo_ia(job_id)
+        temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporal, 'w', encoding='utf-8') as f:
+            json.dump({'creado': time.time(), 'error': str(error)}, f, ensure_ascii=False)
+        os.replace(temporal, ruta)
+    except OSError as e:
+        print(f"Error al guardar el fallo del trabajo de IA {job_id}: {e}")
+
+def _leer_fallo_ia(job_id):
+    """Excepción con la que falló el trabajo (de este u otro worker) o None si no falló o ya expiró."""
+    with _trabajos_ia_lock:
+        fallo = _fallos_ia.get(job_id)
+    if fallo is not None and time.monotonic() - fallo[0] <= IA_FALLOS_TTL:
+        return fallo[1]
+
+    ruta = _ruta_fallo_ia(job_id)
+    try:
+        with open(ruta, 'r', encoding='utf-8') as f:
+            entrada = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - entrada.get('creado', 0) > IA_FALLOS_TTL:
+        try:
+            os.remove(ruta)
+        except OSError:
+            pass
+        return None
+    return RuntimeError(entrada.get('error') or 'El análisis de IA falló.')
+
+def _descartar_fallo_ia(job_id):
+    with _trabajos_ia_lock:
+        _fallos_ia.pop(job_id, None)
+    try:
+        os.remove(_ruta_fallo_ia(job_id))
+    except OSError:
+        pass
+
+# Generaciones en curso por llave de caché. El trabajo del pool que llama al modelo
+# para una llave (suelto, transmitido, combinado o precalentamiento) la reserva; quien
+# llega después espera esa generación en lugar de repetir la llamada, y una
+# transmisión lee los fragmentos a medida que el trabajo los recibe. Solo reservan
+# trabajos que ya están ejecutándose, así nadie espera a un trabajo aún en la cola.
+
+_generaciones_ia = {}
+_cambio_generaciones_ia = threading.Condition(_trabajos_ia_lock)
+
+class _GeneracionIA:
+    """Fragmentos recibidos de una generación en curso y su final (con error o sin él)."""
+
+    def __init__(self):
+        self.partes = []
+        self.terminada = False
+        self.error = None
+        self.condicion = threading.Condition()
+
+    def agregar(self, fragmento):
+        with self.condicion:
+            self.partes.append(fragmento)
+            self.condicion.notify_all()
+
+    def terminar(self, error=None):
+        with self.condicion:
+            self.terminada = True
+            self.error = error
+            self.condicion.notify_all()
+
+    def esperar(self):
+        with self.condicion:
+            self.condicion.wait_for(lambda: self.terminada)
+
+    def fragmentos(self):
+        """Genera los fragmentos a medida que llegan; al final lanza el error si lo hubo."""
+        leidos = 0
+        while True:
+            with self.condicion:
+                self.condicion.wait_for(lambda: self.terminada or len(self.partes) > leidos)
+                nuevos = self.partes[leidos:]
+                terminada = self.terminada
+            leidos += len(nuevos)
+            yield from nuevos
+            if terminada:
+                if self.error is not None:
+                    raise self.error
+                return
+
+def _reservar_generacion_ia(clave):
+    """(generacion, propia): la generación en curso de la llave, o una nueva a cargo de quien llama."""
+    with _trabajos_ia_lock:
+        generacion = _generaciones_ia.get(clave)
+        if generacion is not None:
+            return generacion, False
+        generacion = _generaciones_ia[clave] = _GeneracionIA()
+        _cambio_generaciones_ia.notify_all()
+        return generacion, True
+
+def _liberar_generacion_ia(clave, generacion, error=None):
+    with _trabajos_ia_lock:
+        if _generaciones_ia.get(clave) is generacion:
+            del _generaciones_ia[clave]
+    generacion.terminar(error)
+
+def transmitir_analisis_ia(prompt, uso='analisis'):
+    """
+    Fragmentos de un análisis para respuesta_sse. La llamada al modelo se hace en el
+    pool de IA bajo el mismo job_id que encolar_analisis_ia: una respuesta en caché se
+    entrega en un fragmento y, si la llave ya se está generando (otra transmisión, un
+    trabajo encolado o el precalentamiento), se espera esa generación sin volver a
+    llamar al modelo.
+    """
+    clave = clave_cache_ia(prompt, modelos_para(uso)[0])
+    while True:
+        texto = leer_cache_ia(clave)
+        if texto is not None:
+            yield texto
+            return
+
+        with _trabajos_ia_lock:
+            generacion = _generaciones_ia.get(clave)
+        if generacion is None:
+            if ia_en_pausa(uso):
+                raise IANoDisponibleError('El servicio de IA no está disponible en este momento. Intenta de nuevo en unos minutos.')
+            _encolar_trabajo_ia(clave, generar_analisis_ia, prompt, uso, True)
+            # Se espera a que el trabajo (este u otro ya encolado con el mismo id)
+            # empiece a generar, o a que termine sin necesitarlo
+            with _trabajos_ia_lock:
+                futuro = _trabajos_ia.get(clave)
+                while not _cambio_generaciones_ia.wait_for(
+                        lambda: clave in _generaciones_ia or futuro is None or futuro.done(), timeout=0.5):
+                    pass
+                generacion = _generaciones_ia.get(clave)
+            if generacion is None:
+                if futuro is not None:
+                    futuro.result()  # propaga el error del trabajo
+                texto = leer_cache_ia(clave)
+                if texto is None:
+                    raise RuntimeError('El análisis de IA falló.')
+                yield texto
+                return
+
+        enviados = 0
+        for fragmento in generacion.fragmentos():
+            enviados += 1
+            yield fragmento
+        if enviados:
+            return
+        # La generación se soltó sin texto (p. ej. una sección que el combinado no
+        # devolvió): se vuelve a revisar la caché y, si hace falta, se genera aquí
+
+def estado_analisis_ia(job_id):
+    """
+    Estado de un trabajo: {'estado': 'pendiente'|'listo'|'error', 'html'|'secciones'|'error': ...}
+    ('secciones' para los trabajos de encolar_analisis_combinado).
+    Un id que este proceso no conoce, que no está en caché y sin fallo registrado se
+    reporta como pendiente, porque puede estar ejecutándose en otro worker.
+    """
+    with _trabajos_ia_lock:
+        futuro = _trabajos_ia.get(job_id)
+        if futuro is not None and futuro.done():
+            del _trabajos_ia[job_id]
+
+    if futuro is not None:
+        if not futuro.done():
+            return {'estado': 'pendiente'}
+        error = futuro.exception()
+        if error is not None:
+            print(f"Error en trabajo de IA {job_id}: {error}")
+            return {'estado': 'error', 'error': str(error)}
+        resultado = futuro.result()
+        if isinstance(resultado, dict):
+            return {'estado': 'listo', 'secciones': resultado}
+        return {'estado': 'listo', 'html': resultado}
+
+    texto = leer_cache_ia(job_id)
+    if texto is not None:
+        return {'estado': 'listo', 'html': markdown(texto)}
+    secciones = _secciones_combinado_ia(job_id)
+    if secciones is not None:
+        return {'estado': 'listo', 'secciones': secciones}
+    error = _leer_fallo_ia(job_id)
+    if error is not None:
+        return {'estado': 'error', 'error': str(error)}
+    return {'estado': 'pendiente'}
+
+# --- Funciones para análisis con IA (Gemini) ---
+
+def construir_prompt_vertical(report_data, anio_seleccionado):
+    """Prompt del análisis vertical a partir de los totales del reporte."""
+    # Extraer datos clave
+    totales = report_data.get('Totales', {})
+    total_activo = totales.get('Total Activo', 0)
+    total_pasivo = totales.get('Total Pasivo', 0)
+    total_patrimonio = totales.get('Total Patrimonio', 0)
+    ingresos = totales.get('Ingreso', 0)
+    costos = totales.get('Costo', 0)
+    gastos = totales.get('Gasto', 0)
+    utilidad_bruta = totales.get('Utilidad Bruta', 0)
+    utilidad_operativa = totales.get('Utilidad Operativa', 0)
+    utilidad_neta = totales.get('Utilidad Neta', 0)
+    
+    # Calcular ratios básicos para contexto
+    razon_pasivo_patrimonio = (total_pasivo / total_patrimonio) if total_patrimonio > 0 else 0
+    margen_neto = (utilidad_neta / ingresos * 100) if ingresos > 0 else 0
+    
+    # Prompt conciso y estructurado
+    prompt = f"""Como analista financiero, proporciona un resumen ejecutivo breve (máximo 4 puntos clave) del análisis vertical para el año {anio_seleccionado}.
+
+Datos principales del Balance General:
+- Total Activo: C${total_activo:,.2f}
+- Total Pasivo: C${total_pasivo:,.2f}
+- Total Patrimonio: C${total_patrimonio:,.2f}
+- Razón Pasivo/Patrimonio: {razon_pasivo_patrimonio:.2f}
+
+Datos principales del Estado de Resultados:
+- Ingresos: C${ingresos:,.2f}
+- Costos: C${costos:,.2f}
+- Gastos: C${gastos:,.2f}
+- Utilidad Bruta: C${utilidad_bruta:,.2f}
+- Utilidad Operativa: C${utilidad_operativa:,.2f}
+- Utilidad Neta: C${utilidad_neta:,.2f}
+- Margen Neto: {margen_neto:.1f}%
+
+Enfoca tu análisis en:
+1. Estructura de capital (relación pasivo/patrimonio y su significado)
+2. Rentabilidad (margen neto y eficiencia operativa)
+3. Principales fortalezas identificadas en la estructura financiera
+4. Recomendación clave basada en los datos presentados
+
+Sé directo, específico y usa las cifras proporcionadas. Máximo 80 palabras."""
+    return prompt
+
+def analizar_con_gemini(report_data, anio_seleccionado):
+    """Genera un análisis financiero pequeño y enfocado usando Gemini"""
+    try:
+        prompt = construir_prompt_vertical(report_data, anio_seleccionado)
+        return generar_analisis_ia(prompt)
+    except Exception as e:
+        print(f"Error al llamar a la API de Gemini: {e}")
+        import traceback
+        traceback.print_exc()
+        return f"<p><strong>Error al generar el análisis:</strong> {str(e)}</p>"
+
+def construir_prompt_horizontal(report_data_base, report_data_analisis, periodo_base, periodo_analisis):
+    """Prompt del análisis horizontal entre dos períodos."""
+    # Obtener totales de ambos períodos
+    totales_base = report_data_base.get('Totales', {})
+    totales_analisis = report_data_analisis.get('Totales', {})
+    
+    # Calcular variaciones principales
+    activo_base = totales_base.get('Total Activo', 0)
+    activo_analisis = totales_analisis.get('Total Activo', 0)
+    activo_var = activo_analisis - activo_base
+    activo_var_pct = (activo_var / activo_base * 100) if activo_base > 0 else 0
+    
+    pasivo_base = totales_base.get('Total Pasivo', 0)
+    pasivo_analisis = totales_analisis.get('Total Pasivo', 0)
+    pasivo_var = pasivo_analisis - pasivo_base
+    pasivo_var_pct = (pasivo_var / pasivo_base * 100) if pasivo_base > 0 else 0
+    
+    patrimonio_base = totales_base.get('Total Patrimonio', 0)
+    patrimonio_analisis = totales_analisis.get('Total Patrimonio', 0)
+    patrimonio_var = patrimonio_analisis - patrimonio_base
+    patrimonio_var_pct = (patrimonio_var / patrimonio_base * 100) if patrimonio_base > 0 else 0
+    
+    ingresos_base = totales_base.get('Ingreso', 0)
+    ingresos_analisis = totales_analisis.get('Ingreso', 0)
+    ingresos_var = ingresos_analisis - ingresos_base
+    ingresos_var_pct = (ingresos_var / ingresos_base * 100) if ingresos_base > 0 else 0
+    
+    utilidad_base = totales_base.get('Utilidad Neta', 0)
+    utilidad_analisis = totales_analisis.get('Utilidad Neta', 0)
+    utilidad_var = utilidad_analisis - utilidad_base
+    utilidad_var_pct = (utilidad_var / utilidad_base * 100) if utilidad_base != 0 else (100 if utilidad_var > 0 else -100 if utilidad_var < 0 else 0)
+    
+    prompt = f"""Como analista financiero, proporciona un análisis horizontal breve (máximo 4 puntos clave) comparando el período {periodo_base} vs {periodo_analisis}.
+
+Variaciones en Balance General:
+- Activo Total: {activo_var_pct:+.1f}% (C${activo_var:+,.2f}) - De C${activo_base:,.2f} a C${activo_analisis:,.2f}
+- Pasivo Total: {pasivo_var_pct:+.1f}% (C${pasivo_var:+,.2f}) - De C${pasivo_base:,.2f} a C${pasivo_analisis:,.2f}
+- Patrimonio: {patrimonio_var_pct:+.1f}% (C${patrimonio_var:+,.2f}) - De C${patrimonio_base:,.2f} a C${patrimonio_analisis:,.2f}
 
 Variaciones en Estado de Resultados:
 - Ingresos: {ingresos_var_pct:+.1f}% (C${ingresos_var:+,.2f}) - De C${ingresos_base:,.2f} a C${ingresos_analisis:,.2f}
@@ -960,41 +2589,36 @@ Enfoca tu análisis en:
 4. Conclusión práctica y recomendación clave
 
 Sé directo, específico y usa las cifras proporcionadas. Máximo 80 palabras."""
+    return prompt
 
-        response = model.generate_content(prompt)
-        analisis_texto = response.text
-        
-        # Convertir markdown a HTML
-        analisis_html = markdown(analisis_texto)
-        
-        return analisis_html
+def analizar_horizontal_ia(report_data_base, report_data_analisis, periodo_base, periodo_analisis):
+    """Análisis horizontal pequeño y enfocado"""
+    try:
+        prompt = construir_prompt_horizontal(report_data_base, report_data_analisis, periodo_base, periodo_analisis)
+        return generar_analisis_ia(prompt)
     except Exception as e:
         print(f"Error en análisis horizontal IA: {e}")
         import traceback
         traceback.print_exc()
         return f"<p><strong>Error al generar el análisis:</strong> {str(e)}</p>"
 
-def analizar_ratios_ia(ratios_data):
-    """Análisis de ratios pequeño y enfocado"""
-    try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        model = genai.GenerativeModel('gemini-2.0-flash-lite')
-        
-        # Extraer ratios clave de la estructura correcta
-        razon_circulante = ratios_data.get('Liquidez', {}).get('Razón Circulante', {}).get('valor', 0)
-        razon_rapida = ratios_data.get('Liquidez', {}).get('Razón Rápida', {}).get('valor', 0)
-        margen_bruto = ratios_data.get('Rentabilidad', {}).get('Margen de Utilidad Bruta (MUB)', {}).get('valor', 0)
-        margen_neto = ratios_data.get('Rentabilidad', {}).get('Margen de Utilidad Neta', {}).get('valor', 0)
-        roa = ratios_data.get('Rentabilidad', {}).get('Rentabilidad sobre el Activo (ROA)', {}).get('valor', 0)
-        razon_endeudamiento = ratios_data.get('Endeudamiento', {}).get('Razón de Endeudamiento', {}).get('valor', 0)
-        razon_endeudamiento_pct = ratios_data.get('Endeudamiento', {}).get('Razón de Endeudamiento', {}).get('porcentaje', 0)
-        
-        # Obtener estados para contexto
-        estado_liquidez = ratios_data.get('Liquidez', {}).get('Razón Circulante', {}).get('estado', 'normal')
-        estado_rentabilidad = ratios_data.get('Rentabilidad', {}).get('Margen de Utilidad Neta', {}).get('estado', 'normal')
-        estado_endeudamiento = ratios_data.get('Endeudamiento', {}).get('Razón de Endeudamiento', {}).get('estado', 'normal')
-        
-        prompt = f"""Como analista financiero, proporciona un análisis ejecutivo breve (máximo 4 puntos clave) de los ratios financieros calculados.
+def construir_prompt_ratios(ratios_data):
+    """Prompt del análisis de ratios financieros."""
+    # Extraer ratios clave de la estructura correcta
+    razon_circulante = ratios_data.get('Liquidez', {}).get('Razón Circulante', {}).get('valor', 0)
+    razon_rapida = ratios_data.get('Liquidez', {}).get('Razón Rápida', {}).get('valor', 0)
+    margen_bruto = ratios_data.get('Rentabilidad', {}).get('Margen de Utilidad Bruta (MUB)', {}).get('valor', 0)
+    margen_neto = ratios_data.get('Rentabilidad', {}).get('Margen de Utilidad Neta', {}).get('valor', 0)
+    roa = ratios_data.get('Rentabilidad', {}).get('Rentabilidad sobre el Activo (ROA)', {}).get('valor', 0)
+    razon_endeudamiento = ratios_data.get('Endeudamiento', {}).get('Razón de Endeudamiento', {}).get('valor', 0)
+    razon_endeudamiento_pct = ratios_data.get('Endeudamiento', {}).get('Razón de Endeudamiento', {}).get('porcentaje', 0)
+    
+    # Obtener estados para contexto
+    estado_liquidez = ratios_data.get('Liquidez', {}).get('Razón Circulante', {}).get('estado', 'normal')
+    estado_rentabilidad = ratios_data.get('Rentabilidad', {}).get('Margen de Utilidad Neta', {}).get('estado', 'normal')
+    estado_endeudamiento = ratios_data.get('Endeudamiento', {}).get('Razón de Endeudamiento', {}).get('estado', 'normal')
+    
+    prompt = f"""Como analista financiero, proporciona un análisis ejecutivo breve (máximo 4 puntos clave) de los ratios financieros calculados.
 
 Datos principales de ratios:
 - Razón Circulante: {razon_circulante:.2f} (Estado: {estado_liquidez})
@@ -1011,56 +2635,51 @@ Enfoca tu análisis en:
 4. Recomendación clave basada en los ratios calculados
 
 Sé directo, específico y usa las cifras proporcionadas. Máximo 80 palabras."""
+    return prompt
 
-        response = model.generate_content(prompt)
-        analisis_texto = response.text
-        
-        # Convertir markdown a HTML
-        analisis_html = markdown(analisis_texto)
-        
-        return analisis_html
+def analizar_ratios_ia(ratios_data):
+    """Análisis de ratios pequeño y enfocado"""
+    try:
+        prompt = construir_prompt_ratios(ratios_data)
+        return generar_analisis_ia(prompt)
     except Exception as e:
         print(f"Error en análisis ratios IA: {e}")
         import traceback
         traceback.print_exc()
         return f"<p><strong>Error al generar el análisis:</strong> {str(e)}</p>"
 
-def analizar_origen_aplicacion_ia(origen_aplicacion_data):
-    """Análisis de origen y aplicación pequeño y enfocado"""
-    try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        model = genai.GenerativeModel('gemini-2.0-flash-lite')
-        
-        # Obtener totales de forma segura
-        totales = origen_aplicacion_data.get('Totales', {})
-        total_origen = totales.get('Origen', {}).get('Total', 0)
-        total_aplicacion = totales.get('Aplicacion', {}).get('Total', 0)
-        diferencia = total_origen - total_aplicacion
-        
-        # Identificar principales orígenes y aplicaciones
-        principales_origenes = []
-        origen_dict = origen_aplicacion_data.get('Origen', {})
-        for subtipo, cuentas in origen_dict.items():
-            if isinstance(cuentas, list):
-                for cuenta in sorted(cuentas, key=lambda x: abs(x.get('variacion', 0)), reverse=True)[:3]:
-                    nombre = cuenta.get('nombre', 'Sin nombre')
-                    variacion = cuenta.get('variacion', 0)
-                    principales_origenes.append(f"- {nombre}: C${variacion:,.2f}")
-        
-        principales_aplicaciones = []
-        aplicacion_dict = origen_aplicacion_data.get('Aplicacion', {})
-        for subtipo, cuentas in aplicacion_dict.items():
-            if isinstance(cuentas, list):
-                for cuenta in sorted(cuentas, key=lambda x: abs(x.get('variacion', 0)), reverse=True)[:3]:
-                    nombre = cuenta.get('nombre', 'Sin nombre')
-                    variacion = cuenta.get('variacion', 0)
-                    principales_aplicaciones.append(f"- {nombre}: C${variacion:,.2f}")
-        
-        # Limitar a los 3 principales
-        principales_origenes = principales_origenes[:3]
-        principales_aplicaciones = principales_aplicaciones[:3]
-        
-        prompt = f"""Como analista financiero, proporciona un análisis breve (máximo 4 puntos clave) del Origen y Aplicación de Fondos.
+def construir_prompt_origen_aplicacion(origen_aplicacion_data):
+    """Prompt del análisis de origen y aplicación de fondos."""
+    # Obtener totales de forma segura
+    totales = origen_aplicacion_data.get('Totales', {})
+    total_origen = totales.get('Origen', {}).get('Total', 0)
+    total_aplicacion = totales.get('Aplicacion', {}).get('Total', 0)
+    diferencia = total_origen - total_aplicacion
+    
+    # Identificar principales orígenes y aplicaciones
+    principales_origenes = []
+    origen_dict = origen_aplicacion_data.get('Origen', {})
+    for subtipo, cuentas in origen_dict.items():
+        if isinstance(cuentas, list):
+            for cuenta in sorted(cuentas, key=lambda x: abs(x.get('variacion', 0)), reverse=True)[:3]:
+                nombre = cuenta.get('nombre', 'Sin nombre')
+                variacion = cuenta.get('variacion', 0)
+                principales_origenes.append(f"- {nombre}: C${variacion:,.2f}")
+    
+    principales_aplicaciones = []
+    aplicacion_dict = origen_aplicacion_data.get('Aplicacion', {})
+    for subtipo, cuentas in aplicacion_dict.items():
+        if isinstance(cuentas, list):
+            for cuenta in sorted(cuentas, key=lambda x: abs(x.get('variacion', 0)), reverse=True)[:3]:
+                nombre = cuenta.get('nombre', 'Sin nombre')
+                variacion = cuenta.get('variacion', 0)
+                principales_aplicaciones.append(f"- {nombre}: C${variacion:,.2f}")
+    
+    # Limitar a los 3 principales
+    principales_origenes = principales_origenes[:3]
+    principales_aplicaciones = principales_aplicaciones[:3]
+    
+    prompt = f"""Como analista financiero, proporciona un análisis breve (máximo 4 puntos clave) del Origen y Aplicación de Fondos.
 
 Resumen de flujo de fondos:
 - Total Origen de Fondos: C${total_origen:,.2f}
@@ -1080,52 +2699,47 @@ Enfoca tu análisis en:
 4. Conclusión práctica sobre la gestión del flujo de fondos
 
 Sé directo, específico y usa las cifras proporcionadas. Máximo 80 palabras."""
+    return prompt
 
-        response = model.generate_content(prompt)
-        analisis_texto = response.text
-        
-        # Convertir markdown a HTML
-        analisis_html = markdown(analisis_texto)
-        
-        return analisis_html
+def analizar_origen_aplicacion_ia(origen_aplicacion_data):
+    """Análisis de origen y aplicación pequeño y enfocado"""
+    try:
+        prompt = construir_prompt_origen_aplicacion(origen_aplicacion_data)
+        return generar_analisis_ia(prompt)
     except Exception as e:
         print(f"Error en análisis origen/aplicación IA: {e}")
         import traceback
         traceback.print_exc()
         return f"<p><strong>Error al generar el análisis:</strong> {str(e)}</p>"
 
-def analizar_flujo_efectivo_ia(flujo_data, periodo_inicio, periodo_fin):
-    """Análisis de flujo de efectivo pequeño y enfocado"""
-    try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        model = genai.GenerativeModel('gemini-2.0-flash-lite')
-        
-        # Extraer totales
-        fne_operacion = flujo_data.get('Operacion', {}).get('total', 0)
-        fne_inversion = flujo_data.get('Inversion', {}).get('total', 0)
-        fne_financiamiento = flujo_data.get('Financiamiento', {}).get('total', 0)
-        flujo_neto_total = flujo_data.get('Validacion', {}).get('flujo_neto', 0)
-        
-        # Identificar principales movimientos (top 2 de cada sección)
-        top_operacion = []
-        detalles_op = flujo_data.get('Operacion', {}).get('detalles', [])
-        if detalles_op:
-            for item in sorted(detalles_op, key=lambda x: abs(x.get('monto', 0)), reverse=True)[:2]:
-                top_operacion.append(f"- {item.get('concepto')}: C${item.get('monto', 0):,.2f}")
-                
-        top_inversion = []
-        detalles_inv = flujo_data.get('Inversion', {}).get('detalles', [])
-        if detalles_inv:
-            for item in sorted(detalles_inv, key=lambda x: abs(x.get('monto', 0)), reverse=True)[:2]:
-                top_inversion.append(f"- {item.get('concepto')}: C${item.get('monto', 0):,.2f}")
-                
-        top_financiamiento = []
-        detalles_fin = flujo_data.get('Financiamiento', {}).get('detalles', [])
-        if detalles_fin:
-            for item in sorted(detalles_fin, key=lambda x: abs(x.get('monto', 0)), reverse=True)[:2]:
-                top_financiamiento.append(f"- {item.get('concepto')}: C${item.get('monto', 0):,.2f}")
-        
-        prompt = f"""Como analista financiero, proporciona un análisis ejecutivo breve (máximo 4 puntos clave) del Estado de Flujo de Efectivo (Método Indirecto) para el período {periodo_inicio}-{periodo_fin}.
+def construir_prompt_flujo_efectivo(flujo_data, periodo_inicio, periodo_fin):
+    """Prompt del análisis del estado de flujo de efectivo."""
+    # Extraer totales
+    fne_operacion = flujo_data.get('Operacion', {}).get('total', 0)
+    fne_inversion = flujo_data.get('Inversion', {}).get('total', 0)
+    fne_financiamiento = flujo_data.get('Financiamiento', {}).get('total', 0)
+    flujo_neto_total = flujo_data.get('Validacion', {}).get('flujo_neto', 0)
+    
+    # Identificar principales movimientos (top 2 de cada sección)
+    top_operacion = []
+    detalles_op = flujo_data.get('Operacion', {}).get('detalles', [])
+    if detalles_op:
+        for item in sorted(detalles_op, key=lambda x: abs(x.get('monto', 0)), reverse=True)[:2]:
+            top_operacion.append(f"- {item.get('concepto')}: C${item.get('monto', 0):,.2f}")
+            
+    top_inversion = []
+    detalles_inv = flujo_data.get('Inversion', {}).get('detalles', [])
+    if detalles_inv:
+        for item in sorted(detalles_inv, key=lambda x: abs(x.get('monto', 0)), reverse=True)[:2]:
+            top_inversion.append(f"- {item.get('concepto')}: C${item.get('monto', 0):,.2f}")
+            
+    top_financiamiento = []
+    detalles_fin = flujo_data.get('Financiamiento', {}).get('detalles', [])
+    if detalles_fin:
+        for item in sorted(detalles_fin, key=lambda x: abs(x.get('monto', 0)), reverse=True)[:2]:
+            top_financiamiento.append(f"- {item.get('concepto')}: C${item.get('monto', 0):,.2f}")
+    
+    prompt = f"""Como analista financiero, proporciona un análisis ejecutivo breve (máximo 4 puntos clave) del Estado de Flujo de Efectivo (Método Indirecto) para el período {periodo_inicio}-{periodo_fin}.
 
 Resumen de Flujos:
 - Actividades de Operación: C${fne_operacion:,.2f}
@@ -1136,293 +2750,593 @@ Resumen de Flujos:
   {chr(10).join(top_financiamiento)}
 - Flujo Neto Total: C${flujo_neto_total:,.2f}
 
-Enfoca tu análisis en:
-1. Capacidad de generación de efectivo operativo (calidad de las utilidades)
-2. Estrategia de inversión y crecimiento (o desinversión)
-3. Política de financiamiento (dependencia de deuda vs capital)
-4. Conclusión sobre la sostenibilidad de la liquidez
+Enfoca tu análisis en:
+1. Capacidad de generación de efectivo operativo (calidad de las utilidades)
+2. Estrategia de inversión y crecimiento (o desinversión)
+3. Política de financiamiento (dependencia de deuda vs capital)
+4. Conclusión sobre la sostenibilidad de la liquidez
+
+Sé directo, específico y usa las cifras proporcionadas. Máximo 80 palabras."""
+    return prompt
+
+def analizar_flujo_efectivo_ia(flujo_data, periodo_inicio, periodo_fin):
+    """Análisis de flujo de efectivo pequeño y enfocado"""
+    try:
+        prompt = construir_prompt_flujo_efectivo(flujo_data, periodo_inicio, periodo_fin)
+        return generar_analisis_ia(prompt)
+    except Exception as e:
+        print(f"Error en análisis flujo efectivo IA: {e}")
+        import traceback
+        traceback.print_exc()
+        return f"<p><strong>Error al generar el análisis:</strong> {str(e)}</p>"
+
+def construir_prompt_dupont(dupont_data, anio_actual):
+    """Prompt del análisis DuPont (resultado de generar_analisis_dupont['analisis_dupont'])."""
+    anio_anterior = anio_actual - 1
+    actual = dupont_data.get(str(anio_actual), {})
+    anterior = dupont_data.get(str(anio_anterior), {})
+    variaciones = dupont_data.get('variaciones', {})
+    
+    prompt = f"""Como analista financiero, proporciona un análisis ejecutivo breve (máximo 4 puntos clave) del análisis DuPont de 3 factores.
+
+Año {anio_actual}:
+- ROE: {actual.get('roe', 0) * 100:.2f}%
+- Margen Neto: {actual.get('margen_neto', 0) * 100:.2f}%
+- Rotación de Activos: {actual.get('rotacion_activos', 0):.2f}
+- Multiplicador de Capital: {actual.get('multiplicador', 0):.2f}
+
+Año {anio_anterior}:
+- ROE: {anterior.get('roe', 0) * 100:.2f}%
+- Margen Neto: {anterior.get('margen_neto', 0) * 100:.2f}%
+- Rotación de Activos: {anterior.get('rotacion_activos', 0):.2f}
+- Multiplicador de Capital: {anterior.get('multiplicador', 0):.2f}
+
+Cambio en ROE: {variaciones.get('cambio_roe', 'N/A')} ({variaciones.get('factor_determinante', 'Sin datos')})
+
+Enfoca tu análisis en:
+1. Qué factor explica el ROE actual (margen, rotación o apalancamiento)
+2. Cambio del ROE respecto al año anterior y su causa
+3. Riesgo asociado al nivel de apalancamiento
+4. Recomendación clave para mejorar el ROE
+
+Sé directo, específico y usa las cifras proporcionadas. Máximo 80 palabras."""
+    return prompt
+
+# --- Análisis combinados ---
+# Una página con varios paneles de IA (ratios + DuPont, horizontal + origen y
+# aplicación) resuelve todos en una sola llamada: las tareas van en un prompt con un
+# marcador por sección y la respuesta se separa y se guarda en la caché de cada
+# análisis individual, de modo que los endpoints sueltos también la aprovechan.
+
+_PATRON_SECCION_IA = re.compile(r'^\s*\[\[SECCION:([\w-]+)\]\]\s*$', re.MULTILINE)
+
+def construir_prompt_combinado(prompts):
+    """Une los prompts {tipo: prompt} en uno solo con un marcador [[SECCION:tipo]] por tarea."""
+    tareas = [
+        f"Tarea {i} — responde debajo de la línea [[SECCION:{tipo}]]:\n{prompt}"
+        for i, (tipo, prompt) in enumerate(prompts.items(), start=1)
+    ]
+    return (
+        f"Vas a responder {len(prompts)} análisis financieros independientes en una sola respuesta.\n"
+        "Para cada tarea escribe primero, en una línea propia, su marcador exacto (por ejemplo "
+        "[[SECCION:ratios]]) y debajo la respuesta siguiendo las instrucciones de esa tarea. "
+        "No escribas texto fuera de las secciones.\n\n"
+        + "\n\n".join(tareas)
+    )
+
+def dividir_respuesta_combinada(texto, tipos):
+    """Separa la respuesta combinada en {tipo: texto}; omite secciones ausentes o vacías."""
+    secciones = {}
+    marcas = list(_PATRON_SECCION_IA.finditer(texto))
+    for marca, siguiente in zip(marcas, marcas[1:] + [None]):
+        tipo = marca.group(1)
+        fin = siguiente.start() if siguiente else len(texto)
+        contenido = texto[marca.end():fin].strip()
+        if tipo in tipos and contenido and tipo not in secciones:
+            secciones[tipo] = contenido
+    return secciones
+
+def generar_analisis_combinado(prompts, uso='analisis'):
+    """
+    Genera {tipo: html} para varios prompts con una sola llamada al modelo. Los
+    análisis ya en caché no se vuelven a pedir; una sección que el modelo no devolvió
+    se genera por separado.
+    """
+    modelo_principal = modelos_para(uso)[0]
+    claves = {tipo: clave_cache_ia(prompt, modelo_principal) for tipo, prompt in prompts.items()}
+    textos = {}
+    for tipo, clave in claves.items():
+        texto = leer_cache_ia(clave)
+        if texto is not None:
+            textos[tipo] = texto
+    pendientes = {tipo: prompt for tipo, prompt in prompts.items() if tipo not in textos}
+
+    # Solo se piden en la llamada combinada las secciones que nadie más está generando;
+    # las demás se esperan abajo en generar_analisis_ia
+    reservas = {}
+    for tipo in pendientes:
+        generacion, propia = _reservar_generacion_ia(claves[tipo])
+        if propia:
+            reservas[tipo] = generacion
+    error = None
+    try:
+        if len(reservas) > 1:
+            combinados = {tipo: pendientes[tipo] for tipo in reservas}
+            respuesta, modelo = generar_texto_ia(construir_prompt_combinado(combinados), uso)
+            for tipo, texto in dividir_respuesta_combinada(respuesta, combinados).items():
+                guardar_cache_ia(claves[tipo], texto, modelo, es_modelo_respaldo(modelo, uso))
+                reservas[tipo].agregar(texto)
+                textos[tipo] = texto
+                del pendientes[tipo]
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        for tipo, generacion in reservas.items():
+            _liberar_generacion_ia(claves[tipo], generacion, error)
+    faltantes = [tipo for tipo in reservas if tipo in pendientes]
+    if len(reservas) > 1 and faltantes:
+        print(f"Respuesta combinada sin las secciones: {', '.join(faltantes)}")
+
+    html = {tipo: markdown(textos[tipo]) for tipo in textos}
+    for tipo, prompt in pendientes.items():
+        html[tipo] = generar_analisis_ia(prompt, uso)
+    return {tipo: html[tipo] for tipo in prompts}
+
+def _clave_combinado_ia(job_id):
+    return f"{job_id}.combinado"
+
+def _secciones_combinado_ia(job_id):
+    """
+    {tipo: html} de un trabajo combinado cuyas secciones ya están todas en caché, o None.
+    Las llaves de cada sección quedan en disco al encolar, así cualquier worker puede
+    responder la consulta de estado.
+    """
+    registro = leer_cache_ia(_clave_combinado_ia(job_id))
+    if registro is None:
+        return None
+    try:
+        claves = json.loads(registro)
+    except ValueError:
+        return None
+    textos = {tipo: leer_cache_ia(clave) for tipo, clave in claves.items()}
+    if any(texto is None for texto in textos.values()):
+        return None
+    return {tipo: markdown(texto) for tipo, texto in textos.items()}
+
+def encolar_analisis_combinado(prompts, uso='analisis'):
+    """
+    Como encolar_analisis_ia para varios prompts: devuelve (job_id, {tipo: html}) si
+    todos están en caché, o (job_id, None) tras encolar un único trabajo combinado,
+    cuyo estado se consulta con estado_analisis_ia(job_id).
+    """
+    modelo_principal = modelos_para(uso)[0]
+    job_id = clave_cache_ia('\n'.join(f"{tipo}:{prompt}" for tipo, prompt in prompts.items()), modelo_principal)
+    textos = {tipo: leer_cache_ia(clave_cache_ia(prompt, modelo_principal)) for tipo, prompt in prompts.items()}
+    if all(texto is not None for texto in textos.values()):
+        return job_id, {tipo: markdown(texto) for tipo, texto in textos.items()}
+
+    # El estado se consulta repitiendo la petición: un trabajo fallido (en cualquier
+    # worker) se reporta una vez y la siguiente consulta vuelve a intentarlo
+    with _trabajos_ia_lock:
+        futuro = _trabajos_ia.get(job_id)
+        if futuro is not None and futuro.done():
+            del _trabajos_ia[job_id]
+    error = _leer_fallo_ia(job_id)
+    if error is not None:
+        _descartar_fallo_ia(job_id)
+        raise error
+
+    if ia_en_pausa(uso):
+        raise IANoDisponibleError('El servicio de IA no está disponible en este momento. Intenta de nuevo en unos minutos.')
+
+    if _encolar_trabajo_ia(job_id, generar_analisis_combinado, prompts, uso):
+        claves = {tipo: clave_cache_ia(prompt, modelo_principal) for tipo, prompt in prompts.items()}
+        guardar_cache_ia(_clave_combinado_ia(job_id), json.dumps(claves), modelo_principal)
+    return job_id, None
+
+# --- Precalentamiento de análisis ---
+# Con IA_PRECALENTAR=1, al guardar los saldos de un año se generan en segundo plano
+# los análisis que más se consultan (vertical, ratios + DuPont y horizontal contra el
+# año anterior) para que la primera visita los encuentre en la caché.
+
+IA_PRECALENTAR = os.getenv('IA_PRECALENTAR', '0').lower() in ('1', 'true', 'si', 'yes')
+
+def precalentar_analisis_ia(anio):
+    """Encola el precalentamiento de los análisis de un año. Devuelve True si se encoló."""
+    if not IA_PRECALENTAR or not ia_disponible():
+        return False
+    try:
+        # La versión del catálogo en el id hace que un nuevo guardado encole otra corrida
+        # aunque la anterior (con los saldos viejos) siga en curso
+        _encolar_trabajo_ia(f"precalentar-{anio}-{obtener_version_catalogo()}", _precalentar_analisis_anio, anio)
+    except RuntimeError as e:
+        print(f"No se pudo precalentar el año {anio}: {e}")
+        return False
+    return True
+
+def _precalentar_analisis_anio(anio):
+    # Los prompts se arman igual que en los endpoints de analysis para compartir llaves
+    try:
+        registro = obtener_periodos()
+        anio_anterior = registro.anterior(anio) if anio in registro else None
+        reportes = get_financial_reports_many([anio, anio_anterior] if anio_anterior else [anio])
+        report_data = reportes.get(anio)
+        if not report_data:
+            return
+
+        ratios_data = calcular_ratios_financieros(report_data, None)
+        ratios_data['anio'] = anio
+        ratios_data['anio_anterior'] = None
+        prompts = {
+            'vertical': construir_prompt_vertical(calcular_porcentajes_verticales(report_data), anio),
+            'ratios': construir_prompt_ratios(ratios_data),
+        }
+        dupont_result = generar_analisis_dupont(anio)
+        if dupont_result.get('exito'):
+            prompts['dupont'] = construir_prompt_dupont(dupont_result['analisis_dupont'], anio)
+        if reportes.get(anio_anterior):
+            prompts['horizontal'] = construir_prompt_horizontal(reportes[anio_anterior], report_data, anio_anterior, anio)
+
+        generar_analisis_combinado(prompts)
+        print(f"Análisis de IA precalentados para {anio}: {', '.join(prompts)}")
+    except Exception as e:
+        print(f"Error al precalentar los análisis de {anio}: {e}")
+
+# --- Chatbot ---
+# Tres piezas para contener el gasto en ráfagas (clases, demos):
+# - Las preguntas de definición ("¿qué es ROE?") se normalizan y su respuesta se
+#   guarda en la caché de IA compartida, sin depender de la conversación.
+# - Cada usuario tiene una ventana con sus últimos turnos (memoria del proceso) que
+#   se agrega al prompt para preguntas de seguimiento.
+# - Un token bucket por usuario limita las llamadas al modelo; las respuestas en
+#   caché no consumen tokens.
+
+CHATBOT_HISTORIAL_TURNOS = int(os.getenv('CHATBOT_HISTORIAL_TURNOS', '4'))
+CHATBOT_CONVERSACION_TTL = int(os.getenv('CHATBOT_CONVERSACION_TTL', '1800'))  # segundos de inactividad
+CHATBOT_RAFAGA = int(os.getenv('CHATBOT_RAFAGA', '5'))                        # consultas seguidas permitidas
+CHATBOT_POR_MINUTO = float(os.getenv('CHATBOT_POR_MINUTO', '6'))              # ritmo sostenido
+
+_PATRON_DEFINICION = re.compile(
+    r'^(que es|que son|que significa|que significan|que quiere decir|define|definicion de|'
+    r'concepto de|para que sirve|como se calcula) '
+)
+
+_ARTICULOS = {'el', 'la', 'los', 'las', 'un', 'una', 'unos', 'unas', 'lo'}
+
+_conversaciones_chatbot = {}
+_limites_chatbot = {}
+_chatbot_lock = threading.Lock()
+
+def normalizar_pregunta(mensaje):
+    """Minúsculas, sin tildes, sin signos de puntuación y con espacios simples."""
+    texto = unicodedata.normalize('NFKD', mensaje.lower())
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    texto = re.sub(r'[^\w\s]', ' ', texto)
+    return ' '.join(texto.split())
+
+def clave_pregunta_chatbot(mensaje):
+    """Llave de caché para preguntas de definición; None si la pregunta no lo es."""
+    pregunta = normalizar_pregunta(mensaje)
+    if not _PATRON_DEFINICION.match(pregunta + ' ') or len(pregunta.split()) > 8:
+        return None
+    # "qué es el ROE" y "qué es ROE" comparten respuesta
+    pregunta = ' '.join(p for p in pregunta.split() if p not in _ARTICULOS)
+    return clave_cache_ia(f"chatbot-definicion\n{pregunta}", modelos_para('chatbot')[0])
+
+def construir_prompt_chatbot(mensaje, historial=()):
+    """Prompt del chatbot; historial es una lista de (pregunta, respuesta) recientes."""
+    contexto = ''
+    if historial:
+        turnos = '\n'.join(f"Usuario: {pregunta[:500]}\nAsistente: {respuesta[:500]}" for pregunta, respuesta in historial)
+        contexto = f"\nConversación reciente (úsala solo si la pregunta hace referencia a ella):\n{turnos}\n"
+    
+    prompt = f"""Eres un asistente financiero. Responde de forma PRECISA y CONCISA.
+{contexto}
+Pregunta del usuario: {mensaje}
+
+REGLAS ESTRICTAS:
+1. Responde DIRECTAMENTE la pregunta, sin introducciones largas
+2. Máximo 80 palabras - sé breve y al grano
+3. Si es sobre un término financiero, da la definición corta (1-2 oraciones)
+4. Si es sobre números/análisis, explica QUÉ SIGNIFICA ese número específico
+5. NO te extiendas, NO repitas información, NO agregues contexto innecesario
+6. Si no sabes algo, di simplemente "No tengo esa información"
+
+Responde SOLO lo que pregunta, de forma directa:"""
+    return prompt
+
+def historial_chatbot(user_id):
+    """Últimos turnos (pregunta, respuesta) del usuario, o [] si la conversación expiró."""
+    with _chatbot_lock:
+        conversacion = _conversaciones_chatbot.get(user_id)
+        if not conversacion:
+            return []
+        if time.monotonic() - conversacion['actividad'] > CHATBOT_CONVERSACION_TTL:
+            del _conversaciones_chatbot[user_id]
+            return []
+        return list(conversacion['turnos'])
+
+def registrar_respuesta_chatbot(user_id, mensaje, respuesta, clave=None, modelo=None):
+    """Agrega el turno a la conversación y, si es una definición nueva, la guarda en caché."""
+    ahora = time.monotonic()
+    with _chatbot_lock:
+        conversacion = _conversaciones_chatbot.get(user_id)
+        if not conversacion:
+            conversacion = {'turnos': deque(maxlen=CHATBOT_HISTORIAL_TURNOS), 'actividad': ahora}
+            _conversaciones_chatbot[user_id] = conversacion
+        conversacion['turnos'].append((mensaje, respuesta))
+        conversacion['actividad'] = ahora
+        # Descartar conversaciones inactivas para que el diccionario no crezca sin límite
+        if len(_conversaciones_chatbot) > 1000:
+            for uid in [u for u, c in _conversaciones_chatbot.items() if ahora - c['actividad'] > CHATBOT_CONVERSACION_TTL]:
+                del _conversaciones_chatbot[uid]
+    if clave and modelo and respuesta:
+        guardar_cache_ia(clave, respuesta, modelo, es_modelo_respaldo(modelo, 'chatbot'))
+
+def transmitir_respuesta_chatbot(user_id, mensaje, prompt, clave=None):
+    """Como transmitir_texto_ia para el chatbot; registra el turno al completar la respuesta."""
+    partes = []
+    for fragmento in transmitir_texto_ia(prompt, 'chatbot', usar_cache=False):
+        partes.append(fragmento)
+        yield fragmento
+    registrar_respuesta_chatbot(user_id, mensaje, ''.join(partes), clave, modelos_para('chatbot')[0])
+
+def consumir_token_chatbot(user_id):
+    """
+    Token bucket por usuario: CHATBOT_RAFAGA consultas seguidas y luego
+    CHATBOT_POR_MINUTO por minuto. Devuelve (permitido, segundos_para_reintentar).
+    """
+    ahora = time.monotonic()
+    por_segundo = CHATBOT_POR_MINUTO / 60.0
+    with _chatbot_lock:
+        tokens, ultima = _limites_chatbot.get(user_id, (float(CHATBOT_RAFAGA), ahora))
+        tokens = min(float(CHATBOT_RAFAGA), tokens + (ahora - ultima) * por_segundo)
+        if tokens < 1:
+            _limites_chatbot[user_id] = (tokens, ahora)
+            return False, math.ceil((1 - tokens) / por_segundo) if por_segundo else 60
+        _limites_chatbot[user_id] = (tokens - 1, ahora)
+    return True, 0
+
+# --- Caché de exportaciones ---
+# Los archivos generados se guardan en memoria con llave (tipo, períodos, versión del
+# catálogo) y se descartan por LRU al pasar EXPORTACIONES_CACHE_BYTES. El ETag es el
+# sha256 del contenido, así una descarga repetida se responde con 304 o desde memoria.
+
+EXPORTACIONES_CACHE_BYTES = int(os.getenv('EXPORTACIONES_CACHE_BYTES', str(32 * 1024 * 1024)))
+
+_cache_exportaciones = OrderedDict()
+_cache_exportaciones_bytes = 0
+
+def leer_cache_exportacion(clave):
+    """Devuelve (contenido, etag, nombre_base) de una exportación en caché, o None."""
+    global _cache_exportaciones_bytes
+    with _cache_reportes_lock:
+        entrada = _cache_exportaciones.get(clave)
+        if not entrada:
+            return None
+        guardado_en, contenido, etag, nombre_base = entrada
+        # Mismo vencimiento que los reportes de los que sale el archivo
+        if REPORTES_CACHE_TTL and time.monotonic() - guardado_en > REPORTES_CACHE_TTL:
+            del _cache_exportaciones[clave]
+            _cache_exportaciones_bytes -= len(contenido)
+            return None
+        _cache_exportaciones.move_to_end(clave)
+        return contenido, etag, nombre_base
+
+def guardar_cache_exportacion(clave, contenido, nombre_base):
+    """Guarda el archivo generado y devuelve (contenido, etag, nombre_base)."""
+    global _cache_exportaciones_bytes
+    etag = hashlib.sha256(contenido).hexdigest()
+    if len(contenido) > EXPORTACIONES_CACHE_BYTES:
+        return contenido, etag, nombre_base
+
+    with _cache_reportes_lock:
+        anterior = _cache_exportaciones.pop(clave, None)
+        if anterior:
+            _cache_exportaciones_bytes -= len(anterior[1])
+        _cache_exportaciones[clave] = (time.monotonic(), contenido, etag, nombre_base)
+        _cache_exportaciones_bytes += len(contenido)
+        while _cache_exportaciones_bytes > EXPORTACIONES_CACHE_BYTES:
+            _, (_, viejo, _, _) = _cache_exportaciones.popitem(last=False)
+            _cache_exportaciones_bytes -= len(viejo)
+    return contenido, etag, nombre_base
+
+# --- Exportación a Excel ---
+# Los exportadores usan libros en modo write-only: cada fila se escribe al disco
+# temporal al agregarla, con su estilo con nombre ya asignado, en lugar de armar la
+# hoja completa en memoria y recorrerla otra vez para darle formato.
+
+def _nuevo_libro_excel():
+    """Libro write-only con los estilos con nombre que usan los exportadores."""
+    wb = Workbook(write_only=True)
+
+    borde = Border(
+        left=Side(style='thin'),
+        right=Side(style='thin'),
+        top=Side(style='thin'),
+        bottom=Side(style='thin')
+    )
+    centrado = Alignment(horizontal='center', vertical='center')
+    derecha = Alignment(horizontal='right', vertical='center')
+
+    estilos = {
+        'encabezado': dict(
+            fill=PatternFill(start_color="366092", end_color="366092", fill_type="solid"),
+            font=Font(bold=True, color="FFFFFF", size=12),
+            alignment=centrado
+        ),
+        'celda': {},
+        'centrado': dict(alignment=centrado),
+        'derecha': dict(alignment=derecha),
+        'monto': dict(alignment=derecha, number_format='#,##0.00'),
+        'porcentaje': dict(alignment=derecha, number_format='0.00"%"'),
+    }
+    for nombre, atributos in estilos.items():
+        # Sin fuente propia, la celda conserva la fuente por defecto del libro
+        atributos.setdefault('font', DEFAULT_FONT)
+        wb.add_named_style(NamedStyle(name=nombre, border=borde, **atributos))
+    return wb
+
+def _hoja_excel(wb, titulo, anchos, estilo_celda):
+    """
+    Crea una hoja write-only y devuelve una función para agregarle filas.
+    Cada fila se completa hasta len(anchos) columnas y cada celda recibe el estilo
+    estilo_celda(fila, columna, valor). La fila 1 (título) se combina a lo ancho.
+    """
+    ws = wb.create_sheet(titulo)
+    # En modo write-only los anchos deben definirse antes de la primera fila
+    for columna, ancho in enumerate(anchos, start=1):
+        ws.column_dimensions[get_column_letter(columna)].width = ancho
+    ws.merged_cells.add(f"A1:{get_column_letter(len(anchos))}1")
+
+    fila_actual = [0]
+
+    def agregar(valores):
+        fila_actual[0] += 1
+        celdas = []
+        for columna in range(1, len(anchos) + 1):
+            valor = valores[columna - 1] if columna <= len(valores) else None
+            celda = WriteOnlyCell(ws, value=valor)
+            celda.style = estilo_celda(fila_actual[0], columna, valor)
+            celdas.append(celda)
+        ws.append(celdas)
 
-Sé directo, específico y usa las cifras proporcionadas. Máximo 80 palabras."""
+    return agregar
 
-        response = model.generate_content(prompt)
-        analisis_texto = response.text
-        
-        # Convertir markdown a HTML
-        analisis_html = markdown(analisis_texto)
-        
-        return analisis_html
-    except Exception as e:
-        print(f"Error en análisis flujo efectivo IA: {e}")
-        import traceback
-        traceback.print_exc()
-        return f"<p><strong>Error al generar el análisis:</strong> {str(e)}</p>"
+def _es_numero(valor):
+    return isinstance(valor, (int, float)) and not isinstance(valor, bool)
 
 def exportar_analisis_vertical_excel(anio_seleccionado, report_data):
     """Exporta solo el Análisis Vertical a Excel"""
     try:
-        wb = Workbook()
-        wb.remove(wb.active)
-        
-        # Estilos
-        header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
-        header_font = Font(bold=True, color="FFFFFF", size=12)
-        title_font = Font(bold=True, size=14)
-        border = Border(
-            left=Side(style='thin'),
-            right=Side(style='thin'),
-            top=Side(style='thin'),
-            bottom=Side(style='thin')
-        )
-        center_alignment = Alignment(horizontal='center', vertical='center')
-        right_alignment = Alignment(horizontal='right', vertical='center')
-        
+        wb = _nuevo_libro_excel()
+
+        def estilo(fila, columna, valor):
+            if fila <= 3:
+                return 'encabezado'
+            if isinstance(valor, str) and 'BASE' in valor.upper():
+                return 'centrado'
+            if columna == 2 and _es_numero(valor):
+                return 'monto'
+            if columna == 3 and _es_numero(valor):
+                return 'porcentaje'
+            return 'celda'
+
         # Acceso seguro a los datos
         totales = report_data.get('Totales', {})
         base_bg = totales.get('Total Activo', 0)
         base_er = totales.get('Ingreso', 0)
-        
-        ws = wb.create_sheet("Análisis Vertical")
-        ws.append([f"ANÁLISIS VERTICAL - AÑO {anio_seleccionado}"])
-        ws.append([])
-        
-        # Balance General
-        ws.append(["BALANCE GENERAL (Base: Total Activos)"])
-        ws.append(["Cuenta", "Monto (C$)", "% Vertical"])
-        
-        # Activo
-        activo_data = report_data.get('Activo', {})
-        for subtipo, cuentas in activo_data.items():
-            if cuentas:  # Solo si hay cuentas
-                ws.append([f"  {subtipo}"])
-                for cuenta in cuentas:
-                    if isinstance(cuenta, dict):
-                        monto = cuenta.get('monto', 0)
-                        nombre = cuenta.get('nombre', 'Sin nombre')
-                        porcentaje = (monto / base_bg * 100) if base_bg > 0 else 0
-                        ws.append([f"    {nombre}", monto, porcentaje])
-        
-        # Pasivo
-        pasivo_data = report_data.get('Pasivo', {})
-        for subtipo, cuentas in pasivo_data.items():
-            if cuentas:  # Solo si hay cuentas
-                ws.append([f"  {subtipo}"])
-                for cuenta in cuentas:
-                    if isinstance(cuenta, dict):
-                        monto = cuenta.get('monto', 0)
-                        nombre = cuenta.get('nombre', 'Sin nombre')
-                        porcentaje = (monto / base_bg * 100) if base_bg > 0 else 0
-                        ws.append([f"    {nombre}", monto, porcentaje])
-        
-        # Patrimonio
-        patrimonio_data = report_data.get('Patrimonio', {})
-        for subtipo, cuentas in patrimonio_data.items():
-            if cuentas:  # Solo si hay cuentas
-                ws.append([f"  {subtipo}"])
-                for cuenta in cuentas:
-                    if isinstance(cuenta, dict):
-                        monto = cuenta.get('monto', 0)
-                        nombre = cuenta.get('nombre', 'Sin nombre')
-                        porcentaje = (monto / base_bg * 100) if base_bg > 0 else 0
-                        ws.append([f"    {nombre}", monto, porcentaje])
-        ws.append([])
-        
-        # Estado de Resultados
-        ws.append(["ESTADO DE RESULTADOS (Base: Ingresos)"])
-        ws.append(["Cuenta", "Monto (C$)", "% Vertical"])
-        
-        # Ingresos
-        ingreso_data = report_data.get('Ingreso', {})
-        for subtipo, cuentas in ingreso_data.items():
-            if cuentas:
-                for cuenta in cuentas:
-                    if isinstance(cuenta, dict):
-                        monto = cuenta.get('monto', 0)
-                        nombre = cuenta.get('nombre', 'Sin nombre')
-                        porcentaje = (monto / base_er * 100) if base_er > 0 else 0
-                        ws.append([nombre, monto, porcentaje])
-        
-        # Costos
-        costo_data = report_data.get('Costo', {})
-        for subtipo, cuentas in costo_data.items():
-            if cuentas:
-                for cuenta in cuentas:
-                    if isinstance(cuenta, dict):
-                        monto = cuenta.get('monto', 0)
-                        nombre = cuenta.get('nombre', 'Sin nombre')
-                        porcentaje = (monto / base_er * 100) if base_er > 0 else 0
-                        ws.append([nombre, monto, porcentaje])
-        
-        # Gastos
-        gasto_data = report_data.get('Gasto', {})
-        for subtipo, cuentas in gasto_data.items():
-            if cuentas:
-                for cuenta in cuentas:
+
+        agregar = _hoja_excel(wb, "Análisis Vertical", [40, 18, 15], estilo)
+        agregar([f"ANÁLISIS VERTICAL - AÑO {anio_seleccionado}"])
+        agregar([])
+
+        # Balance General: Activo, Pasivo y Patrimonio agrupados por subtipo
+        agregar(["BALANCE GENERAL (Base: Total Activos)"])
+        agregar(["Cuenta", "Monto (C$)", "% Vertical"])
+        for tipo in ['Activo', 'Pasivo', 'Patrimonio']:
+            for subtipo, cuentas in report_data.get(tipo, {}).items():
+                if cuentas:  # Solo si hay cuentas
+                    agregar([f"  {subtipo}"])
+                    for cuenta in cuentas:
+                        if isinstance(cuenta, dict):
+                            monto = cuenta.get('monto', 0)
+                            nombre = cuenta.get('nombre', 'Sin nombre')
+                            porcentaje = (monto / base_bg * 100) if base_bg > 0 else 0
+                            agregar([f"    {nombre}", monto, porcentaje])
+        agregar([])
+
+        # Estado de Resultados: Ingresos, Costos y Gastos
+        agregar(["ESTADO DE RESULTADOS (Base: Ingresos)"])
+        agregar(["Cuenta", "Monto (C$)", "% Vertical"])
+        for tipo in ['Ingreso', 'Costo', 'Gasto']:
+            for subtipo, cuentas in report_data.get(tipo, {}).items():
+                for cuenta in cuentas or []:
                     if isinstance(cuenta, dict):
                         monto = cuenta.get('monto', 0)
                         nombre = cuenta.get('nombre', 'Sin nombre')
                         porcentaje = (monto / base_er * 100) if base_er > 0 else 0
-                        ws.append([nombre, monto, porcentaje])
-        
-        # Aplicar estilos
-        ws['A1'].font = title_font
-        ws.merge_cells('A1:C1')
-        for row in ws.iter_rows(min_row=1, max_row=ws.max_row):
-            for cell in row:
-                cell.border = border
-                if cell.row <= 3 or (cell.value and isinstance(cell.value, str) and ('BASE' in str(cell.value).upper() or cell.value.strip().startswith('  '))):
-                    if cell.row <= 3:
-                        cell.fill = header_fill
-                        cell.font = header_font
-                    cell.alignment = center_alignment
-                elif cell.column in [2, 3] and isinstance(cell.value, (int, float)):
-                    cell.alignment = right_alignment
-                    if cell.column == 3:
-                        cell.number_format = '0.00"%"'
-                    else:
-                        cell.number_format = '#,##0.00'
-        
-        # Ajustar ancho de columnas
-        ws.column_dimensions['A'].width = 40
-        ws.column_dimensions['B'].width = 18
-        ws.column_dimensions['C'].width = 15
-        
+                        agregar([nombre, monto, porcentaje])
+
         return wb
     except Exception as e:
         print(f"Error al exportar Análisis Vertical: {e}")
         return None
 
+def _variacion_relativa_excel(relativo):
+    # Manejar infinito
+    if relativo == float('inf'):
+        return '∞'
+    if relativo == float('-inf'):
+        return '-∞'
+    return relativo
+
 def exportar_analisis_horizontal_excel(periodo_base, periodo_analisis, analisis_comparativo):
     """Exporta solo el Análisis Horizontal a Excel"""
     try:
-        wb = Workbook()
-        wb.remove(wb.active)
-        
-        # Estilos
-        header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
-        header_font = Font(bold=True, color="FFFFFF", size=12)
-        title_font = Font(bold=True, size=14)
-        border = Border(
-            left=Side(style='thin'),
-            right=Side(style='thin'),
-            top=Side(style='thin'),
-            bottom=Side(style='thin')
-        )
-        center_alignment = Alignment(horizontal='center', vertical='center')
-        right_alignment = Alignment(horizontal='right', vertical='center')
-        
-        ws = wb.create_sheet("Análisis Horizontal")
-        ws.append([f"ANÁLISIS HORIZONTAL - {periodo_base} vs {periodo_analisis}"])
-        ws.append([])
-        
+        wb = _nuevo_libro_excel()
+
+        def estilo(fila, columna, valor):
+            if fila <= 3:
+                return 'encabezado'
+            if columna in [2, 3, 4] and _es_numero(valor):
+                return 'monto'
+            if columna == 5 and _es_numero(valor):
+                return 'porcentaje'
+            return 'celda'
+
+        agregar = _hoja_excel(wb, "Análisis Horizontal", [40, 18, 18, 18, 18], estilo)
+        agregar([f"ANÁLISIS HORIZONTAL - {periodo_base} vs {periodo_analisis}"])
+        agregar([])
+
         # Encabezados
-        ws.append(["Cuenta", f"Período Base ({periodo_base})", f"Período Análisis ({periodo_analisis})", "Variación Absoluta", "Variación Relativa (%)"])
-        
+        agregar(["Cuenta", f"Período Base ({periodo_base})", f"Período Análisis ({periodo_analisis})", "Variación Absoluta", "Variación Relativa (%)"])
+
+        def agregar_cuenta(sangria, cuenta):
+            agregar([
+                f"{sangria}{cuenta.get('nombre', 'Sin nombre')}",
+                cuenta.get('monto_base', 0),
+                cuenta.get('monto_analisis', 0),
+                cuenta.get('absoluto', 0),
+                _variacion_relativa_excel(cuenta.get('relativo', 0))
+            ])
+
         # Balance General
         for tipo in ['Activo', 'Pasivo', 'Patrimonio']:
             tipo_data = analisis_comparativo.get(tipo, {})
             if tipo_data:
-                ws.append([f"  {tipo}"])
+                agregar([f"  {tipo}"])
                 for subtipo, cuentas in tipo_data.items():
                     if cuentas:
-                        ws.append([f"    {subtipo}"])
+                        agregar([f"    {subtipo}"])
                         for cuenta in cuentas:
                             if isinstance(cuenta, dict):
-                                nombre = cuenta.get('nombre', 'Sin nombre')
-                                monto_base = cuenta.get('monto_base', 0)
-                                monto_analisis = cuenta.get('monto_analisis', 0)
-                                absoluto = cuenta.get('absoluto', 0)
-                                relativo = cuenta.get('relativo', 0)
-                                # Manejar infinito
-                                if relativo == float('inf'):
-                                    relativo_str = '∞'
-                                elif relativo == float('-inf'):
-                                    relativo_str = '-∞'
-                                else:
-                                    relativo_str = relativo
-                                ws.append([
-                                    f"      {nombre}",
-                                    monto_base,
-                                    monto_analisis,
-                                    absoluto,
-                                    relativo_str
-                                ])
-        
+                                agregar_cuenta("      ", cuenta)
+
         # Estado de Resultados
         for tipo in ['Ingreso', 'Costo', 'Gasto']:
             tipo_data = analisis_comparativo.get(tipo, {})
             if tipo_data:
-                ws.append([f"  {tipo}"])
+                agregar([f"  {tipo}"])
                 for subtipo, cuentas in tipo_data.items():
-                    if cuentas:
-                        for cuenta in cuentas:
-                            if isinstance(cuenta, dict):
-                                nombre = cuenta.get('nombre', 'Sin nombre')
-                                monto_base = cuenta.get('monto_base', 0)
-                                monto_analisis = cuenta.get('monto_analisis', 0)
-                                absoluto = cuenta.get('absoluto', 0)
-                                relativo = cuenta.get('relativo', 0)
-                                # Manejar infinito
-                                if relativo == float('inf'):
-                                    relativo_str = '∞'
-                                elif relativo == float('-inf'):
-                                    relativo_str = '-∞'
-                                else:
-                                    relativo_str = relativo
-                                ws.append([
-                                    f"    {nombre}",
-                                    monto_base,
-                                    monto_analisis,
-                                    absoluto,
-                                    relativo_str
-                                ])
-        
+                    for cuenta in cuentas or []:
+                        if isinstance(cuenta, dict):
+                            agregar_cuenta("    ", cuenta)
+
         # Totales
-        ws.append([])
-        ws.append(["TOTALES"])
-        totales_data = analisis_comparativo.get('Totales', {})
-        for key, valor in totales_data.items():
+        agregar([])
+        agregar(["TOTALES"])
+        for key, valor in analisis_comparativo.get('Totales', {}).items():
             if isinstance(valor, dict):
-                base = valor.get('base', 0)
-                analisis = valor.get('analisis', 0)
-                absoluto = valor.get('absoluto', 0)
-                relativo = valor.get('relativo', 0)
-                # Manejar infinito
-                if relativo == float('inf'):
-                    relativo_str = '∞'
-                elif relativo == float('-inf'):
-                    relativo_str = '-∞'
-                else:
-                    relativo_str = relativo
-                ws.append([
+                agregar([
                     key,
-                    base,
-                    analisis,
-                    absoluto,
-                    relativo_str
+                    valor.get('base', 0),
+                    valor.get('analisis', 0),
+                    valor.get('absoluto', 0),
+                    _variacion_relativa_excel(valor.get('relativo', 0))
                 ])
-        
-        # Aplicar estilos
-        ws['A1'].font = title_font
-        ws.merge_cells('A1:E1')
-        for row in ws.iter_rows(min_row=1, max_row=ws.max_row):
-            for cell in row:
-                cell.border = border
-                if cell.row <= 3:
-                    cell.fill = header_fill
-                    cell.font = header_font
-                    cell.alignment = center_alignment
-                elif cell.column in [2, 3, 4, 5] and isinstance(cell.value, (int, float)):
-                    cell.alignment = right_alignment
-                    if cell.column == 5:
-                        cell.number_format = '0.00"%"'
-                    else:
-                        cell.number_format = '#,##0.00'
-        
-        # Ajustar ancho de columnas
-        ws.column_dimensions['A'].width = 40
-        for col in ['B', 'C', 'D', 'E']:
-            ws.column_dimensions[col].width = 18
-        
+
         return wb
     except Exception as e:
         print(f"Error al exportar Análisis Horizontal: {e}")
@@ -1431,29 +3345,24 @@ def exportar_analisis_horizontal_excel(periodo_base, periodo_analisis, analisis_
 def exportar_ratios_excel(anio_seleccionado, ratios_data):
     """Exporta solo los Ratios Financieros a Excel"""
     try:
-        wb = Workbook()
-        wb.remove(wb.active)
-        
-        # Estilos
-        header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
-        header_font = Font(bold=True, color="FFFFFF", size=12)
-        title_font = Font(bold=True, size=14)
-        border = Border(
-            left=Side(style='thin'),
-            right=Side(style='thin'),
-            top=Side(style='thin'),
-            bottom=Side(style='thin')
-        )
-        center_alignment = Alignment(horizontal='center', vertical='center')
-        right_alignment = Alignment(horizontal='right', vertical='center')
-        
-        ws = wb.create_sheet("Ratios Financieros")
-        ws.append([f"RATIOS FINANCIEROS - AÑO {anio_seleccionado}"])
-        ws.append([])
-        
+        wb = _nuevo_libro_excel()
+
+        def estilo(fila, columna, valor):
+            if fila <= 3:
+                return 'encabezado'
+            if columna == 3 and isinstance(valor, str):
+                return 'derecha'
+            if columna in [4, 5, 6]:
+                return 'centrado'
+            return 'celda'
+
+        agregar = _hoja_excel(wb, "Ratios Financieros", [15, 35, 18, 40, 20, 12, 60], estilo)
+        agregar([f"RATIOS FINANCIEROS - AÑO {anio_seleccionado}"])
+        agregar([])
+
         # Encabezados
-        ws.append(["Categoría", "Ratio", "Valor", "Fórmula", "Rango Óptimo", "Estado", "Interpretación"])
-        
+        agregar(["Categoría", "Ratio", "Valor", "Fórmula", "Rango Óptimo", "Estado", "Interpretación"])
+
         # Acceder a la estructura correcta por categorías
         categorias = {
             'Liquidez': ratios_data.get('Liquidez', {}),
@@ -1461,7 +3370,7 @@ def exportar_ratios_excel(anio_seleccionado, ratios_data):
             'Endeudamiento': ratios_data.get('Endeudamiento', {}),
             'Rentabilidad': ratios_data.get('Rentabilidad', {})
         }
-        
+
         for categoria_nombre, categoria_ratios in categorias.items():
             if categoria_ratios:
                 for ratio_nombre, ratio_info in categoria_ratios.items():
@@ -1471,7 +3380,7 @@ def exportar_ratios_excel(anio_seleccionado, ratios_data):
                         rango_optimo = ratio_info.get('rango_optimo', '')
                         estado = ratio_info.get('estado', 'normal')
                         interpretacion = ratio_info.get('interpretacion', '')
-                        
+
                         # Formatear valor según el tipo
                         if 'unidad' in ratio_info:
                             if ratio_info['unidad'] == 'días':
@@ -1488,8 +3397,8 @@ def exportar_ratios_excel(anio_seleccionado, ratios_data):
                                 valor_str = f"{valor:.2f}%"
                             else:
                                 valor_str = f"{valor:.2f}"
-                        
-                        ws.append([
+
+                        agregar([
                             categoria_nombre,
                             ratio_nombre,
                             valor_str,
@@ -1498,31 +3407,7 @@ def exportar_ratios_excel(anio_seleccionado, ratios_data):
                             estado.capitalize(),
                             interpretacion
                         ])
-        
-        # Aplicar estilos
-        ws['A1'].font = title_font
-        ws.merge_cells('A1:G1')
-        for row in ws.iter_rows(min_row=1, max_row=ws.max_row):
-            for cell in row:
-                cell.border = border
-                if cell.row <= 3:
-                    cell.fill = header_fill
-                    cell.font = header_font
-                    cell.alignment = center_alignment
-                elif cell.column == 3 and isinstance(cell.value, str):
-                    cell.alignment = right_alignment
-                elif cell.column in [4, 5, 6]:
-                    cell.alignment = center_alignment
-        
-        # Ajustar ancho de columnas
-        ws.column_dimensions['A'].width = 15
-        ws.column_dimensions['B'].width = 35
-        ws.column_dimensions['C'].width = 18
-        ws.column_dimensions['D'].width = 40
-        ws.column_dimensions['E'].width = 20
-        ws.column_dimensions['F'].width = 12
-        ws.column_dimensions['G'].width = 60
-        
+
         return wb
     except Exception as e:
         print(f"Error al exportar Ratios Financieros: {e}")
@@ -1533,110 +3418,445 @@ def exportar_ratios_excel(anio_seleccionado, ratios_data):
 def exportar_origen_aplicacion_excel(periodo_base, periodo_analisis, origen_aplicacion_data):
     """Exporta solo el Origen y Aplicación de Fondos a Excel"""
     try:
-        wb = Workbook()
-        wb.remove(wb.active)
-        
-        # Estilos
-        header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
-        header_font = Font(bold=True, color="FFFFFF", size=12)
-        title_font = Font(bold=True, size=14)
-        border = Border(
-            left=Side(style='thin'),
-            right=Side(style='thin'),
-            top=Side(style='thin'),
-            bottom=Side(style='thin')
-        )
-        center_alignment = Alignment(horizontal='center', vertical='center')
-        right_alignment = Alignment(horizontal='right', vertical='center')
-        
-        ws = wb.create_sheet("Origen y Aplicación")
-        ws.append([f"ORIGEN Y APLICACIÓN DE FONDOS - {periodo_base} vs {periodo_analisis}"])
-        ws.append([])
-        
-        # Origen de Fondos
-        ws.append(["ORIGEN DE FONDOS"])
-        ws.append(["Cuenta", "Monto Base", "Monto Análisis", "Variación (C$)"])
-        origen_data = origen_aplicacion_data.get('Origen', {})
-        for subtipo, cuentas in origen_data.items():
-            if cuentas:
-                ws.append([f"  {subtipo}"])
-                for cuenta in cuentas:
-                    if isinstance(cuenta, dict):
-                        nombre = cuenta.get('nombre', 'Sin nombre')
-                        monto_base = cuenta.get('monto_base', 0)
-                        monto_analisis = cuenta.get('monto_analisis', 0)
-                        variacion = cuenta.get('variacion', 0)
-                        ws.append([f"    {nombre}", monto_base, monto_analisis, variacion])
-        ws.append([])
-        
-        # Aplicación de Fondos
-        ws.append(["APLICACIÓN DE FONDOS"])
-        ws.append(["Cuenta", "Monto Base", "Monto Análisis", "Variación (C$)"])
-        aplicacion_data = origen_aplicacion_data.get('Aplicacion', {})
-        for subtipo, cuentas in aplicacion_data.items():
-            if cuentas:
-                ws.append([f"  {subtipo}"])
-                for cuenta in cuentas:
-                    if isinstance(cuenta, dict):
-                        nombre = cuenta.get('nombre', 'Sin nombre')
-                        monto_base = cuenta.get('monto_base', 0)
-                        monto_analisis = cuenta.get('monto_analisis', 0)
-                        variacion = cuenta.get('variacion', 0)
-                        ws.append([f"    {nombre}", monto_base, monto_analisis, variacion])
-        ws.append([])
-        
+        wb = _nuevo_libro_excel()
+
+        def estilo(fila, columna, valor):
+            if fila <= 3:
+                return 'encabezado'
+            if isinstance(valor, str) and any(palabra in valor.upper() for palabra in ('ORIGEN', 'APLICACIÓN', 'TOTALES')):
+                return 'centrado'
+            if columna in [2, 3, 4] and _es_numero(valor):
+                return 'monto'
+            return 'celda'
+
+        agregar = _hoja_excel(wb, "Origen y Aplicación", [40, 18, 18, 18], estilo)
+        agregar([f"ORIGEN Y APLICACIÓN DE FONDOS - {periodo_base} vs {periodo_analisis}"])
+        agregar([])
+
+        # Origen y Aplicación de Fondos
+        for titulo, clave in [("ORIGEN DE FONDOS", 'Origen'), ("APLICACIÓN DE FONDOS", 'Aplicacion')]:
+            agregar([titulo])
+            agregar(["Cuenta", "Monto Base", "Monto Análisis", "Variación (C$)"])
+            for subtipo, cuentas in origen_aplicacion_data.get(clave, {}).items():
+                if cuentas:
+                    agregar([f"  {subtipo}"])
+                    for cuenta in cuentas:
+                        if isinstance(cuenta, dict):
+                            nombre = cuenta.get('nombre', 'Sin nombre')
+                            monto_base = cuenta.get('monto_base', 0)
+                            monto_analisis = cuenta.get('monto_analisis', 0)
+                            variacion = cuenta.get('variacion', 0)
+                            agregar([f"    {nombre}", monto_base, monto_analisis, variacion])
+            agregar([])
+
         # Totales
-        ws.append(["TOTALES"])
+        agregar(["TOTALES"])
         totales = origen_aplicacion_data.get('Totales', {})
         total_origen = totales.get('Origen', {}).get('Total', 0)
         total_aplicacion = totales.get('Aplicacion', {}).get('Total', 0)
         diferencia = total_origen - total_aplicacion
-        
-        ws.append([
-            "Total Origen",
-            "",
-            "",
-            total_origen
-        ])
-        ws.append([
-            "Total Aplicación",
-            "",
-            "",
-            total_aplicacion
-        ])
-        ws.append([
-            "Diferencia",
-            "",
-            "",
-            diferencia
-        ])
-        
-        # Aplicar estilos
-        ws['A1'].font = title_font
-        ws.merge_cells('A1:D1')
-        for row in ws.iter_rows(min_row=1, max_row=ws.max_row):
-            for cell in row:
-                cell.border = border
-                if cell.row <= 3 or (cell.value and isinstance(cell.value, str) and ('ORIGEN' in str(cell.value).upper() or 'APLICACIÓN' in str(cell.value).upper() or 'TOTALES' in str(cell.value).upper())):
-                    if cell.row <= 3:
-                        cell.fill = header_fill
-                        cell.font = header_font
-                    cell.alignment = center_alignment
-                elif cell.column in [2, 3, 4] and isinstance(cell.value, (int, float)):
-                    cell.alignment = right_alignment
-                    cell.number_format = '#,##0.00'
-        
-        # Ajustar ancho de columnas
-        ws.column_dimensions['A'].width = 40
-        ws.column_dimensions['B'].width = 18
-        ws.column_dimensions['C'].width = 18
-        ws.column_dimensions['D'].width = 18
-        
+
+        agregar(["Total Origen", "", "", total_origen])
+        agregar(["Total Aplicación", "", "", total_aplicacion])
+        agregar(["Diferencia", "", "", diferencia])
+
         return wb
     except Exception as e:
         print(f"Error al exportar Origen y Aplicación: {e}")
         return None
 
+# --- Exportación de datos (CSV, JSONL, Parquet) ---
+# Para consumo automático (BI) cada análisis se exporta también como filas planas y
+# tipadas, generadas a partir de las mismas estructuras que usan los libros de Excel.
+
+COLUMNAS_EXPORTACION = {
+    'vertical': [
+        ('anio', 'entero'), ('estado', 'texto'), ('tipo', 'texto'), ('subtipo', 'texto'),
+        ('cuenta_id', 'texto'), ('cuenta', 'texto'), ('monto', 'decimal'), ('porcentaje_vertical', 'decimal')
+    ],
+    'horizontal': [
+        ('periodo_base', 'entero'), ('periodo_analisis', 'entero'), ('tipo', 'texto'), ('subtipo', 'texto'),
+        ('cuenta_id', 'texto'), ('cuenta', 'texto'), ('monto_base', 'decimal'), ('monto_analisis', 'decimal'),
+        ('variacion_absoluta', 'decimal'), ('variacion_relativa', 'decimal')
+    ],
+    'ratios': [
+        ('anio', 'entero'), ('categoria', 'texto'), ('ratio', 'texto'), ('valor', 'decimal'),
+        ('porcentaje', 'decimal'), ('unidad', 'texto'), ('formula', 'texto'), ('rango_optimo', 'texto'),
+        ('estado', 'texto'), ('interpretacion', 'texto')
+    ],
+    'origen_aplicacion': [
+        ('periodo_base', 'entero'), ('periodo_analisis', 'entero'), ('clasificacion', 'texto'), ('subtipo', 'texto'),
+        ('cuenta_id', 'texto'), ('cuenta', 'texto'), ('monto_base', 'decimal'), ('monto_analisis', 'decimal'),
+        ('variacion', 'decimal')
+    ],
+    'dupont': [
+        ('anio', 'entero'), ('margen_neto', 'decimal'), ('rotacion_activos', 'decimal'), ('multiplicador', 'decimal'),
+        ('roe', 'decimal'), ('variacion_roe', 'decimal'), ('factor_determinante', 'texto')
+    ],
+    'flujo_efectivo': [
+        ('periodo_inicio', 'entero'), ('periodo_fin', 'entero'), ('actividad', 'texto'), ('concepto', 'texto'),
+        ('monto', 'decimal')
+    ],
+}
+
+# csv.gz y jsonl.gz son los mismos archivos comprimidos con gzip mientras se escriben
+FORMATOS_EXPORTACION = {
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'csv': 'text/csv',
+    'csv.gz': 'application/gzip',
+    'jsonl': 'application/x-ndjson',
+    'jsonl.gz': 'application/gzip',
+}
+if pa is not None:
+    FORMATOS_EXPORTACION['parquet'] = 'application/vnd.apache.parquet'
+
+# Nombres para los selectores de formato de las plantillas
+NOMBRES_FORMATOS_EXPORTACION = {
+    'xlsx': 'Excel (.xlsx)',
+    'csv': 'CSV (.csv)',
+    'csv.gz': 'CSV comprimido (.csv.gz)',
+    'jsonl': 'JSON Lines (.jsonl)',
+    'jsonl.gz': 'JSON Lines comprimido (.jsonl.gz)',
+    'parquet': 'Parquet (.parquet)',
+}
+
+def _decimal_exportacion(valor):
+    # inf/-inf (variaciones sin base) no tienen representación en CSV/JSON
+    if valor is None or not math.isfinite(valor):
+        return None
+    return float(valor)
+
+def filas_analisis_vertical(anio_seleccionado, report_data):
+    """Filas del análisis vertical: una por cuenta con su porcentaje sobre la base."""
+    totales = report_data.get('Totales', {})
+    bases = {
+        'Balance General': totales.get('Total Activo', 0),
+        'Estado de Resultados': totales.get('Ingreso', 0),
+    }
+    for estado, tipos in [('Balance General', ['Activo', 'Pasivo', 'Patrimonio']),
+                          ('Estado de Resultados', ['Ingreso', 'Costo', 'Gasto'])]:
+        base = bases[estado]
+        for tipo in tipos:
+            for subtipo, cuentas in report_data.get(tipo, {}).items():
+                for cuenta in cuentas or []:
+                    if isinstance(cuenta, dict):
+                        monto = cuenta.get('monto', 0)
+                        yield {
+                            'anio': anio_seleccionado,
+                            'estado': estado,
+                            'tipo': tipo,
+                            'subtipo': subtipo,
+                            'cuenta_id': cuenta.get('id'),
+                            'cuenta': cuenta.get('nombre', 'Sin nombre'),
+                            'monto': _decimal_exportacion(monto),
+                            'porcentaje_vertical': (monto / base * 100) if base > 0 else 0.0,
+                        }
+
+def filas_analisis_horizontal(periodo_base, periodo_analisis, analisis_comparativo):
+    """Filas del análisis horizontal: una por cuenta y una por cada total."""
+    for tipo in ['Activo', 'Pasivo', 'Patrimonio', 'Ingreso', 'Costo', 'Gasto']:
+        for subtipo, cuentas in analisis_comparativo.get(tipo, {}).items():
+            for cuenta in cuentas or []:
+                if isinstance(cuenta, dict):
+                    yield {
+                        'periodo_base': periodo_base,
+                        'periodo_analisis': periodo_analisis,
+                        'tipo': tipo,
+                        'subtipo': subtipo,
+                        'cuenta_id': cuenta.get('id'),
+                        'cuenta': cuenta.get('nombre', 'Sin nombre'),
+                        'monto_base': _decimal_exportacion(cuenta.get('monto_base', 0)),
+                        'monto_analisis': _decimal_exportacion(cuenta.get('monto_analisis', 0)),
+                        'variacion_absoluta': _decimal_exportacion(cuenta.get('absoluto', 0)),
+                        'variacion_relativa': _decimal_exportacion(cuenta.get('relativo', 0)),
+                    }
+    for nombre, valor in analisis_comparativo.get('Totales', {}).items():
+        if isinstance(valor, dict):
+            yield {
+                'periodo_base': periodo_base,
+                'periodo_analisis': periodo_analisis,
+                'tipo': 'Totales',
+                'subtipo': None,
+                'cuenta_id': None,
+                'cuenta': nombre,
+                'monto_base': _decimal_exportacion(valor.get('base', 0)),
+                'monto_analisis': _decimal_exportacion(valor.get('analisis', 0)),
+                'variacion_absoluta': _decimal_exportacion(valor.get('absoluto', 0)),
+                'variacion_relativa': _decimal_exportacion(valor.get('relativo', 0)),
+            }
+
+def filas_ratios(anio_seleccionado, ratios_data):
+    """Filas de ratios financieros con el valor numérico sin formatear."""
+    for categoria in ['Liquidez', 'Actividades', 'Endeudamiento', 'Rentabilidad']:
+        for ratio_nombre, ratio_info in ratios_data.get(categoria, {}).items():
+            if isinstance(ratio_info, dict):
+                yield {
+                    'anio': anio_seleccionado,
+                    'categoria': categoria,
+                    'ratio': ratio_nombre,
+                    'valor': _decimal_exportacion(ratio_info.get('valor', 0)),
+                    'porcentaje': _decimal_exportacion(ratio_info.get('porcentaje')),
+                    'unidad': ratio_info.get('unidad'),
+                    'formula': ratio_info.get('formula', ''),
+                    'rango_optimo': ratio_info.get('rango_optimo', ''),
+                    'estado': ratio_info.get('estado', 'normal'),
+                    'interpretacion': ratio_info.get('interpretacion', ''),
+                }
+
+def filas_origen_aplicacion(periodo_base, periodo_analisis, origen_aplicacion_data):
+    """Filas de origen y aplicación de fondos: una por cuenta clasificada."""
+    for clasificacion in ['Origen', 'Aplicacion']:
+        for subtipo, cuentas in origen_aplicacion_data.get(clasificacion, {}).items():
+            for cuenta in cuentas or []:
+                if isinstance(cuenta, dict):
+                    yield {
+                        'periodo_base': periodo_base,
+                        'periodo_analisis': periodo_analisis,
+                        'clasificacion': clasificacion,
+                        'subtipo': subtipo,
+                        'cuenta_id': cuenta.get('id'),
+                        'cuenta': cuenta.get('nombre', 'Sin nombre'),
+                        'monto_base': _decimal_exportacion(cuenta.get('monto_base', 0)),
+                        'monto_analisis': _decimal_exportacion(cuenta.get('monto_analisis', 0)),
+                        'variacion': _decimal_exportacion(cuenta.get('variacion', 0)),
+                    }
+
+def filas_dupont(anio_actual, dupont_data):
+    """Fila del análisis DuPont del año (resultado de generar_analisis_dupont['analisis_dupont'])."""
+    actual = dupont_data.get(str(anio_actual), {})
+    variaciones = dupont_data.get('variaciones', {})
+    yield {
+        'anio': anio_actual,
+        'margen_neto': _decimal_exportacion(actual.get('margen_neto', 0)),
+        'rotacion_activos': _decimal_exportacion(actual.get('rotacion_activos', 0)),
+        'multiplicador': _decimal_exportacion(actual.get('multiplicador', 0)),
+        'roe': _decimal_exportacion(actual.get('roe', 0)),
+        'variacion_roe': _decimal_exportacion(variaciones.get('roe')),
+        'factor_determinante': variaciones.get('factor_determinante'),
+    }
+
+def filas_flujo_efectivo(periodo_inicio, periodo_fin, flujo_data):
+    """Filas del flujo de efectivo: conceptos y total de cada actividad, más la validación."""
+    for actividad in ['Operacion', 'Inversion', 'Financiamiento']:
+        seccion = flujo_data.get(actividad, {})
+        for detalle in seccion.get('detalles', []):
+            yield {
+                'periodo_inicio': periodo_inicio,
+                'periodo_fin': periodo_fin,
+                'actividad': actividad,
+                'concepto': detalle.get('concepto'),
+                'monto': _decimal_exportacion(detalle.get('monto', 0)),
+            }
+        yield {
+            'periodo_inicio': periodo_inicio,
+            'periodo_fin': periodo_fin,
+            'actividad': actividad,
+            'concepto': 'Total',
+            'monto': _decimal_exportacion(seccion.get('total', 0)),
+        }
+    for concepto, valor in flujo_data.get('Validacion', {}).items():
+        if _es_numero(valor):
+            yield {
+                'periodo_inicio': periodo_inicio,
+                'periodo_fin': periodo_fin,
+                'actividad': 'Validacion',
+                'concepto': concepto,
+                'monto': _decimal_exportacion(valor),
+            }
+
+def exportar_filas_excel(titulo, columnas, filas):
+    """Libro de Excel con una tabla simple a partir de filas planas (análisis sin formato propio)."""
+    try:
+        wb = _nuevo_libro_excel()
+        decimales = {i for i, (_, tipo) in enumerate(columnas, start=1) if tipo == 'decimal'}
+
+        def estilo(fila, columna, valor):
+            if fila <= 3:
+                return 'encabezado'
+            if columna in decimales and _es_numero(valor):
+                return 'monto'
+            return 'celda'
+
+        agregar = _hoja_excel(wb, titulo[:31], [max(15, len(nombre) + 4) for nombre, _ in columnas], estilo)
+        agregar([titulo.upper()])
+        agregar([])
+        agregar([nombre for nombre, _ in columnas])
+        for fila in filas:
+            agregar([fila.get(nombre) for nombre, _ in columnas])
+        return wb
+    except Exception as e:
+        print(f"Error al exportar {titulo}: {e}")
+        return None
+
+def serializar_filas(filas, columnas, formato):
+    """
+    Convierte un generador de filas (dicts) en bytes CSV, JSONL o Parquet. El texto se
+    escribe fila por fila directo al buffer de salida y, en csv.gz y jsonl.gz, pasa por
+    gzip a medida que se escribe (mtime fijo para que el ETag no cambie entre llamadas).
+    """
+    nombres = [nombre for nombre, _ in columnas]
+    base, _, compresion = formato.partition('.')
+
+    if base in ('csv', 'jsonl') and compresion in ('', 'gz'):
+        salida = io.BytesIO()
+        destino = gzip.GzipFile(fileobj=salida, mode='wb', mtime=0) if compresion else salida
+        texto = io.TextIOWrapper(destino, encoding='utf-8', newline='')
+        if base == 'csv':
+            escritor = csv.writer(texto)
+            escritor.writerow(nombres)
+            for fila in filas:
+                escritor.writerow(['' if fila.get(nombre) is None else fila.get(nombre) for nombre in nombres])
+        else:
+            for fila in filas:
+                texto.write(json.dumps({nombre: fila.get(nombre) for nombre in nombres}, ensure_ascii=False) + '\n')
+        texto.flush()
+        texto.detach()
+        if compresion:
+            destino.close()
+        return salida.getvalue()
+
+    if formato == 'parquet':
+        if pa is None:
+            raise RuntimeError('La exportación a Parquet requiere pyarrow.')
+        tipos = {'texto': pa.string(), 'entero': pa.int32(), 'decimal': pa.float64()}
+        valores = {nombre: [] for nombre in nombres}
+        for fila in filas:
+            for nombre in nombres:
+                valores[nombre].append(fila.get(nombre))
+        tabla = pa.table({nombre: pa.array(valores[nombre], type=tipos[tipo]) for nombre, tipo in columnas})
+        salida = io.BytesIO()
+        pq.write_table(tabla, salida, compression='zstd')
+        return salida.getvalue()
+
+    raise ValueError(f"Formato de exportación no soportado: {formato}")
+
+# DuPont y flujo de efectivo no tienen libro propio: su xlsx es la tabla de filas
+_EXPORTADORES = {
+    'vertical': (exportar_analisis_vertical_excel, filas_analisis_vertical),
+    'horizontal': (exportar_analisis_horizontal_excel, filas_analisis_horizontal),
+    'ratios': (exportar_ratios_excel, filas_ratios),
+    'origen_aplicacion': (exportar_origen_aplicacion_excel, filas_origen_aplicacion),
+    'dupont': (None, filas_dupont),
+    'flujo_efectivo': (None, filas_flujo_efectivo),
+}
+
+_TITULOS_EXPORTACION = {
+    'dupont': 'Análisis DuPont',
+    'flujo_efectivo': 'Flujo de Efectivo',
+}
+
+def generar_exportacion(tipo_analisis, formato, *args):
+    """
+    Bytes del análisis en el formato pedido (ver FORMATOS_EXPORTACION), o None si
+    no se pudo generar. args son los del exportador de Excel del tipo.
+    """
+    exportador_excel, generador_filas = _EXPORTADORES[tipo_analisis]
+    if formato == 'xlsx':
+        if exportador_excel:
+            wb = exportador_excel(*args)
+        else:
+            wb = exportar_filas_excel(_TITULOS_EXPORTACION[tipo_analisis], COLUMNAS_EXPORTACION[tipo_analisis], generador_filas(*args))
+        if not wb:
+            return None
+        output = io.BytesIO()
+        wb.save(output)
+        return output.getvalue()
+    return serializar_filas(generador_filas(*args), COLUMNAS_EXPORTACION[tipo_analisis], formato)
+
+EXPORTACION_MAX_HILOS = int(os.getenv('EXPORTACION_MAX_HILOS', '4'))
+
+def exportar_rango_analisis(anio_desde, anio_hasta, formato='xlsx'):
+    """
+    Exporta todos los análisis de un rango de años en un zip: vertical, ratios y
+    DuPont por año; horizontal, origen y aplicación y flujo de efectivo por cada par
+    de años consecutivos. Los reportes del rango se cargan en una sola consulta y los
+    archivos se generan en un pool de hilos. Devuelve los bytes del zip o None.
+    """
+    registro = obtener_periodos()
+    anios = sorted(anio for anio in registro.anios if anio_desde <= anio <= anio_hasta)
+    if not anios:
+        return None
+
+    # Una sola consulta para el rango y los años previos al primero: el período anterior
+    # (ratios) y el año calendario anterior (DuPont), aunque no exista
+    anteriores = {anios[0] - 1}
+    if registro.anterior(anios[0]):
+        anteriores.add(registro.anterior(anios[0]))
+    reportes = get_financial_reports_many(anios + sorted(anteriores))
+
+    # Los hilos comparten el memo de reportes de la petición (incluye los años sin período)
+    app = current_app._get_current_object() if has_app_context() else None
+    memo = _memo_reportes()
+    versiones = g.get('versiones_datos') if has_app_context() else None
+
+    def en_contexto(funcion, *args):
+        if app is None:
+            return funcion(*args)
+        with app.app_context():
+            g.memo_reportes = memo
+            g.reportes_materializados = 0
+            if versiones is not None:
+                g.versiones_datos = versiones
+            return funcion(*args)
+
+    def vertical(anio):
+        return generar_exportacion('vertical', formato, anio, reportes[anio])
+
+    def ratios(anio):
+        anterior = registro.anterior(anio)
+        return generar_exportacion('ratios', formato, anio, calcular_ratios_financieros(reportes[anio], reportes.get(anterior)))
+
+    def dupont(anio):
+        resultado = generar_analisis_dupont(anio)
+        if not resultado.get('exito'):
+            return None
+        return generar_exportacion('dupont', formato, anio, resultado['analisis_dupont'])
+
+    def horizontal(base, analisis):
+        comparativo = calcular_analisis_horizontal(reportes[base], reportes[analisis])
+        return generar_exportacion('horizontal', formato, base, analisis, comparativo)
+
+    def origen_aplicacion(base, analisis):
+        datos = calcular_origen_aplicacion(reportes[base], reportes[analisis])
+        return generar_exportacion('origen_aplicacion', formato, base, analisis, datos)
+
+    def flujo_efectivo(inicio, fin):
+        flujo = calcular_estado_flujo_efectivo(inicio, fin)
+        if not flujo.get('exito'):
+            return None
+        return generar_exportacion('flujo_efectivo', formato, inicio, fin, flujo)
+
+    tareas = []
+    anios_con_datos = [anio for anio in anios if reportes.get(anio)]
+    for anio in anios_con_datos:
+        tareas.append((f"Analisis_Vertical_{anio}", vertical, (anio,)))
+        tareas.append((f"Ratios_Financieros_{anio}", ratios, (anio,)))
+        tareas.append((f"DuPont_{anio}", dupont, (anio,)))
+    for base, analisis in zip(anios_con_datos, anios_con_datos[1:]):
+        tareas.append((f"Analisis_Horizontal_{base}_{analisis}", horizontal, (base, analisis)))
+        tareas.append((f"Origen_Aplicacion_{base}_vs_{analisis}", origen_aplicacion, (base, analisis)))
+        tareas.append((f"Flujo_Efectivo_{base}_{analisis}", flujo_efectivo, (base, analisis)))
+    if not tareas:
+        return None
+
+    with ThreadPoolExecutor(max_workers=EXPORTACION_MAX_HILOS, thread_name_prefix='exportacion') as ejecutor:
+        futuros = [(nombre, ejecutor.submit(en_contexto, funcion, *args)) for nombre, funcion, args in tareas]
+
+        salida = io.BytesIO()
+        # xlsx, parquet y los .gz ya vienen comprimidos
+        ya_comprimido = formato in ('xlsx', 'parquet') or formato.endswith('.gz')
+        compresion = zipfile.ZIP_STORED if ya_comprimido else zipfile.ZIP_DEFLATED
+        with zipfile.ZipFile(salida, 'w', compression=compresion) as archivo_zip:
+            for nombre, futuro in futuros:
+                try:
+                    contenido = futuro.result()
+                except Exception as e:
+                    print(f"Error al exportar {nombre}: {e}")
+                    contenido = None
+                if contenido:
+                    archivo_zip.writestr(f"{nombre}.{formato}", contenido)
+    return salida.getvalue()
+
 def exportar_analisis_excel(anio_seleccionado=None, tipo_analisis=None, **kwargs):
     """Exporta el análisis financiero especificado a un archivo Excel
     
@@ -1678,7 +3898,7 @@ def exportar_analisis_excel(anio_seleccionado=None, tipo_analisis=None, **kwargs
                 return None
             return exportar_origen_aplicacion_excel(periodo_base, periodo_analisis, origen_aplicacion_data)
         
-        # Si no se especifica tipo, retornar None (no exportar todos)
+        # Si no se especifica tipo, retornar None (para todos los análisis ver exportar_rango_analisis)
         return None
         
     except Exception as e:
@@ -1688,19 +3908,21 @@ def exportar_analisis_excel(anio_seleccionado=None, tipo_analisis=None, **kwargs
         return None
 
 
-def calcular_ctno(anio_seleccionado):
+def calcular_ctno(anio_seleccionado, report_data=None):
     """
     Calcula el Capital de Trabajo Neto Operativo (CTNO) para un año específico.
     
     Fórmula: CTNO = (Total de Cuentas por Cobrar + Total de Inventarios) - Total de Cuentas por Pagar
     
-    La función busca estas cuentas en el catálogo de cuentas por nombre:
-    - Cuentas por Cobrar: busca cuentas con "por cobrar" o "cuentas por cobrar" en el nombre
-    - Inventarios: busca cuentas con "inventario" en el nombre
-    - Cuentas por Pagar: busca cuentas con "por pagar" o "cuentas por pagar" en el nombre
+    La función busca estas cuentas en el reporte del año por etiqueta (ver clasificar_cuenta):
+    - Cuentas por Cobrar: cuentas de Activo con "cobrar" en el nombre (si no hay, las de "cliente")
+    - Inventarios: cuentas de Activo con "inventario" en el nombre
+    - Cuentas por Pagar: cuentas de Pasivo con "pagar" en el nombre
     
     Args:
         anio_seleccionado (int): Año para el cual calcular el CTNO
+        report_data (dict, opcional): Reporte ya cargado del año. Si no se pasa, se
+            obtiene con get_financial_reports (caché de reportes).
         
     Returns:
         dict: Diccionario con:
@@ -1712,100 +3934,45 @@ def calcular_ctno(anio_seleccionado):
             - 'exito': True si se calculó correctamente, False en caso de error
     """
     try:
-        with engine.connect() as conn:
-            # Obtener el PeriodoID para el año seleccionado
-            periodo_query = text("SELECT PeriodoID FROM Periodo WHERE Anio = :anio")
-            periodo_result = conn.execute(periodo_query, {"anio": anio_seleccionado}).fetchone()
-            
-            if not periodo_result:
-                return {
-                    'ctno': 0.0,
-                    'cuentas_por_cobrar': 0.0,
-                    'inventarios': 0.0,
-                    'cuentas_por_pagar': 0.0,
-                    'anio': anio_seleccionado,
-                    'exito': False,
-                    'mensaje': f'No se encontró el período para el año {anio_seleccionado}'
-                }
-            
-            periodo_id = periodo_result[0]
-            
-            # 1. Calcular Total de Cuentas por Cobrar
-            # Primero busca cuentas que contengan "por cobrar" o "cuentas por cobrar" en el nombre
-            cuentas_por_cobrar_query = text("""
-                SELECT COALESCE(SUM(s.Monto), 0) AS total
-                FROM CatalogoCuentas c
-                INNER JOIN SaldoCuenta s ON s.CuentaID = c.CuentaID
-                WHERE s.PeriodoID = :periodo_id
-                AND (
-                    LOWER(c.NombreCuenta) LIKE '%por cobrar%' 
-                    OR LOWER(c.NombreCuenta) LIKE '%cuentas por cobrar%'
-                    OR LOWER(c.NombreCuenta) LIKE '%cobrar%'
-                )
-                AND c.TipoCuenta = 'Activo'
-            """)
-            cuentas_por_cobrar_result = conn.execute(cuentas_por_cobrar_query, {"periodo_id": periodo_id}).fetchone()
-            total_cuentas_por_cobrar = float(cuentas_por_cobrar_result[0]) if cuentas_por_cobrar_result and cuentas_por_cobrar_result[0] else 0.0
-            
-            # Si no hay cuentas por cobrar, buscar cuentas con "cliente" en el nombre
-            if total_cuentas_por_cobrar == 0.0:
-                clientes_query = text("""
-                    SELECT COALESCE(SUM(s.Monto), 0) AS total
-                    FROM CatalogoCuentas c
-                    INNER JOIN SaldoCuenta s ON s.CuentaID = c.CuentaID
-                    WHERE s.PeriodoID = :periodo_id
-                    AND (
-                        LOWER(c.NombreCuenta) LIKE '%cliente%'
-                        OR LOWER(c.NombreCuenta) LIKE '%clientes%'
-                    )
-                    AND c.TipoCuenta = 'Activo'
-                """)
-                clientes_result = conn.execute(clientes_query, {"periodo_id": periodo_id}).fetchone()
-                total_cuentas_por_cobrar = float(clientes_result[0]) if clientes_result and clientes_result[0] else 0.0
-            
-            # 2. Calcular Total de Inventarios
-            # Busca cuentas que contengan "inventario" en el nombre
-            inventarios_query = text("""
-                SELECT COALESCE(SUM(s.Monto), 0) AS total
-                FROM CatalogoCuentas c
-                INNER JOIN SaldoCuenta s ON s.CuentaID = c.CuentaID
-                WHERE s.PeriodoID = :periodo_id
-                AND LOWER(c.NombreCuenta) LIKE '%inventario%'
-                AND c.TipoCuenta = 'Activo'
-            """)
-            inventarios_result = conn.execute(inventarios_query, {"periodo_id": periodo_id}).fetchone()
-            total_inventarios = float(inventarios_result[0]) if inventarios_result and inventarios_result[0] else 0.0
-            
-            # 3. Calcular Total de Cuentas por Pagar
-            # Busca cuentas que contengan "por pagar" o "cuentas por pagar" en el nombre
-            cuentas_por_pagar_query = text("""
-                SELECT COALESCE(SUM(s.Monto), 0) AS total
-                FROM CatalogoCuentas c
-                INNER JOIN SaldoCuenta s ON s.CuentaID = c.CuentaID
-                WHERE s.PeriodoID = :periodo_id
-                AND (
-                    LOWER(c.NombreCuenta) LIKE '%por pagar%' 
-                    OR LOWER(c.NombreCuenta) LIKE '%cuentas por pagar%'
-                    OR LOWER(c.NombreCuenta) LIKE '%pagar%'
-                )
-                AND c.TipoCuenta = 'Pasivo'
-            """)
-            cuentas_por_pagar_result = conn.execute(cuentas_por_pagar_query, {"periodo_id": periodo_id}).fetchone()
-            total_cuentas_por_pagar = float(cuentas_por_pagar_result[0]) if cuentas_por_pagar_result and cuentas_por_pagar_result[0] else 0.0
-            
-            # 4. Calcular CTNO
-            # CTNO = (Cuentas por Cobrar + Inventarios) - Cuentas por Pagar
-            ctno = (total_cuentas_por_cobrar + total_inventarios) - total_cuentas_por_pagar
-            
+        if report_data is None:
+            report_data = get_financial_reports(anio_seleccionado)
+        
+        if not report_data:
             return {
-                'ctno': ctno,
-                'cuentas_por_cobrar': total_cuentas_por_cobrar,
-                'inventarios': total_inventarios,
-                'cuentas_por_pagar': total_cuentas_por_pagar,
+                'ctno': 0.0,
+                'cuentas_por_cobrar': 0.0,
+                'inventarios': 0.0,
+                'cuentas_por_pagar': 0.0,
                 'anio': anio_seleccionado,
-                'exito': True,
-                'mensaje': 'CTNO calculado correctamente'
+                'exito': False,
+                'mensaje': f'No se encontró el período para el año {anio_seleccionado}'
             }
+        
+        # 1. Cuentas por Cobrar, Clientes e Inventarios (Activo)
+        total_cuentas_por_cobrar = sumar_por_etiqueta(report_data['Activo'], ETIQUETA_POR_COBRAR)
+        total_clientes = sumar_por_etiqueta(report_data['Activo'], ETIQUETA_CLIENTES)
+        total_inventarios = sumar_por_etiqueta(report_data['Activo'], ETIQUETA_INVENTARIO)
+        
+        # Si no hay cuentas por cobrar, usar las cuentas con "cliente" en el nombre
+        if total_cuentas_por_cobrar == 0.0:
+            total_cuentas_por_cobrar = total_clientes
+        
+        # 2. Cuentas por Pagar (Pasivo)
+        total_cuentas_por_pagar = sumar_por_etiqueta(report_data['Pasivo'], ETIQUETA_POR_PAGAR)
+        
+        # 3. Calcular CTNO
+        # CTNO = (Cuentas por Cobrar + Inventarios) - Cuentas por Pagar
+        ctno = (total_cuentas_por_cobrar + total_inventarios) - total_cuentas_por_pagar
+        
+        return {
+            'ctno': ctno,
+            'cuentas_por_cobrar': total_cuentas_por_cobrar,
+            'inventarios': total_inventarios,
+            'cuentas_por_pagar': total_cuentas_por_pagar,
+            'anio': anio_seleccionado,
+            'exito': True,
+            'mensaje': 'CTNO calculado correctamente'
+        }
 
     except Exception as e:
         print(f"Error al calcular CTNO: {e}")
@@ -1858,247 +4025,130 @@ def calcular_feo_indirecto(fecha_inicio, fecha_fin):
         anio_fin = fecha_fin.year
         
         with engine.connect() as conn:
-            # Obtener PeriodoID para el año de inicio y fin
-            periodo_inicio_query = text("SELECT PeriodoID FROM Periodo WHERE Anio = :anio")
-            periodo_inicio_result = conn.execute(periodo_inicio_query, {"anio": anio_inicio}).fetchone()
-            periodo_fin_result = conn.execute(periodo_inicio_query, {"anio": anio_fin}).fetchone()
-            
-            if not periodo_inicio_result or not periodo_fin_result:
-                return {
-                    'feo': 0.0,
-                    'utilidad_neta': 0.0,
-                    'gastos_no_monetarios': 0.0,
-                    'cambio_cuentas_por_cobrar': 0.0,
-                    'cambio_inventarios': 0.0,
-                    'cambio_cuentas_por_pagar': 0.0,
-                    'fecha_inicio': str(fecha_inicio),
-                    'fecha_fin': str(fecha_fin),
-                    'exito': False,
-                    'mensaje': f'No se encontraron períodos para los años {anio_inicio} y/o {anio_fin}'
-                }
-            
-            periodo_id_inicio = periodo_inicio_result[0]
-            periodo_id_fin = periodo_fin_result[0]
-            
-            # 1. Calcular Utilidad Neta
-            # Ingresos Totales
-            ingresos_query = text("""
-                SELECT COALESCE(SUM(s.Monto), 0) AS total
-                FROM CatalogoCuentas c
-                INNER JOIN SaldoCuenta s ON s.CuentaID = c.CuentaID
-                WHERE s.PeriodoID = :periodo_id_fin
-                AND c.TipoCuenta = 'Ingreso'
-            """)
-            ingresos_result = conn.execute(ingresos_query, {"periodo_id_fin": periodo_id_fin}).fetchone()
-            ingresos_totales = float(ingresos_result[0]) if ingresos_result and ingresos_result[0] else 0.0
-            
-            # Costos Totales
-            costos_query = text("""
-                SELECT COALESCE(SUM(s.Monto), 0) AS total
-                FROM CatalogoCuentas c
-                INNER JOIN SaldoCuenta s ON s.CuentaID = c.CuentaID
-                WHERE s.PeriodoID = :periodo_id_fin
-                AND c.TipoCuenta = 'Costo'
-            """)
-            costos_result = conn.execute(costos_query, {"periodo_id_fin": periodo_id_fin}).fetchone()
-            costos_totales = float(costos_result[0]) if costos_result and costos_result[0] else 0.0
-            
-            # Gastos Totales
-            gastos_query = text("""
-                SELECT COALESCE(SUM(s.Monto), 0) AS total
-                FROM CatalogoCuentas c
-                INNER JOIN SaldoCuenta s ON s.CuentaID = c.CuentaID
-                WHERE s.PeriodoID = :periodo_id_fin
-                AND c.TipoCuenta = 'Gasto'
-            """)
-            gastos_result = conn.execute(gastos_query, {"periodo_id_fin": periodo_id_fin}).fetchone()
-            gastos_totales = float(gastos_result[0]) if gastos_result and gastos_result[0] else 0.0
-            
-            # Utilidad Neta = Ingresos - Costos - Gastos
-            utilidad_neta = ingresos_totales - costos_totales - gastos_totales
-            
-            # 2. Sumar Gastos No Monetarios (Depreciación y Amortización)
-            gastos_no_monetarios_query = text("""
-                SELECT COALESCE(SUM(s.Monto), 0) AS total
-                FROM CatalogoCuentas c
-                INNER JOIN SaldoCuenta s ON s.CuentaID = c.CuentaID
-                WHERE s.PeriodoID = :periodo_id_fin
-                AND c.TipoCuenta = 'Gasto'
-                AND (
-                    LOWER(c.NombreCuenta) LIKE '%depreciaci%'
-                    OR LOWER(c.NombreCuenta) LIKE '%amortizaci%'
-                    OR LOWER(c.NombreCuenta) LIKE '%deprecioaci%'
-                )
-            """)
-            gastos_no_monetarios_result = conn.execute(gastos_no_monetarios_query, {"periodo_id_fin": periodo_id_fin}).fetchone()
-            gastos_no_monetarios = abs(float(gastos_no_monetarios_result[0])) if gastos_no_monetarios_result and gastos_no_monetarios_result[0] else 0.0
-            
-            # Utilidad Ajustada = Utilidad Neta + Gastos No Monetarios
-            utilidad_ajustada = utilidad_neta + gastos_no_monetarios
-            
-            # 3. Calcular Cambios en Capital de Trabajo
-            
-            # 3.1 Cambio en Cuentas por Cobrar
-            # Saldo en fecha_fin
-            cxc_fin_query = text("""
-                SELECT COALESCE(SUM(s.Monto), 0) AS total
-                FROM CatalogoCuentas c
-                INNER JOIN SaldoCuenta s ON s.CuentaID = c.CuentaID
-                WHERE s.PeriodoID = :periodo_id_fin
-                AND (
-                    LOWER(c.NombreCuenta) LIKE '%por cobrar%' 
-                    OR LOWER(c.NombreCuenta) LIKE '%cuentas por cobrar%'
-                    OR LOWER(c.NombreCuenta) LIKE '%cobrar%'
-                )
-                AND c.TipoCuenta = 'Activo'
-            """)
-            cxc_fin_result = conn.execute(cxc_fin_query, {"periodo_id_fin": periodo_id_fin}).fetchone()
-            cxc_fin = float(cxc_fin_result[0]) if cxc_fin_result and cxc_fin_result[0] else 0.0
-            
-            # Si no hay cuentas por cobrar, buscar clientes
-            if cxc_fin == 0.0:
-                clientes_fin_query = text("""
-                    SELECT COALESCE(SUM(s.Monto), 0) AS total
-                    FROM CatalogoCuentas c
-                    INNER JOIN SaldoCuenta s ON s.CuentaID = c.CuentaID
-                    WHERE s.PeriodoID = :periodo_id_fin
-                    AND (
-                        LOWER(c.NombreCuenta) LIKE '%cliente%'
-                        OR LOWER(c.NombreCuenta) LIKE '%clientes%'
-                    )
-                    AND c.TipoCuenta = 'Activo'
-                """)
-                clientes_fin_result = conn.execute(clientes_fin_query, {"periodo_id_fin": periodo_id_fin}).fetchone()
-                cxc_fin = float(clientes_fin_result[0]) if clientes_fin_result and clientes_fin_result[0] else 0.0
-            
-            # Saldo en fecha_inicio
-            cxc_inicio_query = text("""
-                SELECT COALESCE(SUM(s.Monto), 0) AS total
-                FROM CatalogoCuentas c
-                INNER JOIN SaldoCuenta s ON s.CuentaID = c.CuentaID
-                WHERE s.PeriodoID = :periodo_id_inicio
-                AND (
-                    LOWER(c.NombreCuenta) LIKE '%por cobrar%' 
-                    OR LOWER(c.NombreCuenta) LIKE '%cuentas por cobrar%'
-                    OR LOWER(c.NombreCuenta) LIKE '%cobrar%'
-                )
-                AND c.TipoCuenta = 'Activo'
-            """)
-            cxc_inicio_result = conn.execute(cxc_inicio_query, {"periodo_id_inicio": periodo_id_inicio}).fetchone()
-            cxc_inicio = float(cxc_inicio_result[0]) if cxc_inicio_result and cxc_inicio_result[0] else 0.0
-            
-            # Si no hay cuentas por cobrar, buscar clientes
-            if cxc_inicio == 0.0:
-                clientes_inicio_query = text("""
-                    SELECT COALESCE(SUM(s.Monto), 0) AS total
-                    FROM CatalogoCuentas c
-                    INNER JOIN SaldoCuenta s ON s.CuentaID = c.CuentaID
-                    WHERE s.PeriodoID = :periodo_id_inicio
-                    AND (
-                        LOWER(c.NombreCuenta) LIKE '%cliente%'
-                        OR LOWER(c.NombreCuenta) LIKE '%clientes%'
-                    )
-                    AND c.TipoCuenta = 'Activo'
-                """)
-                clientes_inicio_result = conn.execute(clientes_inicio_query, {"periodo_id_inicio": periodo_id_inicio}).fetchone()
-                cxc_inicio = float(clientes_inicio_result[0]) if clientes_inicio_result and clientes_inicio_result[0] else 0.0
-            
-            # Cambio en Cuentas por Cobrar = Saldo fin - Saldo inicio
-            cambio_cxc = cxc_fin - cxc_inicio
-            
-            # 3.2 Cambio en Inventarios
-            # Saldo en fecha_fin
-            inventarios_fin_query = text("""
-                SELECT COALESCE(SUM(s.Monto), 0) AS total
-                FROM CatalogoCuentas c
-                INNER JOIN SaldoCuenta s ON s.CuentaID = c.CuentaID
-                WHERE s.PeriodoID = :periodo_id_fin
-                AND LOWER(c.NombreCuenta) LIKE '%inventario%'
-                AND c.TipoCuenta = 'Activo'
-            """)
-            inventarios_fin_result = conn.execute(inventarios_fin_query, {"periodo_id_fin": periodo_id_fin}).fetchone()
-            inventarios_fin = float(inventarios_fin_result[0]) if inventarios_fin_result and inventarios_fin_result[0] else 0.0
-            
-            # Saldo en fecha_inicio
-            inventarios_inicio_query = text("""
-                SELECT COALESCE(SUM(s.Monto), 0) AS total
-                FROM CatalogoCuentas c
-                INNER JOIN SaldoCuenta s ON s.CuentaID = c.CuentaID
-                WHERE s.PeriodoID = :periodo_id_inicio
-                AND LOWER(c.NombreCuenta) LIKE '%inventario%'
-                AND c.TipoCuenta = 'Activo'
-            """)
-            inventarios_inicio_result = conn.execute(inventarios_inicio_query, {"periodo_id_inicio": periodo_id_inicio}).fetchone()
-            inventarios_inicio = float(inventarios_inicio_result[0]) if inventarios_inicio_result and inventarios_inicio_result[0] else 0.0
-            
-            # Cambio en Inventarios = Saldo fin - Saldo inicio
-            cambio_inventarios = inventarios_fin - inventarios_inicio
-            
-            # 3.3 Cambio en Cuentas por Pagar
-            # Saldo en fecha_fin
-            cxp_fin_query = text("""
-                SELECT COALESCE(SUM(s.Monto), 0) AS total
-                FROM CatalogoCuentas c
-                INNER JOIN SaldoCuenta s ON s.CuentaID = c.CuentaID
-                WHERE s.PeriodoID = :periodo_id_fin
-                AND (
-                    LOWER(c.NombreCuenta) LIKE '%por pagar%' 
-                    OR LOWER(c.NombreCuenta) LIKE '%cuentas por pagar%'
-                    OR LOWER(c.NombreCuenta) LIKE '%pagar%'
-                )
-                AND c.TipoCuenta = 'Pasivo'
-            """)
-            cxp_fin_result = conn.execute(cxp_fin_query, {"periodo_id_fin": periodo_id_fin}).fetchone()
-            cxp_fin = float(cxp_fin_result[0]) if cxp_fin_result and cxp_fin_result[0] else 0.0
-            
-            # Saldo en fecha_inicio
-            cxp_inicio_query = text("""
-                SELECT COALESCE(SUM(s.Monto), 0) AS total
-                FROM CatalogoCuentas c
-                INNER JOIN SaldoCuenta s ON s.CuentaID = c.CuentaID
-                WHERE s.PeriodoID = :periodo_id_inicio
-                AND (
-                    LOWER(c.NombreCuenta) LIKE '%por pagar%' 
-                    OR LOWER(c.NombreCuenta) LIKE '%cuentas por pagar%'
-                    OR LOWER(c.NombreCuenta) LIKE '%pagar%'
-                )
-                AND c.TipoCuenta = 'Pasivo'
+            # Una sola consulta con el saldo de cada cuenta en ambos años; los rubros se
+            # arman con las etiquetas del catálogo clasificado
+            saldos_query = text("""
+                SELECT
+                    p.Anio AS anio,
+                    c.CuentaID AS cuenta_id,
+                    c.NombreCuenta AS nombre,
+                    c.TipoCuenta AS tipo,
+                    COALESCE(SUM(s.Monto), 0) AS monto
+                FROM Periodo p
+                LEFT JOIN SaldoCuenta s ON s.PeriodoID = p.PeriodoID
+                LEFT JOIN CatalogoCuentas c ON c.CuentaID = s.CuentaID
+                WHERE p.Anio IN (:anio_inicio, :anio_fin)
+                GROUP BY p.Anio, c.CuentaID, c.NombreCuenta, c.TipoCuenta
             """)
-            cxp_inicio_result = conn.execute(cxp_inicio_query, {"periodo_id_inicio": periodo_id_inicio}).fetchone()
-            cxp_inicio = float(cxp_inicio_result[0]) if cxp_inicio_result and cxp_inicio_result[0] else 0.0
-            
-            # Cambio en Cuentas por Pagar = Saldo fin - Saldo inicio
-            cambio_cxp = cxp_fin - cxp_inicio
-            
-            # 4. Calcular FEO Final
-            # FEO = Utilidad Ajustada - Cambio CxC - Cambio Inventarios + Cambio CxP
-            feo = utilidad_ajustada - cambio_cxc - cambio_inventarios + cambio_cxp
+            resultados = conn.execute(saldos_query, {"anio_inicio": anio_inicio, "anio_fin": anio_fin}).fetchall()
+        
+        # Rubros por año: {anio: {'ingresos': ..., 'costos': ..., ...}}
+        catalogo = obtener_catalogo_cuentas()
+        rubros = {}
+        for row in resultados:
+            valores = rubros.setdefault(row[0], {
+                'ingresos': 0.0, 'costos': 0.0, 'gastos': 0.0, 'gastos_no_monetarios': 0.0,
+                'cxc': 0.0, 'clientes': 0.0, 'inventarios': 0.0, 'cxp': 0.0
+            })
+            if row[1] is None:
+                # Período sin saldos
+                continue
+            tipo = row[3]
+            monto = float(row[4]) if row[4] else 0.0
+            etiquetas = etiquetas_cuenta({'id': row[1], 'nombre': row[2]}, catalogo)
             
+            if tipo == 'Ingreso':
+                valores['ingresos'] += monto
+            elif tipo == 'Costo':
+                valores['costos'] += monto
+            elif tipo == 'Gasto':
+                valores['gastos'] += monto
+                if ETIQUETA_DEPRECIACION in etiquetas or ETIQUETA_AMORTIZACION in etiquetas:
+                    valores['gastos_no_monetarios'] += monto
+            elif tipo == 'Activo':
+                if ETIQUETA_POR_COBRAR in etiquetas:
+                    valores['cxc'] += monto
+                if ETIQUETA_CLIENTES in etiquetas:
+                    valores['clientes'] += monto
+                if ETIQUETA_INVENTARIO in etiquetas:
+                    valores['inventarios'] += monto
+            elif tipo == 'Pasivo':
+                if ETIQUETA_POR_PAGAR in etiquetas:
+                    valores['cxp'] += monto
+        
+        # Si no hay cuentas por cobrar, usar las cuentas de clientes
+        for valores in rubros.values():
+            if valores['cxc'] == 0.0:
+                valores['cxc'] = valores['clientes']
+        
+        if anio_inicio not in rubros or anio_fin not in rubros:
             return {
-                'feo': feo,
-                'utilidad_neta': utilidad_neta,
-                'ingresos_totales': ingresos_totales,
-                'costos_totales': costos_totales,
-                'gastos_totales': gastos_totales,
-                'gastos_no_monetarios': gastos_no_monetarios,
-                'utilidad_ajustada': utilidad_ajustada,
-                'cambio_cuentas_por_cobrar': cambio_cxc,
-                'cxc_inicio': cxc_inicio,
-                'cxc_fin': cxc_fin,
-                'cambio_inventarios': cambio_inventarios,
-                'inventarios_inicio': inventarios_inicio,
-                'inventarios_fin': inventarios_fin,
-                'cambio_cuentas_por_pagar': cambio_cxp,
-                'cxp_inicio': cxp_inicio,
-                'cxp_fin': cxp_fin,
+                'feo': 0.0,
+                'utilidad_neta': 0.0,
+                'gastos_no_monetarios': 0.0,
+                'cambio_cuentas_por_cobrar': 0.0,
+                'cambio_inventarios': 0.0,
+                'cambio_cuentas_por_pagar': 0.0,
                 'fecha_inicio': str(fecha_inicio),
                 'fecha_fin': str(fecha_fin),
-                'anio_inicio': anio_inicio,
-                'anio_fin': anio_fin,
-                'exito': True,
-                'mensaje': 'FEO calculado correctamente'
+                'exito': False,
+                'mensaje': f'No se encontraron períodos para los años {anio_inicio} y/o {anio_fin}'
             }
-            
+        
+        inicio = rubros[anio_inicio]
+        fin = rubros[anio_fin]
+        
+        # 1. Calcular Utilidad Neta = Ingresos - Costos - Gastos
+        ingresos_totales = fin['ingresos']
+        costos_totales = fin['costos']
+        gastos_totales = fin['gastos']
+        utilidad_neta = ingresos_totales - costos_totales - gastos_totales
+        
+        # 2. Sumar Gastos No Monetarios (Depreciación y Amortización)
+        gastos_no_monetarios = abs(fin['gastos_no_monetarios'])
+        
+        # Utilidad Ajustada = Utilidad Neta + Gastos No Monetarios
+        utilidad_ajustada = utilidad_neta + gastos_no_monetarios
+        
+        # 3. Calcular Cambios en Capital de Trabajo (Saldo fin - Saldo inicio)
+        cxc_inicio, cxc_fin = inicio['cxc'], fin['cxc']
+        cambio_cxc = cxc_fin - cxc_inicio
+        
+        inventarios_inicio, inventarios_fin = inicio['inventarios'], fin['inventarios']
+        cambio_inventarios = inventarios_fin - inventarios_inicio
+        
+        cxp_inicio, cxp_fin = inicio['cxp'], fin['cxp']
+        cambio_cxp = cxp_fin - cxp_inicio
+        
+        # 4. Calcular FEO Final
+        # FEO = Utilidad Ajustada - Cambio CxC - Cambio Inventarios + Cambio CxP
+        feo = utilidad_ajustada - cambio_cxc - cambio_inventarios + cambio_cxp
+        
+        return {
+            'feo': feo,
+            'utilidad_neta': utilidad_neta,
+            'ingresos_totales': ingresos_totales,
+            'costos_totales': costos_totales,
+            'gastos_totales': gastos_totales,
+            'gastos_no_monetarios': gastos_no_monetarios,
+            'utilidad_ajustada': utilidad_ajustada,
+            'cambio_cuentas_por_cobrar': cambio_cxc,
+            'cxc_inicio': cxc_inicio,
+            'cxc_fin': cxc_fin,
+            'cambio_inventarios': cambio_inventarios,
+            'inventarios_inicio': inventarios_inicio,
+            'inventarios_fin': inventarios_fin,
+            'cambio_cuentas_por_pagar': cambio_cxp,
+            'cxp_inicio': cxp_inicio,
+            'cxp_fin': cxp_fin,
+            'fecha_inicio': str(fecha_inicio),
+            'fecha_fin': str(fecha_fin),
+            'anio_inicio': anio_inicio,
+            'anio_fin': anio_fin,
+            'exito': True,
+            'mensaje': 'FEO calculado correctamente'
+        }
+        
     except Exception as e:
         print(f"Error al calcular FEO: {e}")
         import traceback
@@ -2122,8 +4172,9 @@ def calcular_estado_flujo_efectivo(periodo_inicio, periodo_fin):
     Wrapper para la clase CashFlowEngine.
     """
     try:
-        report_ant = get_financial_reports(periodo_inicio)
-        report_act = get_financial_reports(periodo_fin)
+        reportes = get_financial_reports_many([periodo_inicio, periodo_fin])
+        report_ant = reportes.get(periodo_inicio)
+        report_act = reportes.get(periodo_fin)
         
         if not report_ant or not report_act:
              return {
@@ -2172,6 +4223,7 @@ class CashFlowEngine:
         }
         self.depreciacion = 0.0
         self.utilidad_neta = 0.0
+        self.catalogo = obtener_catalogo_cuentas()
 
     def ejecutar(self):
         # 1. Obtener datos base
@@ -2197,8 +4249,8 @@ class CashFlowEngine:
             # Buscar en todo el Activo (usando el helper existente)
             cuentas = self._flatten_report_section(report, 'Activo')
             for c in cuentas.values():
-                nombre = c['nombre'].lower()
-                if 'depreciaci' in nombre or 'amortizaci' in nombre:
+                etiquetas = etiquetas_cuenta(c, self.catalogo)
+                if ETIQUETA_DEPRECIACION in etiquetas or ETIQUETA_AMORTIZACION in etiquetas:
                     # Depreciación acumulada suele ser negativa (contra-activo). Usamos abs.
                     total += abs(c['monto'])
             return total
@@ -2237,7 +4289,7 @@ class CashFlowEngine:
             if not nombre: continue
             
             # Filtrar solo operativos
-            if self._es_operativo_activo(nombre):
+            if ETIQUETA_ACTIVO_OPERATIVO in self._etiquetas(cid, nombre):
                 saldo_ant = activos_ant.get(cid, {}).get('monto', 0.0)
                 saldo_act = activos_act.get(cid, {}).get('monto', 0.0)
                 
@@ -2258,7 +4310,7 @@ class CashFlowEngine:
             if not nombre: continue
 
             # Filtrar solo operativos
-            if self._es_operativo_pasivo(nombre):
+            if ETIQUETA_PASIVO_OPERATIVO in self._etiquetas(cid, nombre):
                 saldo_ant = pasivos_ant.get(cid, {}).get('monto', 0.0)
                 saldo_act = pasivos_act.get(cid, {}).get('monto', 0.0)
                 
@@ -2287,7 +4339,7 @@ class CashFlowEngine:
             nombre = activos_act.get(cid, {}).get('nombre') or activos_ant.get(cid, {}).get('nombre')
             if not nombre: continue
 
-            if self._es_inversion(nombre):
+            if ETIQUETA_ACTIVO_FIJO in self._etiquetas(cid, nombre):
                 saldo_ant = activos_ant.get(cid, {}).get('monto', 0.0)
                 saldo_act = activos_act.get(cid, {}).get('monto', 0.0)
                 
@@ -2318,7 +4370,7 @@ class CashFlowEngine:
             nombre = pasivos_act.get(cid, {}).get('nombre') or pasivos_ant.get(cid, {}).get('nombre')
             if not nombre: continue
 
-            if self._es_financiamiento_pasivo(nombre):
+            if ETIQUETA_DEUDA_FINANCIERA in self._etiquetas(cid, nombre):
                 saldo_ant = pasivos_ant.get(cid, {}).get('monto', 0.0)
                 saldo_act = pasivos_act.get(cid, {}).get('monto', 0.0)
                 
@@ -2340,13 +4392,12 @@ class CashFlowEngine:
         for cid in todas_cuentas_pat:
             nombre = patrimonio_act.get(cid, {}).get('nombre') or patrimonio_ant.get(cid, {}).get('nombre')
             if not nombre: continue
-            nombre_lower = nombre.lower()
             
             saldo_ant = patrimonio_ant.get(cid, {}).get('monto', 0.0)
             saldo_act = patrimonio_act.get(cid, {}).get('monto', 0.0)
             
             # Identificar Utilidades para el cálculo de dividendos
-            if any(x in nombre_lower for x in ['utilidad', 'resultado', 'ganancia', 'perdida', 'ejercicio', 'acumulada']):
+            if ETIQUETA_UTILIDADES_RETENIDAS in self._etiquetas(cid, nombre):
                 utilidad_acumulada_ant += saldo_ant
                 utilidad_acumulada_act += saldo_act
                 continue 
@@ -2403,72 +4454,16 @@ class CashFlowEngine:
                     cuentas[c['id']] = c
         return cuentas
 
-    def _es_efectivo(self, nombre):
-        if not nombre: return False
-        n = nombre.lower()
-        return any(x in n for x in ['caja', 'banco', 'efectivo', 'cash', 'disponible'])
-
-    def _es_operativo_activo(self, nombre):
-        """Regla 3A: Clientes, Inventarios, Anticipos, etc."""
-        if not nombre: return False
-        n = nombre.lower()
-        
-        # Excluir explícitamente efectivo e inversión
-        if self._es_efectivo(nombre): return False
-        if self._es_inversion(nombre): return False
-        
-        # Palabras clave operativas
-        keywords = ['cliente', 'cobrar', 'inventario', 'almacen', 'anticipo', 
-                   'deposito', 'garantia', 'otro activo', 'impuesto', 'renta', 'iva', 'acreditable',
-                   'obra', 'trabajo', 'proceso', 'pago anticipado', 'pagos anticipados']
-        
-        return any(x in n for x in keywords)
-
-    def _es_operativo_pasivo(self, nombre):
-        """Regla 3A: Proveedores, Impuestos, etc."""
-        if not nombre: return False
-        n = nombre.lower()
-        
-        # Excluir financiamiento
-        if self._es_financiamiento_pasivo(nombre): return False
-        
-        # Palabras clave operativas
-        keywords = ['proveedor', 'acreedor', 'por pagar', 'impuesto', 'retencion', 
-                   'iva', 'acumulado', 'laboral', 'sueldo', 'salario']
-        
-        return any(x in n for x in keywords)
-
-    def _es_inversion(self, nombre):
-        """Regla 3B: Activos Fijos Tangibles"""
-        if not nombre: return False
-        n = nombre.lower()
-        
-        # EXCLUIR DEPRECIACIÓN (Regla de Oro 2)
-        if 'depreciaci' in n or 'amortizaci' in n: return False
-        
-        # Excluir Obras en Proceso (Regla Hotfix 1)
-        if 'proceso' in n or 'obra' in n or 'trabajo' in n: return False
-        
-        keywords = ['maquinaria', 'equipo', 'edificio', 'terreno', 'vehiculo', 
-                   'rodante', 'mobiliario', 'construccion', 'propiedad']
-        
-        return any(x in n for x in keywords)
-
-    def _es_financiamiento_pasivo(self, nombre):
-        """Regla 3C: Préstamos Bancarios"""
-        if not nombre: return False
-        n = nombre.lower()
-        
-        keywords = ['prestamo', 'préstamo', 'credito', 'crédito', 'bancari', 'financier', 'hipoteca']
-        
-        return any(x in n for x in keywords)
+    def _etiquetas(self, cid, nombre):
+        """Etiquetas de la cuenta según el catálogo clasificado (ver clasificar_cuenta)"""
+        return etiquetas_cuenta({'id': cid, 'nombre': nombre}, self.catalogo)
 
     def _calcular_efectivo_total(self, reporte):
         total = 0.0
         # Buscar en todo el activo, no solo corriente, por si acaso
         activos = self._flatten_report_section(reporte, 'Activo')
         for c in activos.values():
-            if self._es_efectivo(c['nombre']):
+            if ETIQUETA_EFECTIVO in etiquetas_cuenta(c, self.catalogo):
                 total += c['monto']
         return total
 
@@ -2480,8 +4475,9 @@ def generar_analisis_dupont(anio_actual):
     try:
         anio_anterior = anio_actual - 1
         
-        report_act = get_financial_reports(anio_actual)
-        report_ant = get_financial_reports(anio_anterior)
+        reportes = get_financial_reports_many([anio_actual, anio_anterior])
+        report_act = reportes.get(anio_actual)
+        report_ant = reportes.get(anio_anterior)
         
         # Si no hay datos del año anterior, intentamos calcular solo el actual
         # pero para la comparativa necesitamos ambos.
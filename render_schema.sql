@@ -55,3 +55,12 @@ CREATE TABLE SaldoCuenta (
     CONSTRAINT FK_Saldo_Cuenta FOREIGN KEY (CuentaID) REFERENCES CatalogoCuentas(CuentaID),
     CONSTRAINT UQ_Cuenta_Periodo UNIQUE (PeriodoID, CuentaID)
 );
+
+-- Tabla VersionDatos (versión compartida de las cachés entre workers)
+CREATE TABLE VersionDatos (
+    Nombre VARCHAR(20) PRIMARY KEY,
+    Version BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT INTO VersionDatos (Nombre, Version) VALUES ('catalogo', 0);
+INSERT INTO VersionDatos (Nombre, Version) VALUES ('usuarios', 0);
@@ -0,0 +1,83 @@
+"""
+Configuración común de las pruebas: corren sin base de datos ni API key.
+
+El engine de extensions.py se crea con una URL de SQLite que nunca se abre (SQLAlchemy
+no conecta hasta el primer uso) y las pruebas que tocan la BD reemplazan
+utils.engine por MotorFalso, que registra las sentencias y devuelve filas fijas.
+"""
+import os
+import sys
+import tempfile
+
+_TEMPORAL = tempfile.mkdtemp(prefix='finanzas_pruebas_')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_TEMPORAL, 'sin_uso.sqlite')
+os.environ['IA_CACHE_DIR'] = os.path.join(_TEMPORAL, 'ia_cache')
+os.environ['IA_MODELO_FALSO'] = '1'
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from app import utils
+
+
+class ResultadoFalso:
+    def __init__(self, filas):
+        self.filas = list(filas)
+
+    def fetchall(self):
+        return self.filas
+
+    def fetchone(self):
+        return self.filas[0] if self.filas else None
+
+    def scalar(self):
+        return self.filas[0][0] if self.filas else None
+
+
+class ConexionFalsa:
+    """Registra (sql, parametros) y responde con las filas de la primera consulta que coincide."""
+
+    def __init__(self, respuestas):
+        self.respuestas = respuestas
+        self.sentencias = []
+
+    def execute(self, sentencia, parametros=None):
+        sql = ' '.join(str(sentencia).split())
+        self.sentencias.append((sql, parametros))
+        for inicio, filas in self.respuestas.items():
+            if sql.startswith(inicio):
+                return ResultadoFalso(filas)
+        return ResultadoFalso([])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class MotorFalso:
+    """Sustituto de utils.engine: begin() y connect() comparten una ConexionFalsa."""
+
+    def __init__(self, respuestas=None):
+        self.conexion = ConexionFalsa(respuestas or {})
+
+    def begin(self):
+        return self.conexion
+
+    def connect(self):
+        return self.conexion
+
+    def sentencias(self, inicio):
+        return [(sql, parametros) for sql, parametros in self.conexion.sentencias if sql.startswith(inicio)]
+
+
+@pytest.fixture
+def motor_falso(monkeypatch):
+    """Devuelve una función que instala un MotorFalso con las respuestas indicadas."""
+    def instalar(respuestas=None):
+        motor = MotorFalso(respuestas)
+        monkeypatch.setattr(utils, 'engine', motor)
+        return motor
+    return instalar
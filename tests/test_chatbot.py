@@ -0,0 +1,51 @@
+import pytest
+
+from app import utils
+
+
+@pytest.mark.parametrize('a, b', [
+    ('¿Qué es el ROE?', 'que es roe'),
+    ('QUÉ ES LA liquidez corriente', '¿qué es liquidez corriente?'),
+    ('Define: margen bruto', 'define el margen bruto'),
+])
+def test_clave_pregunta_chatbot_equivalentes(a, b):
+    clave = utils.clave_pregunta_chatbot(a)
+    assert clave is not None
+    assert clave == utils.clave_pregunta_chatbot(b)
+
+
+def test_clave_pregunta_chatbot_distingue_conceptos():
+    assert utils.clave_pregunta_chatbot('¿Qué es el ROE?') != utils.clave_pregunta_chatbot('¿Qué es el ROA?')
+
+
+@pytest.mark.parametrize('mensaje', [
+    '¿Cómo está mi liquidez este año?',
+    'queso es un activo',
+    '¿Qué es lo que debería hacer con mi empresa si las ventas bajaron este año?',
+    '',
+])
+def test_clave_pregunta_chatbot_solo_definiciones(mensaje):
+    assert utils.clave_pregunta_chatbot(mensaje) is None
+
+
+def test_consumir_token_chatbot_rafaga_y_espera(monkeypatch):
+    monkeypatch.setattr(utils, '_limites_chatbot', {})
+    monkeypatch.setattr(utils, 'CHATBOT_RAFAGA', 2)
+    monkeypatch.setattr(utils, 'CHATBOT_POR_MINUTO', 6.0)
+
+    assert utils.consumir_token_chatbot(1) == (True, 0)
+    assert utils.consumir_token_chatbot(1) == (True, 0)
+    permitido, espera = utils.consumir_token_chatbot(1)
+    assert not permitido and 0 < espera <= 10
+    assert utils.consumir_token_chatbot(2) == (True, 0)
+
+
+def test_historial_chatbot_guarda_los_ultimos_turnos(monkeypatch):
+    monkeypatch.setattr(utils, '_conversaciones_chatbot', {})
+    for i in range(utils.CHATBOT_HISTORIAL_TURNOS + 2):
+        utils.registrar_respuesta_chatbot(7, f'pregunta {i}', f'respuesta {i}')
+
+    historial = utils.historial_chatbot(7)
+    assert len(historial) == utils.CHATBOT_HISTORIAL_TURNOS
+    assert historial[-1] == (f'pregunta {utils.CHATBOT_HISTORIAL_TURNOS + 1}', f'respuesta {utils.CHATBOT_HISTORIAL_TURNOS + 1}')
+    assert utils.historial_chatbot(8) == []
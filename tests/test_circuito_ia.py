@@ -0,0 +1,103 @@
+import time
+
+import pytest
+
+from app import utils
+
+MODELO = 'modelo-prueba'
+
+
+class ModeloQueFalla:
+    def __init__(self):
+        self.llamadas = 0
+        self.fallar = True
+
+    def generate_content(self, prompt, **kwargs):
+        self.llamadas += 1
+        if self.fallar:
+            raise RuntimeError('error del modelo')
+        return utils._RespuestaIAFalsa('ok')
+
+
+@pytest.fixture
+def modelo(monkeypatch):
+    instancia = ModeloQueFalla()
+    monkeypatch.setattr(utils, '_circuitos_ia', {})
+    monkeypatch.setattr(utils, 'IA_CIRCUITO_FALLOS', 2)
+    monkeypatch.setattr(utils, 'obtener_modelo_ia', lambda nombre: instancia)
+    return instancia
+
+
+def _abrir(modelo):
+    for _ in range(utils.IA_CIRCUITO_FALLOS):
+        with pytest.raises(RuntimeError, match='error del modelo'):
+            utils.llamar_modelo_ia(MODELO, 'prompt')
+
+
+def _vencer_espera():
+    utils._circuitos_ia[MODELO]['abierto_hasta'] = time.monotonic() - 1
+
+
+def test_circuito_cerrado_admite_llamadas_y_cuenta_fallos(modelo):
+    modelo.fallar = False
+    assert utils.llamar_modelo_ia(MODELO, 'prompt') == 'ok'
+    assert not utils._circuito_abierto(MODELO)
+
+    modelo.fallar = True
+    with pytest.raises(RuntimeError):
+        utils.llamar_modelo_ia(MODELO, 'prompt')
+    assert utils._circuitos_ia[MODELO]['fallos'] == 1
+    assert not utils._circuito_abierto(MODELO)
+
+
+def test_circuito_abierto_rechaza_sin_llamar_al_modelo(modelo):
+    _abrir(modelo)
+    assert utils._circuito_abierto(MODELO)
+
+    llamadas = modelo.llamadas
+    with pytest.raises(utils.IANoDisponibleError):
+        utils.llamar_modelo_ia(MODELO, 'prompt')
+    assert modelo.llamadas == llamadas
+
+
+def test_circuito_semiabierto_admite_una_sola_prueba(modelo):
+    _abrir(modelo)
+    _vencer_espera()
+    assert not utils._circuito_abierto(MODELO)
+
+    assert utils._admitir_llamada_ia(MODELO) == (True, True)
+    assert utils._circuito_abierto(MODELO)
+    assert utils._admitir_llamada_ia(MODELO) == (False, False)
+
+    utils._cancelar_prueba_ia(MODELO)
+    assert utils._admitir_llamada_ia(MODELO) == (True, True)
+
+
+def test_prueba_exitosa_cierra_el_circuito(modelo):
+    _abrir(modelo)
+    _vencer_espera()
+    modelo.fallar = False
+
+    assert utils.llamar_modelo_ia(MODELO, 'prompt') == 'ok'
+    assert utils._circuitos_ia[MODELO] == utils._nuevo_circuito_ia()
+    assert utils._admitir_llamada_ia(MODELO) == (True, False)
+
+
+def test_prueba_fallida_reabre_el_circuito(modelo):
+    _abrir(modelo)
+    _vencer_espera()
+
+    with pytest.raises(RuntimeError, match='error del modelo'):
+        utils.llamar_modelo_ia(MODELO, 'prompt')
+    circuito = utils._circuitos_ia[MODELO]
+    assert circuito['abierto_hasta'] > time.monotonic()
+    assert not circuito['en_prueba']
+    with pytest.raises(utils.IANoDisponibleError):
+        utils.llamar_modelo_ia(MODELO, 'prompt')
+
+
+def test_ia_en_pausa_con_todos_los_circuitos_abiertos(modelo, monkeypatch):
+    monkeypatch.setitem(utils.MODELOS_IA, 'analisis', [MODELO])
+    assert not utils.ia_en_pausa('analisis')
+    _abrir(modelo)
+    assert utils.ia_en_pausa('analisis')
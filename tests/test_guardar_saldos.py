@@ -0,0 +1,38 @@
+from decimal import Decimal
+
+from app import utils
+
+
+def test_guardar_saldos_repetidos_gana_el_ultimo(motor_falso):
+    motor = motor_falso()
+    saldos = [
+        ('1101', 1, Decimal('10.00')),
+        ('1102', 1, Decimal('20.00')),
+        ('1101', 1, Decimal('30.00')),
+    ]
+    with motor.begin() as conn:
+        guardados = utils.guardar_saldos(conn, saldos)
+
+    assert guardados == 2
+    (sql, parametros), = motor.sentencias('INSERT INTO SaldoCuenta')
+    assert 'ON CONFLICT (PeriodoID, CuentaID)' in sql
+    filas = {(parametros[f'v{i}_0'], parametros[f'v{i}_1']): parametros[f'v{i}_2'] for i in range(2)}
+    assert filas == {('1101', 1): Decimal('30.00'), ('1102', 1): Decimal('20.00')}
+
+
+def test_guardar_saldos_en_lotes(motor_falso, monkeypatch):
+    monkeypatch.setattr(utils, 'SALDOS_LOTE', 2)
+    motor = motor_falso()
+    saldos = [(f'11{i:02d}', 1, Decimal(i)) for i in range(5)]
+    with motor.begin() as conn:
+        assert utils.guardar_saldos(conn, saldos) == 5
+
+    lotes = motor.sentencias('INSERT INTO SaldoCuenta')
+    assert [len(parametros) // 3 for _, parametros in lotes] == [2, 2, 1]
+
+
+def test_guardar_saldos_sin_filas_no_escribe(motor_falso):
+    motor = motor_falso()
+    with motor.begin() as conn:
+        assert utils.guardar_saldos(conn, []) == 0
+    assert motor.sentencias('INSERT') == []
@@ -0,0 +1,115 @@
+import io
+from decimal import Decimal
+
+import pytest
+from openpyxl import Workbook
+
+from app import utils
+
+
+@pytest.mark.parametrize('valor, esperado', [
+    ('1234.56', Decimal('1234.56')),
+    (' -7 ', Decimal('-7')),
+    (1500, Decimal('1500')),
+    (0.1, Decimal('0.1')),
+    (Decimal('9999999999999999.99'), Decimal('9999999999999999.99')),
+    ('', None),
+    (None, None),
+])
+def test_convertir_monto_validos(valor, esperado):
+    assert utils.convertir_monto(valor) == esperado
+
+
+@pytest.mark.parametrize('valor, mensaje', [
+    ('abc', 'monto inválido'),
+    ('NaN', 'monto inválido'),
+    ('Infinity', 'monto inválido'),
+    (True, 'monto inválido'),
+    ('10000000000000000', 'monto fuera de rango'),
+    ('1.005', 'monto con más de 2 decimales'),
+])
+def test_convertir_monto_invalidos(valor, mensaje):
+    with pytest.raises(ValueError, match=mensaje):
+        utils.convertir_monto(valor)
+
+
+def _csv(texto):
+    return io.BytesIO(texto.encode('utf-8'))
+
+
+def test_leer_filas_acepta_alias_de_encabezados():
+    archivo = _csv('Saldo,Año,Cuenta ID,Comentario\n100.50,2023,1101,x\n\n,,,\n200,2024,1102,y\n')
+    filas = list(utils.leer_filas_importacion(archivo, 'saldos.CSV'))
+    assert filas == [
+        (2, {'cuenta_id': '1101', 'anio': '2023', 'monto': '100.50'}),
+        (5, {'cuenta_id': '1102', 'anio': '2024', 'monto': '200'}),
+    ]
+
+
+def test_leer_filas_punto_y_coma_usa_coma_decimal():
+    archivo = _csv('\ufeffCuenta;Periodo;Monto\n1101;2023;1.234,56\n')
+    filas = list(utils.leer_filas_importacion(archivo, 'saldos.csv'))
+    assert filas == [(2, {'cuenta_id': '1101', 'anio': '2023', 'monto': '1234.56'})]
+    assert utils.convertir_monto(filas[0][1]['monto']) == Decimal('1234.56')
+
+
+def test_leer_filas_xlsx():
+    wb = Workbook()
+    ws = wb.active
+    ws.append(['Código', 'Año', 'Monto'])
+    ws.append([1101, 2023, 99.5])
+    archivo = io.BytesIO()
+    wb.save(archivo)
+    archivo.seek(0)
+
+    (numero_fila, fila), = utils.leer_filas_importacion(archivo, 'saldos.xlsx')
+    assert numero_fila == 2
+    assert utils._texto_celda(fila['cuenta_id']) == '1101'
+    assert fila['monto'] == 99.5
+
+
+def test_leer_filas_rechaza_encabezados_y_formato():
+    with pytest.raises(ValueError, match='CuentaID, Anio y Monto'):
+        list(utils.leer_filas_importacion(_csv('Cuenta,Monto\n1101,5\n'), 'saldos.csv'))
+    with pytest.raises(ValueError, match='Formato no soportado'):
+        list(utils.leer_filas_importacion(_csv(''), 'saldos.txt'))
+
+
+def test_cargar_saldos_importados_valida_contra_el_catalogo(motor_falso):
+    motor = motor_falso({'SELECT CuentaID FROM CatalogoCuentas': [('1101',)]})
+    filas = [
+        (2, {'cuenta_id': '1101', 'anio': '2023', 'monto': '10'}),
+        (3, {'cuenta_id': '9999', 'anio': '2023', 'monto': '10'}),
+        (4, {'cuenta_id': '1101', 'anio': '1800', 'monto': '10'}),
+        (5, {'cuenta_id': '1101', 'anio': '2023', 'monto': '1.234'}),
+    ]
+    resultado = utils.cargar_saldos_importados(filas)
+
+    assert resultado['total_errores'] == 3
+    assert [numero for numero, _ in resultado['errores']] == [3, 4, 5]
+    assert resultado['guardados'] == 0
+    assert motor.sentencias('INSERT') == []
+
+
+def test_cargar_saldos_importados_guarda_en_una_transaccion(motor_falso):
+    motor = motor_falso({
+        'SELECT CuentaID FROM CatalogoCuentas': [('1101',), ('1102',)],
+        'SELECT Anio, PeriodoID FROM Periodo': [(2023, 7)],
+    })
+    filas = [
+        (2, {'cuenta_id': '1101', 'anio': '2023', 'monto': '10'}),
+        (3, {'cuenta_id': 1102.0, 'anio': 2023.0, 'monto': 5.25}),
+    ]
+    resultado = utils.cargar_saldos_importados(filas)
+
+    assert resultado['total_errores'] == 0
+    assert resultado['guardados'] == 2
+    assert resultado['anios'] == [2023]
+    (_, parametros), = motor.sentencias('INSERT INTO SaldoCuenta')
+    assert parametros['v1_0'] == '1102' and parametros['v1_1'] == 7 and parametros['v1_2'] == Decimal('5.25')
+
+
+def test_cargar_saldos_importados_catalogo_vacio(motor_falso):
+    motor_falso()
+    with pytest.raises(ValueError, match='catálogo de cuentas está vacío'):
+        utils.cargar_saldos_importados([(2, {'cuenta_id': '1101', 'anio': '2023', 'monto': '1'})])
@@ -0,0 +1,52 @@
+from flask import Flask
+
+from app import utils
+
+
+def _reporte(anio):
+    return {'Activo': {}, 'Pasivo': {}, 'Patrimonio': {}, 'Ingreso': {}, 'Costo': {}, 'Gasto': {},
+            'Totales': {'Total Activo': float(anio)}}
+
+
+def _preparar(monkeypatch):
+    cargas = []
+
+    def cargar(anios):
+        cargas.append(list(anios))
+        return {anio: _reporte(anio) for anio in anios if anio != 1999}
+
+    monkeypatch.setattr(utils, '_cache_reportes', {})
+    monkeypatch.setattr(utils, 'leer_versiones_compartidas', lambda: {})
+    monkeypatch.setattr(utils, '_cargar_reportes_financieros', cargar)
+    return cargas
+
+
+def test_memo_materializa_cada_anio_una_vez_por_peticion(monkeypatch):
+    cargas = _preparar(monkeypatch)
+    with Flask(__name__).app_context():
+        reportes = utils.get_financial_reports_many([2023, 2022, 2023, 1999])
+        assert cargas == [[2023, 2022, 1999]]
+        assert reportes[1999] is None
+        assert reportes[2023]['Totales']['Total Activo'] == 2023.0
+
+        # Aunque la caché del proceso se vacíe, la petición sigue usando su memo
+        utils._cache_reportes.clear()
+        assert utils.get_financial_reports(2022) is reportes[2022]
+        assert cargas == [[2023, 2022, 1999]]
+        assert utils.reportes_materializados() == 3
+
+    # Una petición nueva no ve el memo anterior: como la caché del proceso se vació,
+    # vuelve a cargar 2023 una vez
+    with Flask(__name__).app_context():
+        utils.get_financial_reports_many([2023])
+        assert cargas == [[2023, 2022, 1999], [2023]]
+        assert utils.get_financial_reports(2023) is not None
+        assert utils.reportes_materializados() == 1
+
+
+def test_sin_contexto_no_hay_memo(monkeypatch):
+    cargas = _preparar(monkeypatch)
+    utils.get_financial_reports(2023)
+    utils.get_financial_reports(2023)
+    assert cargas == [[2023]]
+    assert utils.reportes_materializados() == 0
@@ -0,0 +1,65 @@
+import io
+
+from app import utils
+
+_SELECT_CATALOGO = 'SELECT CuentaID, NombreCuenta, TipoCuenta, SubTipoCuenta FROM CatalogoCuentas'
+
+
+def _fila(numero, cuenta_id, nombre, tipo, subtipo):
+    return numero, {'cuenta_id': cuenta_id, 'nombre': nombre, 'tipo': tipo, 'subtipo': subtipo}
+
+
+def test_sincronizar_catalogo_aplica_la_diferencia(motor_falso):
+    motor = motor_falso({_SELECT_CATALOGO: [
+        ('1101', 'Caja', 'Activo', 'Activo Corriente'),
+        ('2101 ', 'Proveedores', 'Pasivo', 'Pasivo Corriente'),  # CHAR con relleno: sin cambios
+        ('3101', 'Capital', 'Patrimonio', 'Capital'),
+        ('9999', 'Cuenta vieja', 'Gasto', 'Gasto Operativo'),
+    ]})
+    filas = [
+        _fila(2, '1101', 'Caja y Bancos', 'Activo', 'Activo Corriente'),
+        _fila(3, '2101', 'Proveedores', 'Pasivo', 'Pasivo Corriente'),
+        _fila(4, 3101.0, 'Capital', 'Patrimonio', 'Capital'),
+        _fila(5, '4101', 'Ventas', 'Ingreso', 'Ingresos Operativos'),
+    ]
+    resultado = utils.sincronizar_catalogo(filas)
+
+    assert resultado['total_errores'] == 0
+    assert (resultado['insertadas'], resultado['actualizadas'], resultado['sin_cambios'], resultado['ausentes']) == (1, 1, 2, 1)
+    (_, insertadas), = motor.sentencias('INSERT INTO CatalogoCuentas')
+    assert insertadas == {'v0_0': '4101', 'v0_1': 'Ventas', 'v0_2': 'Ingreso', 'v0_3': 'Ingresos Operativos'}
+    (_, actualizadas), = motor.sentencias('UPDATE CatalogoCuentas')
+    assert actualizadas == [{'id': '1101', 'nombre': 'Caja y Bancos', 'tipo': 'Activo', 'subtipo': 'Activo Corriente'}]
+
+
+def test_sincronizar_catalogo_con_errores_no_escribe(motor_falso):
+    motor = motor_falso()
+    filas = [
+        _fila(2, '', 'Sin id', 'Activo', 'Activo Corriente'),
+        _fila(3, 'X' * (utils.CUENTA_ID_MAX + 1), 'Largo', 'Activo', 'Activo Corriente'),
+        _fila(4, '1101', 'Caja', 'Activo', 'Activo Corriente'),
+        _fila(5, '1101', 'Caja repetida', 'Activo', 'Activo Corriente'),
+        _fila(6, '1102', 'N' * (utils.NOMBRE_CUENTA_MAX + 1), 'Activo', 'Activo Corriente'),
+        _fila(7, '1103', 'Bancos', 'Activos', 'Activo Corriente'),
+        _fila(8, '1104', 'Clientes', 'Activo', ''),
+        _fila(9, '1105', 'Inventario', 'Activo', 'Pasivo Corriente'),
+    ]
+    resultado = utils.sincronizar_catalogo(filas)
+
+    mensajes = dict(resultado['errores'])
+    assert resultado['total_errores'] == 7
+    assert mensajes[2] == 'falta el CuentaID'
+    assert 'supera los 20 caracteres' in mensajes[3]
+    assert 'repetida' in mensajes[5]
+    assert 'supera los 100 caracteres' in mensajes[6]
+    assert mensajes[7] == 'tipo de cuenta inválido "Activos"'
+    assert 'no tiene subtipo' in mensajes[8]
+    assert mensajes[9] == 'el subtipo "Pasivo Corriente" no corresponde al tipo "Activo"'
+    assert motor.conexion.sentencias == []
+
+
+def test_leer_filas_catalogo_comparte_los_alias_de_saldos():
+    archivo = io.BytesIO('Cuenta,Nombre,Tipo,Subtipo\n1101,Caja,Activo,Activo Corriente\n'.encode('utf-8'))
+    assert list(utils.leer_filas_catalogo(archivo, 'catalogo.csv')) == [
+        _fila(2, '1101', 'Caja', 'Activo', 'Activo Corriente'),
+    ]
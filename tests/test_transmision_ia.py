@@ -0,0 +1,62 @@
+import json
+import uuid
+
+import pytest
+from flask import Flask
+
+from app import utils
+
+
+def _eventos(respuesta):
+    """[(evento, datos)] de un cuerpo text/event-stream."""
+    eventos = []
+    for bloque in respuesta.get_data(as_text=True).strip().split('\n\n'):
+        evento, datos = bloque.split('\n')
+        eventos.append((evento[len('event: '):], json.loads(datos[len('data: '):])))
+    return eventos
+
+
+@pytest.fixture
+def contexto():
+    with Flask(__name__).test_request_context():
+        yield
+
+
+def test_modelo_falso_activo():
+    assert utils.IA_MODELO_FALSO
+    assert isinstance(utils.obtener_modelo_ia(utils.modelos_para('analisis')[0]), utils.ModeloIAFalso)
+
+
+def test_transmision_sse_con_modelo_falso(contexto):
+    prompt = f'Analiza la liquidez {uuid.uuid4()}'
+    respuesta = utils.respuesta_sse(utils.transmitir_analisis_ia(prompt))
+    assert respuesta.mimetype == 'text/event-stream'
+    assert respuesta.headers['Cache-Control'] == 'no-cache'
+
+    eventos = _eventos(respuesta)
+    fragmentos = [datos['texto'] for evento, datos in eventos if evento == 'fragmento']
+    evento, fin = eventos[-1]
+    assert evento == 'fin'
+    assert len(fragmentos) > 1
+    assert fin['texto'] == ''.join(fragmentos)
+    assert fin['texto'].startswith('**Análisis de prueba**')
+    assert '<strong>Análisis de prueba</strong>' in fin['html']
+
+    # La respuesta completa quedó en la caché: la siguiente transmisión la entrega de una vez
+    clave = utils.clave_cache_ia(prompt, utils.modelos_para('analisis')[0])
+    assert utils.leer_cache_ia(clave) == fin['texto']
+    eventos = _eventos(utils.respuesta_sse(utils.transmitir_analisis_ia(prompt)))
+    assert eventos == [('fragmento', {'texto': fin['texto']}), ('fin', fin)]
+    assert utils.estado_analisis_ia(clave) == {'estado': 'listo', 'html': fin['html']}
+
+
+def test_transmision_sse_reporta_el_error(contexto):
+    def fragmentos():
+        yield 'inicio '
+        raise RuntimeError('fallo a mitad de camino')
+
+    eventos = _eventos(utils.respuesta_sse(fragmentos()))
+    assert eventos == [
+        ('fragmento', {'texto': 'inicio '}),
+        ('error', {'error': 'fallo a mitad de camino'}),
+    ]